@@ -4,9 +4,10 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
 
-from skimage.feature import hog
 from skimage import color
+from skimage.transform import resize
 
 from six.moves import cPickle
 import numpy as np
@@ -22,6 +23,9 @@ c_p_b    = (1, 1)
 h_type   = 'region'
 d_type   = 'd1'
 
+single_pass = False  # region mode: run HOG once on the whole image and assign its cells to regions
+max_side    = None   # downscale images whose longer side exceeds max_side before HOG, None keeps the original size
+
 depth    = 5
 
 ''' MMAP
@@ -69,17 +73,23 @@ if not os.path.exists(cache_dir):
 
 
 class HOG(object):
+  use_gray = True  # uses the gray image shared by feature_store
 
-  def histogram(self, input, n_bin=n_bin, type=h_type, n_slice=n_slice, normalize=True):
+  def histogram(self, input, n_bin=n_bin, type=h_type, n_slice=n_slice, normalize=True,
+                single_pass=single_pass, max_side=max_side, gray=None):
     ''' count img histogram
   
       arguments
-        input    : a path to a image or a numpy.ndarray
-        n_bin    : number of bins of histogram
-        type     : 'global' means count the histogram for whole image
-                   'region' means count the histogram for regions in images, then concatanate all of them
-        n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
-        normalize: normalize output histogram
+        input      : a path to a image or a numpy.ndarray
+        n_bin      : number of bins of histogram
+        type       : 'global' means count the histogram for whole image
+                     'region' means count the histogram for regions in images, then concatanate all of them
+        n_slice    : work when type equals to 'region', height & width will equally sliced into N slices
+        normalize  : normalize output histogram
+        single_pass: work when type equals to 'region', compute gradients and cells once for the whole image
+                     instead of once per region
+        max_side   : downscale the image so that its longer side is at most max_side, None disables it
+        gray       : color.rgb2gray of the image if already computed
   
       return
         type == 'global'
@@ -92,9 +102,17 @@ class HOG(object):
     else:
       img = imageio.imread(input)
     height, width, channel = img.shape
+    if max_side and max(height, width) > max_side:
+      scale = float(max_side) / max(height, width)
+      height, width = max(int(round(height * scale)), 1), max(int(round(width * scale)), 1)
+      img = resize(img, (height, width), anti_aliasing=True, preserve_range=True).astype(img.dtype)
+      gray = None  # the gray image no longer matches
   
     if type == 'global':
-      hist = self._HOG(img, n_bin)
+      hist = self._HOG(img, n_bin, gray=gray)
+  
+    elif type == 'region' and single_pass:
+      hist = self._HOG_regions(img, n_bin, n_slice, gray=gray)
   
     elif type == 'region':
       hist = np.zeros((n_slice, n_slice, n_bin))
@@ -104,16 +122,17 @@ class HOG(object):
       for hs in range(len(h_silce)-1):
         for ws in range(len(w_slice)-1):
           img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._HOG(img_r, n_bin)
+          gray_r = None if gray is None else gray[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]
+          hist[hs][ws] = self._HOG(img_r, n_bin, gray=gray_r)
   
     if normalize:
       hist /= np.sum(hist)
   
     return hist.flatten()
 
-  def _HOG(self, img, n_bin, normalize=True):
-    image = color.rgb2gray(img)
-    fd = hog(image, orientations=n_orient, pixels_per_cell=p_p_c, cells_per_block=c_p_b)
+  def _HOG(self, img, n_bin, normalize=True, gray=None):
+    image = color.rgb2gray(img) if gray is None else gray
+    fd = self._hog(image).ravel()
     bins = np.linspace(0, np.max(fd), n_bin+1, endpoint=True)
     hist, _ = np.histogram(fd, bins=bins)
   
@@ -122,35 +141,101 @@ class HOG(object):
   
     return hist
 
-  def make_samples(self, db, verbose=True):
+  def _hog(self, image, eps=1e-5):
+    ''' vectorized skimage.feature.hog(image, n_orient, p_p_c, c_p_b, block_norm='L2-Hys', feature_vector=False)
+  
+      skimage normalizes the blocks one by one in a Python loop, which dominates the run time for
+      small cells; the same steps are done here on whole arrays, the results agree with skimage up to
+      its single precision rounding
+  
+      return
+        a numpy array with shape (n_blocks_row, n_blocks_col, b_row, b_col, n_orient)
+    '''
+    image = image.astype(float)
+    g_row = np.zeros_like(image)
+    g_row[1:-1, :] = image[2:, :] - image[:-2, :]
+    g_col = np.zeros_like(image)
+    g_col[:, 1:-1] = image[:, 2:] - image[:, :-2]
+    magnitude = np.hypot(g_row, g_col)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+  
+    c_row, c_col = p_p_c
+    b_row, b_col = c_p_b
+    n_cells_row, n_cells_col = image.shape[0] // c_row, image.shape[1] // c_col
+    n_blocks_row, n_blocks_col = n_cells_row - b_row + 1, n_cells_col - b_col + 1
+    if n_blocks_row <= 0 or n_blocks_col <= 0:
+      raise ValueError('The input image is too small given the values of pixels_per_cell and cells_per_block.')
+  
+    # orientation bin edges in single precision, as in skimage's hog_histograms
+    edges = (np.float32(180. / n_orient) * np.arange(n_orient+1, dtype=np.float32)).astype(float)
+    orient_idx = np.searchsorted(edges, orientation, side='right') - 1
+    cell_row = np.arange(image.shape[0]) // c_row
+    cell_col = np.arange(image.shape[1]) // c_col
+    valid = (cell_row[:, None] < n_cells_row) & (cell_col[None, :] < n_cells_col) & (orient_idx < n_orient)
+    idx = (cell_row[:, None] * n_cells_col + cell_col[None, :]) * n_orient + orient_idx
+    cells = np.bincount(idx[valid], weights=magnitude[valid], minlength=n_cells_row * n_cells_col * n_orient)
+    cells = cells.reshape(n_cells_row, n_cells_col, n_orient) / (c_row * c_col)
+  
+    # L2-Hys normalization of every block
+    blocks = np.lib.stride_tricks.sliding_window_view(cells, (b_row, b_col), axis=(0, 1))
+    blocks = blocks.transpose(0, 1, 3, 4, 2)
+    out = blocks / np.sqrt(np.sum(blocks**2, axis=(2, 3, 4), keepdims=True) + eps**2)
+    out = np.minimum(out, 0.2)
+    out = out / np.sqrt(np.sum(out**2, axis=(2, 3, 4), keepdims=True) + eps**2)
+    return out
+  
+  def _HOG_regions(self, img, n_bin, n_slice, normalize=True, gray=None):
+    ''' region histograms from one whole-image HOG, every block goes to the region holding its center
+  
+      return
+        a numpy array with size n_slice * n_slice * n_bin
+    '''
+    height, width = img.shape[:2]
+    image = color.rgb2gray(img) if gray is None else gray
+    fd = self._hog(image)
+    n_rows, n_cols = fd.shape[:2]
+    values = fd.reshape(n_rows * n_cols, -1)
+  
+    h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
+    w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+    center_h = (np.arange(n_rows) + c_p_b[0] / 2.) * p_p_c[0]
+    center_w = (np.arange(n_cols) + c_p_b[1] / 2.) * p_p_c[1]
+    region_h = np.clip(np.searchsorted(h_silce, center_h, side='right') - 1, 0, n_slice-1)
+    region_w = np.clip(np.searchsorted(w_slice, center_w, side='right') - 1, 0, n_slice-1)
+    region = (region_h[:, None] * n_slice + region_w[None, :]).ravel()
+  
+    # bins span [0, max] of every region like _HOG, the max itself falls into the last bin
+    region_max = np.zeros(n_slice * n_slice)
+    np.maximum.at(region_max, region, values.max(axis=1))
+    scale = np.divide(n_bin, region_max, out=np.zeros_like(region_max), where=region_max > 0)
+    bin_idx = np.minimum((values * scale[region][:, None]).astype(int), n_bin-1)
+    bin_idx[region_max[region] == 0] = n_bin-1
+    idx = region[:, None] * n_bin + bin_idx
+    hist = np.bincount(idx.ravel(), minlength=n_slice * n_slice * n_bin).astype(float)
+    hist = hist.reshape(n_slice, n_slice, n_bin)
+  
+    if normalize:
+      total = np.sum(hist, axis=2, keepdims=True)
+      hist = np.divide(hist, total, out=np.zeros_like(hist), where=total > 0)
+  
+    return hist
+  
+  def cache_name(self):
     if h_type == 'global':
       sample_cache = "HOG-{}-n_bin{}-n_orient{}-ppc{}-cpb{}".format(h_type, n_bin, n_orient, p_p_c, c_p_b)
     elif h_type == 'region':
       sample_cache = "HOG-{}-n_bin{}-n_slice{}-n_orient{}-ppc{}-cpb{}".format(h_type, n_bin, n_slice, n_orient, p_p_c, c_p_b)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-
-    return samples
+      if single_pass:
+        sample_cache += "-single_pass"
+    if max_side:
+      sample_cache += "-max_side{}".format(max_side)
+    return sample_cache
+
+  def extract(self, img, gray=None):
+    return self.histogram(img, type=h_type, n_slice=n_slice, gray=gray)
+
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
 
 
 if __name__ == "__main__":
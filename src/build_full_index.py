@@ -1,31 +1,29 @@
 import os
+import argparse
 import numpy as np
-import faiss
-from PIL import Image
 
-# 导入各特征提取方法
-from color import Color
-from daisy import Daisy
-from HOG import HOG
-from resnet import extract_resnet_feature
-from vggnet import extract_vgg_feature
-from fusion import extract_fusion_feature  
+import index_segments
+import resnet
+import vggnet
+from build_pipeline import extract_features, create_pool, default_workers, Progress
+from feature_shards import FeatureShards, ConfigMismatchError
+from thumbnail import ThumbnailService
+from inference_modes import index_meta
+from index_registry import read_index_meta, write_index_meta
 
 # 使用绝对路径，避免相对路径问题
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 dataset_dir = os.path.join(BASE_DIR, "..", "dataset")
 faiss_index_dir = os.path.join(BASE_DIR, "..", "faiss_index")
+thumbnail_dir = os.path.join(BASE_DIR, "..", "thumbnails")
 os.makedirs(faiss_index_dir, exist_ok=True)
+# 断点分片目录，构建完成后删除
+build_dir = os.path.join(faiss_index_dir, "build")
+# 每个分片包含的图片数量
+default_shard_size = int(os.environ.get("CBIR_SHARD_SIZE", "4096"))
 
-# 特征类型与提取函数映射
-feature_methods = {
-    "color": lambda img: Color().histogram(img),
-    "texture": lambda img: Daisy().histogram(img),
-    "shape": lambda img: HOG().histogram(img),
-    "resnet": extract_resnet_feature,
-    "vgg": extract_vgg_feature,
-    "fusion": extract_fusion_feature,
-}
+# 依次构建索引的特征类型
+feature_types = ["color", "texture", "shape", "edge", "resnet", "vgg", "fusion"]
 
 def get_image_files(directory):
     """获取目录中的所有图片文件"""
@@ -35,75 +33,128 @@ def get_image_files(directory):
             image_files.append(fname)
     return image_files
 
-def extract_features_from_image(img_path, feature_type, extract_func):
-    """从单张图片提取特征"""
-    try:
-        img = Image.open(img_path)
-        if img.format == 'GIF':
-            try:
-                img.seek(0)
-            except Exception:
-                return None
-        img = img.convert('RGB')
-        
-        # 根据特征类型传递不同类型
-        if feature_type in ["color", "texture", "shape"]:
-            input_data = np.array(img)
-        else:
-            input_data = img
-            
-        feat = extract_func(input_data)
-        if feat is not None:
-            return np.array(feat).flatten()
-    except Exception as e:
-        print(f"特征提取失败: {img_path}, 错误: {e}")
-    return None
+def build_config():
+    """本次构建的配置，续跑时必须与断点一致"""
+    backbones = {"resnet": resnet.backbone_spec(), "vgg": vggnet.backbone_spec()}
+    return {"meta": {feature_type: index_meta(feature_type, backbones) for feature_type in feature_types}}
 
-def main():
-    # 获取所有图片文件
-    image_files = get_image_files(dataset_dir)
+def main(workers=default_workers, shard_size=default_shard_size, restart=False):
+    """
+    Args:
+        workers: 提取手工特征的工作进程数，为0时在当前进程中提取
+        shard_size: 每个分片包含的图片数量
+        restart: 丢弃上次中断的构建，从头开始
+    """
+    # 获取所有图片文件，排序后续跑时按相同顺序处理
+    image_files = sorted(get_image_files(dataset_dir))
     if not image_files:
         print("dataset目录中没有找到图片文件。")
         return
     
-    print(f"发现 {len(image_files)} 张图片，开始完整索引构建...")
+    try:
+        shards = FeatureShards(build_dir, feature_types, build_config(), restart)
+    except ConfigMismatchError as e:
+        print(e)
+        return
+    done = shards.done_files()
+    todo = [fname for fname in image_files if fname not in done]
+    if done:
+        print(f"从断点继续：已完成 {len(shards.shards)} 个分片（{len(done)} 张图片），剩余 {len(todo)} 张图片")
+    else:
+        print(f"发现 {len(image_files)} 张图片，开始完整索引构建...")
+    
+    try:
+        extract_to_shards(shards, todo, workers, shard_size)
+    except KeyboardInterrupt:
+        print(f"构建已中断，已保存 {len(shards.shards)} 个分片，重新运行同一命令可从断点继续。")
+        return
     
-    # 为每种特征类型构建完整索引
-    for feature_type, extract_func in feature_methods.items():
-        features = []
-        img_paths = []
-        print(f"正在提取 {feature_type} 特征...")
-        
-        for fname in image_files:
-            img_path = os.path.join(dataset_dir, fname)
-            feat = extract_features_from_image(img_path, feature_type, extract_func)
-            if feat is not None:
-                features.append(feat)
-                img_paths.append(fname)
-        
-        if not features:
-            print(f"{feature_type} 没有提取到任何特征，跳过。")
-            continue
-        
-        # 保存特征和路径
-        features = np.vstack(features).astype('float32')
-        features_file = os.path.join(faiss_index_dir, f'features_{feature_type}.npy')
-        paths_file = os.path.join(faiss_index_dir, f'img_paths_{feature_type}.txt')
-        index_file = os.path.join(faiss_index_dir, f'index_{feature_type}.faiss')
-        
-        np.save(features_file, features)
-        with open(paths_file, 'w', encoding='utf-8') as f:
-            for p in img_paths:
-                f.write(p + '\n')
-        
-        # 创建FAISS索引
-        index = faiss.IndexFlatL2(features.shape[1])
-        index.add(features)
-        faiss.write_index(index, index_file)
-        
-        print(f"{feature_type} 特征索引构建完成，共处理了 {len(features)} 张图片。")
+    # 由分片组装每种特征的完整索引
+    current = set(image_files)
+    for feature_type in feature_types:
+        save_feature_index(feature_type, shards, current)
     
+    # 预生成结果页使用的缩略图
+    ThumbnailService(dataset_dir, thumbnail_dir).generate_all(image_files)
+    
+    shards.remove()
     print("完整索引构建完成！")
 
+def extract_to_shards(shards, image_files, workers, shard_size):
+    """遍历一次图片，同时提取所有特征，每处理 shard_size 张图片写入一个分片"""
+    paths = [os.path.join(dataset_dir, fname) for fname in image_files]
+    progress = Progress(len(paths), "特征提取")
+    buffer = {feature_type: ([], []) for feature_type in feature_types}
+    start = 0
+    pool = create_pool(workers)
+    try:
+        for idxs, feats in extract_features(paths, feature_types, pool, workers):
+            for feature_type, (shard_features, shard_paths) in buffer.items():
+                for i, feat in zip(idxs, feats[feature_type]):
+                    if feat is not None:
+                        shard_features.append(feat)
+                        shard_paths.append(image_files[i])
+            end = idxs[-1] + 1
+            progress.update(end)
+            if end - start >= shard_size:
+                shards.write_shard(image_files[start:end], buffer)
+                buffer = {feature_type: ([], []) for feature_type in feature_types}
+                start = end
+        if start < len(image_files):
+            shards.write_shard(image_files[start:], buffer)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    progress.finish()
+
+def save_feature_index(feature_type, shards, current):
+    """
+    由分片组装一种特征的索引段和元数据，替换原有的段
+    每次只读入一个段的特征，不需要把所有特征同时读入内存
+
+    Args:
+        current: dataset目录中现有的图片，构建期间删除的图片不进入索引
+    """
+    parts = []
+    for feats, paths in shards.iter_feature(feature_type):
+        keep = np.array([p in current for p in paths], dtype=bool)
+        if keep.any():
+            parts.append((feats, [p for p, k in zip(paths, keep) if k], keep))
+    total = sum(len(paths) for _, paths, _ in parts)
+    if not total:
+        print(f"{feature_type} 没有提取到任何特征，跳过。")
+        return
+    
+    # 分片按顺序写为索引的段，相邻分片合并到不少于 merge_min_rows 行，避免刚建好的索引就需要合并小段
+    def blocks():
+        group = []
+        for feats, paths, keep in parts:
+            group.append((np.ascontiguousarray(feats[keep], dtype='float32'), paths))
+            if sum(len(p) for _, p in group) >= index_segments.merge_min_rows:
+                yield np.concatenate([f for f, _ in group]), [p for _, ps in group for p in ps]
+                group = []
+        if group:
+            yield np.concatenate([f for f, _ in group]), [p for _, ps in group for p in ps]
+    
+    index_segments.replace_segments(faiss_index_dir, feature_type, blocks())
+    # 记录构建时的推理模式和骨干网络，Web服务按元数据创建模型，只用相同模式的查询特征检索
+    write_index_meta(faiss_index_dir, feature_type, shards.config["meta"][feature_type])
+    
+    print(f"{feature_type} 特征索引构建完成，共处理了 {total} 张图片。")
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="重建所有特征的完整索引")
+    parser.add_argument("--resnet", choices=list(resnet.model_urls), default=resnet.RES_model,
+                        help="ResNet特征的骨干网络，较小的模型速度更快")
+    parser.add_argument("--vgg", choices=list(vggnet.model_urls), default=vggnet.VGG_model,
+                        help="VGG特征的骨干网络")
+    parser.add_argument("--workers", type=int, default=default_workers,
+                        help="提取手工特征的工作进程数，默认为CPU核数，0表示在当前进程中提取")
+    parser.add_argument("--shard-size", type=int, default=default_shard_size,
+                        help="每个分片包含的图片数量，完成的分片在中断后不会重新提取")
+    parser.add_argument("--restart", action="store_true",
+                        help="丢弃上次中断的构建，从头开始")
+    args = parser.parse_args()
+    resnet.RES_model = args.resnet
+    vggnet.VGG_model = args.vgg
+    main(args.workers, args.shard_size, args.restart) 
\ No newline at end of file
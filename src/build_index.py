@@ -1,37 +1,30 @@
 import os
+import argparse
 import numpy as np
-import faiss
-from PIL import Image
 import shutil
 import json
 import torch
 import gc
 
-# 导入各特征提取方法
-from color import Color
-from daisy import Daisy
-from HOG import HOG
-from resnet import extract_resnet_feature
-from vggnet import extract_vgg_feature
-from fusion import extract_fusion_feature  
+import index_segments
+import resnet
+import vggnet
+from build_pipeline import extract_features, create_pool, default_workers, Progress
+from thumbnail import ThumbnailService
+from inference_modes import index_meta
+from index_registry import read_index_meta, write_index_meta, index_backbones, deep_feature_types
 
 # 使用绝对路径，避免相对路径问题
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 dataset_dir = os.path.join(BASE_DIR, "..", "dataset")
 new_dir = os.path.join(dataset_dir, "new")
 faiss_index_dir = os.path.join(BASE_DIR, "..", "faiss_index")
+thumbnail_dir = os.path.join(BASE_DIR, "..", "thumbnails")
 os.makedirs(faiss_index_dir, exist_ok=True)
 os.makedirs(new_dir, exist_ok=True)
 
-# 特征类型与提取函数映射
-feature_methods = {
-    "color": lambda img: Color().histogram(img),
-    "texture": lambda img: Daisy().histogram(img),
-    "shape": lambda img: HOG().histogram(img),
-    "resnet": extract_resnet_feature,
-    "vgg": extract_vgg_feature,
-    "fusion": extract_fusion_feature,
-}
+# 依次构建索引的特征类型
+feature_types = ["color", "texture", "shape", "edge", "resnet", "vgg", "fusion"]
 
 def clear_gpu_memory():
     """清理GPU内存"""
@@ -47,68 +40,8 @@ def get_image_files(directory):
             image_files.append(fname)
     return image_files
 
-def extract_features_from_image(img_path, feature_type, extract_func):
-    """从单张图片提取特征"""
-    try:
-        img = Image.open(img_path)
-        if img.format == 'GIF':
-            try:
-                img.seek(0)
-            except Exception:
-                return None
-        img = img.convert('RGB')
-        
-        # 根据特征类型传递不同类型
-        if feature_type in ["color", "texture", "shape"]:
-            input_data = np.array(img)
-        else:
-            input_data = img
-            
-        feat = extract_func(input_data)
-        if feat is not None:
-            return np.array(feat).flatten()
-    except Exception as e:
-        print(f"特征提取失败: {img_path}, 错误: {e}")
-        # 清理GPU内存
-        clear_gpu_memory()
-    return None
-
-def load_existing_index(feature_type):
-    """加载现有的索引文件"""
-    features_file = os.path.join(faiss_index_dir, f'features_{feature_type}.npy')
-    paths_file = os.path.join(faiss_index_dir, f'img_paths_{feature_type}.txt')
-    index_file = os.path.join(faiss_index_dir, f'index_{feature_type}.faiss')
-    
-    features = []
-    img_paths = []
-    index = None
-    
-    if os.path.exists(features_file) and os.path.exists(paths_file) and os.path.exists(index_file):
-        try:
-            features = np.load(features_file)
-            with open(paths_file, 'r', encoding='utf-8') as f:
-                img_paths = [line.strip() for line in f]
-            index = faiss.read_index(index_file)
-            print(f"加载现有 {feature_type} 索引，包含 {len(features)} 张图片")
-        except Exception as e:
-            print(f"加载现有索引失败: {e}")
-            features = []
-            img_paths = []
-            index = None
-    
-    return features, img_paths, index
-
-def save_index(features, img_paths, index, feature_type):
-    """保存索引文件"""
-    features_file = os.path.join(faiss_index_dir, f'features_{feature_type}.npy')
-    paths_file = os.path.join(faiss_index_dir, f'img_paths_{feature_type}.txt')
-    index_file = os.path.join(faiss_index_dir, f'index_{feature_type}.faiss')
-    
-    np.save(features_file, features)
-    with open(paths_file, 'w', encoding='utf-8') as f:
-        for p in img_paths:
-            f.write(p + '\n')
-    faiss.write_index(index, index_file)
+def has_index(feature_type):
+    return index_segments.has_index(faiss_index_dir, feature_type)
 
 def move_new_images_to_dataset():
     """将new目录中的图片移动到dataset目录"""
@@ -136,28 +69,68 @@ def move_new_images_to_dataset():
     
     return moved_files
 
-def process_feature_type(feature_type, extract_func, moved_files):
-    """处理单个特征类型，包含内存管理"""
+# 模块中配置的骨干网络，新建索引且命令行未指定时使用
+default_backbones = {"resnet": resnet.backbone_spec(), "vgg": vggnet.backbone_spec()}
+
+def select_backbones(feature_type, has_index, requested):
+    """
+    选择增量构建使用的骨干网络：有现有索引时沿用其元数据中记录的骨干网络
+
+    Args:
+        requested: 命令行指定的骨干网络 {网络: 模型}
+    Returns:
+        {网络: {"model", "layer"}}；与现有索引的推理模式、特征层或指定的骨干网络不一致时返回None
+    """
+    backbones = dict(default_backbones)
+    for network, model in requested.items():
+        backbones[network] = dict(backbones[network], model=model)
+    if not has_index or feature_type not in deep_feature_types:
+        return backbones
+
+    meta = read_index_meta(faiss_index_dir, feature_type)
+    # 同一索引中的特征必须用同一推理模式提取，没有元数据的旧索引按fp32处理
+    built_mode = meta.get('inference_mode', 'fp32')
+    current_mode = index_meta(feature_type, backbones)['inference_mode']
+    if built_mode != current_mode:
+        print(f"{feature_type} 索引使用 {built_mode} 模式构建，当前为 {current_mode}，请用 build_full_index.py 重建，跳过。")
+        return None
+    for network, spec in index_backbones(meta, feature_type).items():
+        if requested.get(network, spec['model']) != spec['model'] or spec['layer'] != backbones[network]['layer']:
+            print(f"{feature_type} 索引使用 {spec['model']}/{spec['layer']} 构建，与当前配置不一致，请用 build_full_index.py 重建，跳过。")
+            return None
+        backbones[network] = spec
+    return backbones
+
+def extract_new_features(new_fnames, plans, workers=default_workers):
+    """
+    遍历一次新图片，同时提取所有待更新特征
+
+    Args:
+        plans: {特征类型: 骨干网络}，select_backbones 的结果
+    Returns:
+        {特征类型: (特征列表, 图片文件名列表)}
+    """
+    paths = [os.path.join(dataset_dir, fname) for fname in new_fnames]
+    results = {feature_type: ([], []) for feature_type in plans}
+    progress = Progress(len(paths), "特征提取")
+    pool = create_pool(workers)
+    try:
+        for idxs, feats in extract_features(paths, list(plans), pool, workers, backbones=plans):
+            for feature_type, (new_features, new_paths) in results.items():
+                for i, feat in zip(idxs, feats[feature_type]):
+                    if feat is not None:
+                        new_features.append(feat)
+                        new_paths.append(new_fnames[i])
+            progress.update(idxs[-1] + 1)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    progress.finish()
+    return results
+
+def process_feature_type(feature_type, new_features, new_paths, backbones):
+    """把新特征合并到单个特征类型的索引，包含内存管理"""
     print(f"正在处理 {feature_type} 特征...")
-    
-    # 加载现有索引
-    existing_features, existing_paths, existing_index = load_existing_index(feature_type)
-    
-    # 提取新图片的特征
-    new_features = []
-    new_paths = []
-    
-    for old_fname, new_fname in moved_files.items():
-        img_path = os.path.join(dataset_dir, new_fname)
-        feat = extract_features_from_image(img_path, feature_type, extract_func)
-        if feat is not None:
-            new_features.append(feat)
-            new_paths.append(new_fname)
-        
-        # 每处理几张图片就清理一次内存
-        if len(new_features) % 3 == 0:
-            clear_gpu_memory()
-    
     if not new_features:
         print(f"{feature_type} 没有提取到任何新特征，跳过。")
         return
@@ -171,41 +144,22 @@ def process_feature_type(feature_type, extract_func, moved_files):
         new_features = [feat[:min_dim] for feat in new_features]
         print(f"统一特征维度为: {min_dim}")
     
-    # 合并特征和路径
+    # 新特征写为一个新段，现有的段不需要读取或重写（旧格式的索引第一次会被转换为段）
     new_features = np.vstack(new_features).astype('float32')
-    if len(existing_features) > 0:
-        # 检查维度匹配
-        if existing_features.shape[1] != new_features.shape[1]:
-            print(f"警告：现有特征维度 {existing_features.shape[1]} 与新特征维度 {new_features.shape[1]} 不匹配")
-            # 使用较小的维度
-            min_dim = min(existing_features.shape[1], new_features.shape[1])
-            existing_features = existing_features[:, :min_dim]
-            new_features = new_features[:, :min_dim]
-        
-        all_features = np.vstack([existing_features, new_features])
-        all_paths = existing_paths + new_paths
-    else:
-        all_features = new_features
-        all_paths = new_paths
-    
-    # 创建或更新FAISS索引
-    if existing_index is not None:
-        # 更新现有索引
-        existing_index.add(new_features)
-        index = existing_index
-    else:
-        # 创建新索引
-        index = faiss.IndexFlatL2(all_features.shape[1])
-        index.add(all_features)
-    
-    # 保存更新后的索引
-    save_index(all_features, all_paths, index, feature_type)
-    print(f"{feature_type} 特征索引更新完成，新增 {len(new_features)} 张图片，总计 {len(all_features)} 张图片。")
+    manifest = index_segments.append_segment(faiss_index_dir, feature_type, new_features, new_paths)
+    write_index_meta(faiss_index_dir, feature_type, index_meta(feature_type, backbones))
+    total = sum(segment['rows'] for segment in manifest['segments'])
+    print(f"{feature_type} 特征索引更新完成，新增 {len(new_features)} 张图片，总计 {total} 张图片。")
     
     # 清理内存
     clear_gpu_memory()
 
-def main():
+def main(requested_backbones=None, workers=default_workers):
+    """
+    Args:
+        requested_backbones: 命令行指定的骨干网络 {网络: 模型}，只用于还没有索引的特征
+        workers: 提取手工特征的工作进程数，为0时在当前进程中提取
+    """
     # 检查是否有新图片需要处理
     new_images = get_image_files(new_dir)
     if not new_images:
@@ -218,21 +172,46 @@ def main():
     # 移动新图片到dataset目录
     moved_files = move_new_images_to_dataset()
     
-    # 为每种特征类型构建增量索引
-    for feature_type, extract_func in feature_methods.items():
+    # 先确定各特征使用的骨干网络，与现有索引不一致的特征跳过
+    plans = {}
+    for feature_type in feature_types:
+        backbones = select_backbones(feature_type, has_index(feature_type), requested_backbones or {})
+        if backbones is not None:
+            plans[feature_type] = backbones
+    
+    # 遍历一次新图片提取所有特征，融合特征由已提取的分量拼接
+    results = extract_new_features(list(moved_files.values()), plans, workers) if plans else {}
+    
+    # 为每种特征类型构建增量索引，追加新段后在后台合并小段
+    compactions = []
+    for feature_type, (new_features, new_paths) in results.items():
         try:
-            process_feature_type(feature_type, extract_func, moved_files)
+            process_feature_type(feature_type, new_features, new_paths, plans[feature_type])
         except Exception as e:
             print(f"处理 {feature_type} 特征时出错: {e}")
             clear_gpu_memory()
             continue
+        compactions.append(index_segments.start_compaction(faiss_index_dir, feature_type))
+    
+    # 为新图片预生成结果页使用的缩略图
+    ThumbnailService(dataset_dir, thumbnail_dir).generate_all(moved_files.values())
     
     # 保存文件重命名映射（可选，用于调试）
     mapping_file = os.path.join(faiss_index_dir, 'file_mapping.json')
     with open(mapping_file, 'w', encoding='utf-8') as f:
         json.dump(moved_files, f, ensure_ascii=False, indent=2)
     
+    for thread in compactions:
+        thread.join()
     print("增量索引构建完成！")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="把 dataset/new/ 中的新图片增量加入索引")
+    parser.add_argument("--resnet", choices=list(resnet.model_urls),
+                        help="ResNet特征的骨干网络，默认沿用现有索引记录的骨干网络")
+    parser.add_argument("--vgg", choices=list(vggnet.model_urls),
+                        help="VGG特征的骨干网络，默认沿用现有索引记录的骨干网络")
+    parser.add_argument("--workers", type=int, default=default_workers,
+                        help="提取手工特征的工作进程数，默认为CPU核数，0表示在当前进程中提取")
+    args = parser.parse_args()
+    main({network: model for network, model in (("resnet", args.resnet), ("vgg", args.vgg)) if model}, args.workers) 
\ No newline at end of file
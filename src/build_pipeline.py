@@ -0,0 +1,168 @@
+import math
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import resnet
+import vggnet
+from handcrafted import handcrafted_methods, extract_handcrafted_multi
+from image_loader import iter_decoded, default_batch_size
+from index_registry import fusion_components
+
+# 索引构建流水线：解码线程按组预取图片，手工特征在进程池中提取，深度特征按 CBIR_BATCH_SIZE 分批推理
+# 每组图片数量，内存中最多同时保留约4组图片
+chunk_size = int(os.environ.get("CBIR_BUILD_CHUNK", "64"))
+# 手工特征的工作进程数，默认为CPU核数
+default_workers = os.cpu_count() or 1
+
+
+def format_duration(seconds: float) -> str:
+    if math.isinf(seconds) or math.isnan(seconds):
+        return "--:--"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60:02d}:{rest % 60:02d}"
+
+
+class Progress:
+    """按固定间隔打印处理进度、吞吐量和预计剩余时间"""
+
+    def __init__(self, total: int, label: str, interval: float = 10.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, done: int):
+        """done 为已处理（包括失败）的图片数"""
+        self.done = done
+        now = time.monotonic()
+        if now - self.last >= self.interval and done < self.total:
+            self.last = now
+            print(self.summary())
+
+    def finish(self):
+        self.done = self.total
+        print(self.summary())
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+        percent = 100.0 * self.done / self.total if self.total else 100.0
+        return (f"{self.label}: {self.done}/{self.total} ({percent:.1f}%)，{rate:.1f} 张/秒，"
+                f"已用 {format_duration(elapsed)}，剩余约 {format_duration(remaining)}")
+
+
+def create_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """手工特征的进程池，workers为0时返回None，在当前进程中提取"""
+    if workers <= 0:
+        return None
+    # spawn 避免在已初始化torch/OpenMP线程的进程中fork
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def feature_parts(feature_type: str, backbones: Optional[Dict[str, Dict]] = None) -> List:
+    """
+    特征由哪些基础特征拼接而成：手工特征为特征类型，深度特征为 (网络, 骨干网络)
+
+    Args:
+        backbones: {网络: {"model", "layer"}}，为None时使用模块中配置的骨干网络
+    """
+    backbones = backbones or {"resnet": resnet.backbone_spec(), "vgg": vggnet.backbone_spec()}
+    parts = []
+    for t in (fusion_components if feature_type == "fusion" else (feature_type,)):
+        parts.append(t if t in handcrafted_methods else (t, backbones[t]["model"]))
+    return parts
+
+
+def _deep_features(part: Tuple[str, str], imgs: List) -> List:
+    network, backbone = part
+    if network == "resnet":
+        return resnet.extract_resnet_features(imgs, backbone=backbone)
+    feats = []
+    for start in range(0, len(imgs), default_batch_size):
+        feats.extend(vggnet.extract_vgg_features(imgs[start:start + default_batch_size], backbone=backbone))
+    return feats
+
+
+def _flatten(feat) -> Optional[np.ndarray]:
+    if feat is None:
+        return None
+    return np.array(feat).astype('float32').flatten()
+
+
+def _submit_handcrafted(pool, workers: int, feature_types: List[str], imgs: List) -> List:
+    """把一组图片均分给工作进程，返回 [(起始位置, future或结果)]"""
+    arrays = [np.asarray(img) for img in imgs]
+    if pool is None:
+        return [(0, extract_handcrafted_multi(feature_types, arrays))]
+    size = max(1, math.ceil(len(arrays) / max(workers, 1)))
+    return [(start, pool.submit(extract_handcrafted_multi, feature_types, arrays[start:start + size]))
+            for start in range(0, len(arrays), size)]
+
+
+def _collect(paths: Sequence[str], idxs: List[int], handcrafted: List, feats: Dict,
+             plan: Dict[str, List]) -> Tuple[List[int], Dict[str, List]]:
+    for start, part in handcrafted:
+        result = part.result() if hasattr(part, 'result') else part
+        for feature_type, values in result.items():
+            column = feats.setdefault(feature_type, [None] * len(idxs))
+            for offset, value in enumerate(values):
+                if isinstance(value, Exception):
+                    print(f"{feature_type} 特征提取失败: {paths[idxs[start + offset]]}, 错误: {value}")
+                    value = None
+                column[start + offset] = value
+    results = {}
+    for feature_type, parts in plan.items():
+        if len(parts) == 1:
+            results[feature_type] = feats[parts[0]]
+        else:
+            # 融合特征由已提取的分量拼接，任一分量失败时该图片没有融合特征
+            results[feature_type] = [None if any(c is None for c in components) else np.concatenate(components)
+                                     for components in zip(*[feats[p] for p in parts])]
+    return idxs, results
+
+
+def extract_features(paths: Sequence[str], feature_types: Sequence[str], pool: Optional[ProcessPoolExecutor] = None,
+                     workers: int = default_workers, backbones: Optional[Dict[str, Dict]] = None,
+                     chunk_size: int = chunk_size) -> Iterator[Tuple[List[int], Dict[str, List]]]:
+    """
+    遍历一次图片，按组流式提取多种特征
+
+    每张图片只解码一次，每个基础特征只提取一次，融合特征由已提取的分量拼接；
+    手工特征交给进程池后，当前进程接着做本组的深度特征推理，同时解码线程预取后面的图片；
+    进程池中最多有两组图片在处理，内存占用与图片总数无关
+
+    Args:
+        paths: 图片路径列表
+        feature_types: 要提取的特征类型
+        pool: create_pool 创建的进程池，为None时在当前进程中提取手工特征
+        workers: 进程池的工作进程数，用于把一组图片均分成任务
+        backbones: {特征类型: {网络: {"model", "layer"}}}，各特征使用的骨干网络，缺省时使用模块中的配置
+
+    Yields:
+        (idxs, feats): 本组图片在paths中的下标；feats为 {特征类型: 与idxs等长的列表}，
+        元素为 float32 特征向量，解码或提取失败时为None（解码失败的图片不出现在idxs中）
+    """
+    backbones = backbones or {}
+    plan = {t: feature_parts(t, backbones.get(t)) for t in feature_types}
+    parts = list(dict.fromkeys(p for ps in plan.values() for p in ps))
+    handcrafted = [p for p in parts if p in handcrafted_methods]
+    deep = [p for p in parts if p not in handcrafted_methods]
+
+    pending = deque()
+    for idxs, imgs in iter_decoded(paths, chunk_size=chunk_size):
+        submitted = _submit_handcrafted(pool, workers, handcrafted, imgs) if handcrafted else []
+        feats = {p: [_flatten(f) for f in _deep_features(p, imgs)] for p in deep}
+        pending.append((idxs, submitted, feats))
+        if len(pending) > 1:
+            yield _collect(paths, *pending.popleft(), plan)
+    while pending:
+        yield _collect(paths, *pending.popleft(), plan)
@@ -4,11 +4,11 @@ from __future__ import print_function
 
 from evaluate import distance, evaluate_class
 from DB import Database
+import feature_store
 
 from six.moves import cPickle
 import numpy as np
 import scipy.misc
-import itertools
 import os
 import imageio
 
@@ -95,14 +95,17 @@ class Color(object):
       hist = self._count_hist(img, n_bin, bins, channel)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, n_bin ** channel))
+      # assign every pixel a region id, then count all regions with one bincount
       h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
       w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
+      h_region = np.searchsorted(h_silce, np.arange(height), side='right') - 1
+      w_region = np.searchsorted(w_slice, np.arange(width), side='right') - 1
+      region = h_region[:, None] * n_slice + w_region[None, :]
   
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._count_hist(img_r, n_bin, bins, channel)
+      n_hist = n_bin ** channel
+      idx = region * n_hist + self._bin_index(img, n_bin, bins, channel)
+      hist = np.bincount(idx.ravel(), minlength=n_slice * n_slice * n_hist).astype(float)
+      hist = hist.reshape(n_slice, n_slice, n_hist)
   
     if normalize:
       hist /= np.sum(hist)
@@ -110,50 +113,35 @@ class Color(object):
     return hist.flatten()
   
   
-  def _count_hist(self, input, n_bin, bins, channel):
-    img = input.copy()
-    bins_idx = {key: idx for idx, key in enumerate(itertools.product(np.arange(n_bin), repeat=channel))}  # permutation of bins
-    hist = np.zeros(n_bin ** channel)
+  def _bin_index(self, input, n_bin, bins, channel):
+    ''' joint bin index of every pixel, same order as itertools.product(range(n_bin), repeat=channel) '''
+    # bins[i] <= value < bins[i+1] falls into bin i
+    quantized = np.digitize(input, bins) - 1
+    if quantized.min() < 0 or quantized.max() >= n_bin:
+      raise ValueError("pixel values must be in [%s, %s)" % (bins[0], bins[-1]))
+    idx = np.zeros(input.shape[:2], dtype=np.int64)
+    for c in range(channel):
+      idx = idx * n_bin + quantized[..., c]
+    return idx
   
-    # cluster every pixels
-    for idx in range(len(bins)-1):
-      img[(input >= bins[idx]) & (input < bins[idx+1])] = idx
-    # add pixels into bins
-    height, width, _ = img.shape
-    for h in range(height):
-      for w in range(width):
-        b_idx = bins_idx[tuple(img[h,w])]
-        hist[b_idx] += 1
   
-    return hist
+  def _count_hist(self, input, n_bin, bins, channel):
+    idx = self._bin_index(input, n_bin, bins, channel)
+    return np.bincount(idx.ravel(), minlength=n_bin ** channel).astype(float)
   
   
-  def make_samples(self, db, verbose=True):
+  def cache_name(self):
     if h_type == 'global':
-      sample_cache = "histogram_cache-{}-n_bin{}".format(h_type, n_bin)
+      return "histogram_cache-{}-n_bin{}".format(h_type, n_bin)
     elif h_type == 'region':
-      sample_cache = "histogram_cache-{}-n_bin{}-n_slice{}".format(h_type, n_bin, n_slice)
-    
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_bin=n_bin, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+      return "histogram_cache-{}-n_bin{}-n_slice{}".format(h_type, n_bin, n_slice)
+
+  def extract(self, img, gray=None):
+    # img is the decoded RGB array shared with the other features
+    return self.histogram(img, type=h_type, n_bin=n_bin, n_slice=n_slice)
+
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
 
 
 if __name__ == "__main__":
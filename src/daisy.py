@@ -4,6 +4,7 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
 
 from skimage.feature import daisy
 from skimage import color
@@ -58,8 +59,9 @@ if not os.path.exists(cache_dir):
 
 
 class Daisy(object):
+  use_gray = True  # uses the gray image shared by feature_store
 
-  def histogram(self, input, type=h_type, n_slice=n_slice, normalize=True):
+  def histogram(self, input, type=h_type, n_slice=n_slice, normalize=True, gray=None):
     ''' count img histogram
   
       arguments
@@ -68,6 +70,7 @@ class Daisy(object):
                    'region' means count the histogram for regions in images, then concatanate all of them
         n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
         normalize: normalize output histogram
+        gray     : color.rgb2gray of the image if already computed
   
       return
         type == 'global'
@@ -83,22 +86,25 @@ class Daisy(object):
       img = imageio.imread(input, mode='RGB')
     height, width, channel = img.shape
   
-    P = math.ceil((height - radius*2) / step) 
-    Q = math.ceil((width - radius*2) / step)
-    assert P > 0 and Q > 0, "input image size need to pass this check"
-  
     if type == 'global':
-      hist = self._daisy(img)
+      hist = self._daisy(img, gray=gray)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, R))
+      # one descriptor field for the whole image, every descriptor goes to the region holding its center
+      descs, rows, cols = self._daisy_field(img, n_slice=n_slice, gray=gray)
       h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
       w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
-  
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._daisy(img_r)
+      region_h = np.clip(np.searchsorted(h_silce, rows, side='right') - 1, 0, n_slice-1)
+      region_w = np.clip(np.searchsorted(w_slice, cols, side='right') - 1, 0, n_slice-1)
+      region = (region_h[:, None] * n_slice + region_w[None, :]).ravel()
+  
+      sums = np.zeros((n_slice * n_slice, R))
+      np.add.at(sums, region, descs.reshape(-1, R))
+      counts = np.bincount(region, minlength=n_slice * n_slice)[:, None]
+      hist = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)  # mean of every region
+      total = np.sum(hist, axis=1, keepdims=True)
+      hist = np.divide(hist, total, out=np.zeros_like(hist), where=total > 0)
+      hist = hist.reshape(n_slice, n_slice, R)
   
     if normalize:
       hist /= np.sum(hist)
@@ -106,9 +112,8 @@ class Daisy(object):
     return hist.flatten()
   
   
-  def _daisy(self, img, normalize=True):
-    image = color.rgb2gray(img)
-    descs = daisy(image, step=step, radius=radius, rings=rings, histograms=histograms, orientations=n_orient)
+  def _daisy(self, img, normalize=True, gray=None):
+    descs, _, _ = self._daisy_field(img, gray=gray)
     descs = descs.reshape(-1, R)  # shape=(N, R)
     hist  = np.mean(descs, axis=0)  # shape=(R,)
   
@@ -118,35 +123,63 @@ class Daisy(object):
     return hist
   
   
-  def make_samples(self, db, verbose=True):
+  def _daisy_field(self, img, n_slice=1, gray=None):
+    ''' DAISY descriptors of the whole gray image
+  
+      arguments
+        n_slice   : slices along each axis in region mode, every region then holds some descriptor centers
+        gray      : color.rgb2gray(img) if already computed
+  
+      return
+        descs: a numpy array with shape (P, Q, R)
+        rows, cols: pixel coordinates of the descriptor centers
+    '''
+    image = color.rgb2gray(img) if gray is None else gray
+    d_radius, d_step = self._scaled_params(image.shape[0], image.shape[1], n_slice)
+    descs = daisy(image, step=d_step, radius=d_radius, rings=rings, histograms=histograms, orientations=n_orient)
+    rows = d_radius + d_step * np.arange(descs.shape[0])
+    cols = d_radius + d_step * np.arange(descs.shape[1])
+    return descs, rows, cols
+  
+  
+  def _scaled_params(self, height, width, n_slice=1):
+    ''' radius and step for an image, images whose slices would get no descriptor center get a smaller radius and step '''
+    if self._covers(height, radius, step, n_slice) and self._covers(width, radius, step, n_slice):
+      return radius, step
+  
+    # shrink from a radius of a quarter of the shorter side until the centers reach every slice
+    for d_radius in range(min(radius, min(height, width) // 4), 0, -1):
+      d_step = max(int(round(step * d_radius / float(radius))), 1)
+      if self._covers(height, d_radius, d_step, n_slice) and self._covers(width, d_radius, d_step, n_slice):
+        return d_radius, d_step
+    raise ValueError("input image size %dx%d is too small for daisy" % (height, width))
+  
+  
+  def _covers(self, length, d_radius, d_step, n_slice):
+    ''' whether the descriptor centers along an axis of the given length fall into all n_slice slices '''
+    n_points = int(math.ceil((length - d_radius*2) / float(d_step)))
+    if n_points < 1:
+      return False
+    centers = d_radius + d_step * np.arange(n_points)
+    slices = np.around(np.linspace(0, length, n_slice+1, endpoint=True)).astype(int)
+    regions = np.clip(np.searchsorted(slices, centers, side='right') - 1, 0, n_slice-1)
+    return len(np.unique(regions)) == n_slice
+  
+  
+  def cache_name(self):
     if h_type == 'global':
-      sample_cache = "daisy-{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type, n_orient, step, radius, rings, histograms)
+      return "daisy-{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type, n_orient, step, radius, rings, histograms)
     elif h_type == 'region':
-      sample_cache = "daisy-{}-n_slice{}-n_orient{}-step{}-radius{}-rings{}-histograms{}".format(h_type, n_slice, n_orient, step, radius, rings, histograms)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+      # '-field': regions are pooled from one whole-image descriptor field, caches of the per-region algorithm are not reused
+      return "daisy-{}-n_slice{}-n_orient{}-step{}-radius{}-rings{}-histograms{}-field".format(h_type, n_slice, n_orient, step, radius, rings, histograms)
+  
+  
+  def extract(self, img, gray=None):
+    return self.histogram(img, type=h_type, n_slice=n_slice, gray=gray)
+  
+  
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
 
 
 if __name__ == "__main__":
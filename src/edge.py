@@ -4,6 +4,7 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
 
 from six.moves import cPickle
 import numpy as np
@@ -112,14 +113,12 @@ class Edge(object):
       hist = self._conv(img, stride=stride, kernels=edge_kernels)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, edge_kernels.shape[0]))
+      # compute the edge responses once for the whole image, then pool them per region
       h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
       w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
-  
-      for hs in range(len(h_silce)-1):
-        for ws in range(len(w_slice)-1):
-          img_r = img[h_silce[hs]:h_silce[hs+1], w_slice[ws]:w_slice[ws+1]]  # slice img to regions
-          hist[hs][ws] = self._conv(img_r, stride=stride, kernels=edge_kernels)
+      responses = self._responses(img, edge_kernels)
+      hist = self._pool(responses, h_silce, w_slice, stride, edge_kernels.shape[1:])
+      hist /= np.sum(hist, axis=2, keepdims=True)  # normalize every region like _conv does
   
     if normalize:
       hist /= np.sum(hist)
@@ -129,62 +128,78 @@ class Edge(object):
   
   def _conv(self, img, stride, kernels, normalize=True):
     H, W, C = img.shape
-    conv_kernels = np.expand_dims(kernels, axis=3)
-    conv_kernels = np.tile(conv_kernels, (1, 1, 1, C))
-    assert list(conv_kernels.shape) == list(kernels.shape) + [C]  # check kernels size
+    responses = self._responses(img, kernels)
+    hist = self._pool(responses, [0, H], [0, W], stride, kernels.shape[1:])[0, 0]
   
-    sh, sw = stride
-    kn, kh, kw, kc = conv_kernels.shape
+    if normalize:
+      hist /= np.sum(hist)
   
-    hh = int((H - kh) / sh + 1)
-    ww = int((W - kw) / sw + 1)
+    return hist
   
-    hist = np.zeros(kn)
   
-    for idx, k in enumerate(conv_kernels):
-      for h in range(hh):
-        hs = int(h*sh)
-        he = int(h*sh + kh)
-        for w in range(ww):
-          ws = w*sw
-          we = w*sw + kw
-          hist[idx] += np.sum(img[hs:he, ws:we] * k)  # element-wise product
+  def _responses(self, img, kernels):
+    ''' response of every kernel at every window position (stride 1), shape (H-kh+1, W-kw+1, kn) '''
+    gray = np.sum(img, axis=2, dtype=float)  # kernels are identical across channels
+    kn, kh, kw = kernels.shape
+    H, W = gray.shape
+    hh, ww = max(H - kh + 1, 0), max(W - kw + 1, 0)
+    responses = np.zeros((hh, ww, kn))
+    for i in range(kh):
+      for j in range(kw):
+        responses += gray[i:i+hh, j:j+ww, None] * kernels[:, i, j]
+    return responses
   
-    if normalize:
-      hist /= np.sum(hist)
   
-    return hist
+  def _pool(self, responses, h_bounds, w_bounds, stride, kernel_shape):
+    ''' sum the strided responses inside every region with integral images
   
+      a region starting at (h0, w0) visits positions h0 + i*sh, w0 + j*sw, so it only reads
+      one stride phase of the response map; each phase gets its own integral image
   
-  def make_samples(self, db, verbose=True):
+      return
+        a numpy array with size len(h_bounds)-1 * len(w_bounds)-1 * kn
+    '''
+    sh, sw = stride
+    kh, kw = kernel_shape
+    h_bounds, w_bounds = np.asarray(h_bounds), np.asarray(w_bounds)
+    h0, w0 = h_bounds[:-1], w_bounds[:-1]
+    # number of windows per region, same as int((H - kh) / sh + 1) in a per-region loop
+    nh = np.maximum(((np.diff(h_bounds) - kh) / sh + 1).astype(int), 0)
+    nw = np.maximum(((np.diff(w_bounds) - kw) / sw + 1).astype(int), 0)
+  
+    sums = np.zeros((len(h0), len(w0), responses.shape[2]))
+    for ph in range(sh):
+      rows = np.where(h0 % sh == ph)[0]
+      for pw in range(sw):
+        cols = np.where(w0 % sw == pw)[0]
+        if len(rows) == 0 or len(cols) == 0:
+          continue
+        phase = responses[ph::sh, pw::sw]
+        integral = np.zeros((phase.shape[0]+1, phase.shape[1]+1, phase.shape[2]))
+        integral[1:, 1:] = phase.cumsum(axis=0).cumsum(axis=1)
+        top = np.minimum(h0[rows] // sh, phase.shape[0])
+        bottom = np.minimum(top + nh[rows], phase.shape[0])
+        left = np.minimum(w0[cols] // sw, phase.shape[1])
+        right = np.minimum(left + nw[cols], phase.shape[1])
+        sums[np.ix_(rows, cols)] = (integral[bottom][:, right] - integral[top][:, right]
+                                    - integral[bottom][:, left] + integral[top][:, left])
+    return sums
+  
+  
+  def cache_name(self):
     if h_type == 'global':
-      sample_cache = "edge-{}-stride{}".format(h_type, stride)
+      return "edge-{}-stride{}".format(h_type, stride)
     elif h_type == 'region':
-      sample_cache = "edge-{}-stride{}-n_slice{}".format(h_type, stride, n_slice)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+      return "edge-{}-stride{}-n_slice{}".format(h_type, stride, n_slice)
+  
+  
+  def extract(self, img, gray=None):
+    # edge sums the channels itself, the shared gray image is not used
+    return self.histogram(img, type=h_type, n_slice=n_slice)
+  
+  
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
 
 
 if __name__ == "__main__":
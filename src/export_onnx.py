@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import resnet
+import vggnet
+from onnx_backend import onnx_dir, model_path, info_path, backbone_network
+
+
+class AvgFeature(nn.Module):
+    """只输出avg特征：卷积部分加全局平均池化，池化用mean实现，导出后的计算图支持任意输入尺寸"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.backbone = model.backbone()
+
+    def forward(self, x):
+        return self.backbone(x).mean(dim=(2, 3))
+
+
+# 可以导出的骨干网络
+backbones = list(resnet.model_urls) + list(vggnet.model_urls)
+
+
+def _build(backbone):
+    """返回 (fp32模型, 输入尺寸, 可变的输入维度)"""
+    if backbone_network(backbone) == "resnet":
+        if resnet.pick_layer != 'avg':
+            raise ValueError("只支持导出avg特征")
+        model = resnet.ResidualNet(model=backbone)
+        # 保持原始分辨率时高宽都是可变维度
+        dynamic = {0: 'batch'} if resnet.input_size else {0: 'batch', 2: 'height', 3: 'width'}
+        return model, resnet.input_size, dynamic
+    if vggnet.pick_layer != 'avg':
+        raise ValueError("只支持导出avg特征")
+    model = vggnet.VGGNet(requires_grad=False, model=backbone, remove_fc=True)
+    return model, (224, 224), {0: 'batch'}
+
+
+def export(backbone, opset=17, verbose=True):
+    """
+    导出骨干网络的avg特征计算图到 onnx_dir，并记录模型信息
+
+    Args:
+        backbone: resnet18/34/50/101/152 或 vgg11/13/16/19
+        opset: ONNX opset 版本
+    """
+    model, size, dynamic = _build(backbone)
+    module = AvgFeature(model.eval()).eval()
+    shape = (1, 3) + tuple(size or (224, 224))
+    example = torch.from_numpy(np.zeros(shape, dtype=np.float32))
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    path = model_path(backbone)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(module, (example,), tmp,
+                          input_names=['input'], output_names=['avg'],
+                          dynamic_axes={'input': dynamic, 'avg': {0: 'batch'}},
+                          opset_version=opset)
+    os.replace(tmp, path)
+    with open(info_path(backbone), 'w', encoding='utf-8') as f:
+        json.dump({'model': backbone, 'pick_layer': 'avg', 'input_size': size, 'opset': opset}, f, indent=2)
+    if verbose:
+        print(f"{backbone} 已导出到 {path}")
+    check(backbone, module, shape[2:], verbose)
+    return path
+
+
+def check(backbone, module, size=(224, 224), verbose=True):
+    """用随机输入比较 ONNX Runtime 与 PyTorch 的输出，未安装 onnxruntime 时跳过"""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        if verbose:
+            print("未安装 onnxruntime，跳过输出校验")
+        return None
+    x = np.random.RandomState(0).rand(2, 3, *size).astype(np.float32)
+    session = ort.InferenceSession(model_path(backbone), providers=['CPUExecutionProvider'])
+    actual = session.run(None, {'input': x})[0]
+    with torch.no_grad():
+        expected = module(torch.from_numpy(x)).numpy()
+    max_diff = float(np.abs(actual - expected).max())
+    if verbose:
+        print(f"{backbone} ONNX Runtime 与 PyTorch 输出的最大误差: {max_diff:.3g}")
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出ResNet/VGG的avg特征计算图到ONNX")
+    parser.add_argument("backbones", nargs="*",
+                        help=f"{'/'.join(backbones)}，默认导出 RES_model 和 VGG_model")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+    invalid = [b for b in args.backbones if b not in backbones]
+    if invalid:
+        parser.error(f"不支持的骨干网络: {', '.join(invalid)}")
+    for backbone in args.backbones or [resnet.RES_model, vggnet.VGG_model]:
+        export(backbone, args.opset)
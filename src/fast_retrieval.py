@@ -1,11 +1,14 @@
 import numpy as np
 import faiss
-import pickle
 import hashlib
+import threading
 from collections import OrderedDict
 import time
 from typing import List, Tuple, Dict, Any
-import os
+
+from index_registry import IndexEntry, IndexRegistry
+
+feature_types = ['color', 'texture', 'shape', 'edge', 'resnet', 'vgg', 'fusion']
 
 class LRUCache:
     """LRU缓存实现"""
@@ -34,7 +37,9 @@ class FastRetrieval:
                  index_dir: str,
                  cache_size: int = 1000,
                  use_hierarchical: bool = True,
-                 filter_ratio: float = 0.1):
+                 filter_ratio: float = 0.1,
+                 registry: IndexRegistry = None,
+                 preload: bool = True):
         """
         初始化快速检索系统
         
@@ -43,61 +48,56 @@ class FastRetrieval:
             cache_size: 缓存大小
             use_hierarchical: 是否使用分层检索
             filter_ratio: 预过滤比例
+            registry: 共用的索引注册表，为空时自行创建；索引文件变化时自动重新加载
+            preload: 是否在初始化时加载索引，为 False 时在首次检索时加载
         """
         self.index_dir = index_dir
         self.cache = LRUCache(cache_size)
         self.use_hierarchical = use_hierarchical
         self.filter_ratio = filter_ratio
+        self.registry = registry or IndexRegistry(index_dir, feature_types)
+        # 检索在多个执行器线程中并发调用，缓存需要加锁
+        self._cache_lock = threading.Lock()
+        # 目标特征类型 -> (颜色索引版本, 目标索引版本, 两个索引的图片顺序是否一致)
+        # 每种特征只保留当前版本，索引重新加载后旧版本的结果被覆盖
+        self._aligned = {}
         
         # 加载索引
-        self.indices = {}
-        self.features = {}
-        self.img_paths = {}
-        self.load_indices()
-        
-        # 构建轻量级索引用于预过滤
-        if self.use_hierarchical:
-            self.build_lightweight_index()
+        if preload:
+            self.load_indices()
     
     def load_indices(self):
         """加载所有特征索引"""
-        feature_types = ['color', 'texture', 'shape', 'resnet', 'vgg', 'fusion']
-        
-        for feature_type in feature_types:
-            try:
-                # 加载特征
-                features_file = os.path.join(self.index_dir, f'features_{feature_type}.npy')
-                if os.path.exists(features_file):
-                    self.features[feature_type] = np.load(features_file)
-                
-                # 加载索引
-                index_file = os.path.join(self.index_dir, f'index_{feature_type}.faiss')
-                if os.path.exists(index_file):
-                    self.indices[feature_type] = faiss.read_index(index_file)
-                
-                # 加载图片路径
-                paths_file = os.path.join(self.index_dir, f'img_paths_{feature_type}.txt')
-                if os.path.exists(paths_file):
-                    with open(paths_file, 'r', encoding='utf-8') as f:
-                        self.img_paths[feature_type] = [line.strip() for line in f]
-                
-                print(f"加载 {feature_type} 索引，包含 {len(self.features.get(feature_type, []))} 张图片")
-                
-            except Exception as e:
-                print(f"加载 {feature_type} 索引失败: {e}")
-    
-    def build_lightweight_index(self):
-        """构建轻量级索引用于预过滤"""
-        if 'color' in self.features:
-            # 使用颜色特征作为轻量级索引
-            color_features = self.features['color']
-            self.lightweight_index = faiss.IndexFlatL2(color_features.shape[1])
-            self.lightweight_index.add(color_features.astype('float32'))
-            print(f"构建轻量级索引，维度: {color_features.shape[1]}")
+        self.registry.load_all()
     
     def compute_query_hash(self, query_feature: np.ndarray) -> str:
         """计算查询特征哈希值用于缓存"""
-        return hashlib.md5(query_feature.tobytes()).hexdigest()
+        return hashlib.md5(np.ascontiguousarray(query_feature, dtype='float32').tobytes()).hexdigest()
+    
+    def _can_prefilter(self, feature_type: str, entry: IndexEntry, k: int) -> bool:
+        """
+        是否可以用颜色索引预过滤
+        
+        只有融合特征的查询向量以颜色特征开头（见 fusion.extract_fusion_feature），
+        且颜色索引与目标索引的图片顺序一致时才能用颜色特征过滤候选集
+        """
+        if not self.use_hierarchical or feature_type != 'fusion':
+            return False
+        try:
+            color_entry = self.registry.get('color')
+        except Exception:
+            return False
+        if self._filter_k(color_entry, k) >= len(entry):
+            # 候选集覆盖整个索引时过滤没有意义
+            return False
+        cached = self._aligned.get(feature_type)
+        if cached is None or cached[:2] != (color_entry.version, entry.version):
+            cached = (color_entry.version, entry.version, color_entry.img_paths == entry.img_paths)
+            self._aligned[feature_type] = cached
+        return cached[2]
+    
+    def _filter_k(self, color_entry: IndexEntry, k: int) -> int:
+        return max(k * 10, int(len(color_entry) * self.filter_ratio))
     
     def hierarchical_search(self, 
                           query_feature: np.ndarray, 
@@ -116,49 +116,65 @@ class FastRetrieval:
             indices: 索引数组
             img_paths: 图片路径列表
         """
-        if not self.use_hierarchical or 'color' not in self.features:
+        entry = self.registry.get(feature_type)
+        if not self._can_prefilter(feature_type, entry, k):
             # 直接检索
             return self.direct_search(query_feature, feature_type, k)
         
-        # 第一步：使用颜色特征快速过滤
-        color_feature = query_feature[:self.features['color'].shape[1]]  # 假设颜色特征在前
-        filter_k = max(k * 10, int(len(self.features['color']) * self.filter_ratio))
-        
-        D_filter, I_filter = self.lightweight_index.search(
+        # 第一步：使用颜色特征快速过滤，融合特征的前几维就是颜色特征
+        color_entry = self.registry.get('color')
+        color_feature = query_feature[:color_entry.index.d]
+        _, I_filter = color_entry.index.search(
             color_feature.reshape(1, -1).astype('float32'), 
-            filter_k
+            self._filter_k(color_entry, k)
         )
+        candidates = I_filter[0][I_filter[0] >= 0]
         
-        # 第二步：在候选集中使用精确特征检索
-        if feature_type in self.features:
-            candidate_features = self.features[feature_type][I_filter[0]]
-            candidate_paths = [self.img_paths[feature_type][i] for i in I_filter[0]]
-            
-            # 计算精确相似度
-            distances = np.linalg.norm(candidate_features - query_feature, axis=1)
-            top_indices = np.argsort(distances)[:k]
-            
-            return (distances[top_indices], 
-                   I_filter[0][top_indices], 
-                   [candidate_paths[i] for i in top_indices])
-        
-        return np.array([]), np.array([]), []
+        # 第二步：在候选集中使用精确特征检索，距离与faiss一致为L2距离的平方
+        candidate_features = entry.index.reconstruct_batch(candidates)
+        diff = candidate_features - query_feature.reshape(1, -1).astype('float32')
+        distances = np.einsum('ij,ij->i', diff, diff)
+        top_indices = np.argsort(distances)[:k]
+        ids = candidates[top_indices]
+        return distances[top_indices], ids, [entry.img_paths[i] for i in ids]
     
     def direct_search(self, 
                      query_feature: np.ndarray, 
                      feature_type: str, 
                      k: int = 5) -> Tuple[np.ndarray, np.ndarray, List[str]]:
         """直接检索"""
-        if feature_type not in self.indices:
-            return np.array([]), np.array([]), []
-        
-        D, I = self.indices[feature_type].search(
-            query_feature.reshape(1, -1).astype('float32'), 
-            k
-        )
+        entry = self.registry.get(feature_type)
+        D, I = self._direct_search_batch([query_feature], entry, k)
+        return D[0], I[0], [entry.img_paths[i] for i in I[0]]
+    
+    def _direct_search_batch(self, query_features, entry: IndexEntry, k: int):
+        """一次faiss调用检索多个查询，去掉k大于索引大小时faiss填充的 -1"""
+        D, I = entry.index.search(np.vstack(query_features).astype('float32'), k)
+        valid = [ids >= 0 for ids in I]
+        return [d[v] for d, v in zip(D, valid)], [ids[v] for ids, v in zip(I, valid)]
+    
+    def _make_result(self, feature_type, entry, distances, indices, img_paths, search_time):
+        # 计算相似度分数
+        if len(distances) > 0:
+            d_min, d_max = float(np.min(distances)), float(np.max(distances))
+            if d_max > d_min:
+                scores = [1 - (float(d) - d_min) / (d_max - d_min) for d in distances]
+            else:
+                scores = [1.0 for _ in distances]
+        else:
+            scores = []
         
-        img_paths = [self.img_paths[feature_type][i] for i in I[0]]
-        return D[0], I[0], img_paths
+        return {
+            'feature_type': feature_type,
+            'distances': [float(d) for d in distances],
+            'indices': [int(i) for i in indices],
+            'img_paths': img_paths,
+            'scores': scores,
+            'search_time': search_time,
+            'cache_hit': False,
+            'total_images': len(entry),
+            'index_version': entry.version
+        }
     
     def search(self, 
               query_feature: np.ndarray, 
@@ -177,94 +193,79 @@ class FastRetrieval:
         Returns:
             检索结果字典
         """
+        return self.batch_search([query_feature], feature_type, k, use_cache)[0]
+    
+    def batch_search(self, 
+                    query_features: List[np.ndarray], 
+                    feature_type: str = 'fusion', 
+                    k: int = 5,
+                    use_cache: bool = True) -> List[Dict[str, Any]]:
+        """批量检索，缓存未命中的查询合并为一次faiss检索"""
         start_time = time.time()
+        entry = self.registry.get(feature_type)
         
-        # 计算查询哈希
-        query_hash = self.compute_query_hash(query_feature)
-        
-        # 检查缓存
+        # 检查缓存，键中包含索引版本，索引更新后旧结果自然失效
+        keys = [(feature_type, k, entry.version, self.compute_query_hash(q)) for q in query_features]
+        results = [None] * len(query_features)
         if use_cache:
-            cached_result = self.cache.get(query_hash)
-            if cached_result is not None:
-                cached_result['cache_hit'] = True
-                cached_result['search_time'] = time.time() - start_time
-                return cached_result
+            with self._cache_lock:
+                for i, key in enumerate(keys):
+                    cached_result = self.cache.get(key)
+                    if cached_result is not None:
+                        results[i] = dict(cached_result, cache_hit=True)
+        missing = [i for i, result in enumerate(results) if result is None]
         
         # 执行检索
-        if self.use_hierarchical:
-            distances, indices, img_paths = self.hierarchical_search(
-                query_feature, feature_type, k
-            )
-        else:
-            distances, indices, img_paths = self.direct_search(
-                query_feature, feature_type, k
-            )
-        
-        # 计算相似度分数
-        if len(distances) > 0:
-            d_min, d_max = float(np.min(distances)), float(np.max(distances))
-            if d_max > d_min:
-                scores = [1 - (float(d) - d_min) / (d_max - d_min) for d in distances]
+        if missing:
+            if self._can_prefilter(feature_type, entry, k):
+                searched = [self.hierarchical_search(query_features[i], feature_type, k) for i in missing]
             else:
-                scores = [1.0 for _ in distances]
-        else:
-            scores = []
-        
-        # 构建结果
-        result = {
-            'feature_type': feature_type,
-            'distances': distances.tolist() if len(distances) > 0 else [],
-            'indices': indices.tolist() if len(indices) > 0 else [],
-            'img_paths': img_paths,
-            'scores': scores,
-            'search_time': time.time() - start_time,
-            'cache_hit': False,
-            'total_images': len(self.features.get(feature_type, []))
-        }
-        
-        # 缓存结果
-        if use_cache:
-            self.cache.put(query_hash, result)
+                D, I = self._direct_search_batch([query_features[i] for i in missing], entry, k)
+                searched = [(d, ids, [entry.img_paths[j] for j in ids]) for d, ids in zip(D, I)]
+            search_time = time.time() - start_time
+            for i, (distances, indices, img_paths) in zip(missing, searched):
+                results[i] = self._make_result(feature_type, entry, distances, indices, img_paths, search_time)
+            
+            # 缓存结果
+            if use_cache:
+                with self._cache_lock:
+                    for i in missing:
+                        self.cache.put(keys[i], results[i])
         
-        return result
-    
-    def batch_search(self, 
-                    query_features: List[np.ndarray], 
-                    feature_type: str = 'fusion', 
-                    k: int = 5) -> List[Dict[str, Any]]:
-        """批量检索"""
-        results = []
-        for query_feature in query_features:
-            result = self.search(query_feature, feature_type, k)
-            results.append(result)
+        for result in results:
+            if result['cache_hit']:
+                result['search_time'] = time.time() - start_time
         return results
     
     def get_index_stats(self) -> Dict[str, Any]:
         """获取索引统计信息"""
         stats = {}
-        for feature_type, features in self.features.items():
+        for feature_type, entry in self.registry.entries.items():
             stats[feature_type] = {
-                'num_images': len(features),
-                'feature_dim': features.shape[1] if len(features) > 0 else 0,
-                'index_type': type(self.indices.get(feature_type)).__name__
+                'num_images': len(entry),
+                'feature_dim': entry.index.d,
+                'index_type': type(entry.index).__name__,
+                'version': entry.version
             }
         return stats
     
+    def cache_stats(self) -> Dict[str, Any]:
+        return {'entries': len(self.cache.cache), 'capacity': self.cache.capacity}
+    
     def optimize_index(self, feature_type: str):
         """优化索引性能"""
-        if feature_type in self.indices:
-            index = self.indices[feature_type]
-            
-            # 如果是IVF索引，训练量化器
-            if hasattr(index, 'train'):
-                features = self.features[feature_type]
-                index.train(features.astype('float32'))
-            
-            # 重建索引
-            if hasattr(index, 'make_direct_map'):
-                index.make_direct_map()
-            
-            print(f"优化 {feature_type} 索引完成")
+        index = self.registry.get(feature_type).index
+        
+        # 如果是IVF索引，训练量化器
+        if hasattr(index, 'train') and not index.is_trained:
+            features = index.reconstruct_n(0, index.ntotal)
+            index.train(features.astype('float32'))
+        
+        # 重建索引
+        if hasattr(index, 'make_direct_map'):
+            index.make_direct_map()
+        
+        print(f"优化 {feature_type} 索引完成")
 
 # 使用示例
 if __name__ == "__main__":
@@ -281,8 +282,8 @@ if __name__ == "__main__":
     print("索引统计:", stats)
     
     # 测试检索性能
-    if 'fusion' in fast_retrieval.features:
-        test_feature = fast_retrieval.features['fusion'][0]  # 使用第一张图片作为查询
+    if 'fusion' in fast_retrieval.registry.entries:
+        test_feature = fast_retrieval.registry.get('fusion').index.reconstruct(0)  # 使用第一张图片作为查询
         
         # 测试直接检索
         result_direct = fast_retrieval.search(
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+
+import numpy as np
+
+# 完整构建的断点文件：提取的特征按固定图片数写入分片，清单记录已完成的分片
+#   manifest.json                  构建配置和已完成的分片
+#   shard_00000.files.txt          分片处理过的图片（包括提取失败的），重新运行时跳过
+#   {特征}/shard_00000.npy/.txt    分片中该特征的特征矩阵和对应图片
+manifest_name = 'manifest.json'
+
+
+class ConfigMismatchError(RuntimeError):
+    """已有断点的构建配置与本次不一致"""
+
+
+class FeatureShards:
+    """
+    可断点续跑的特征分片目录
+
+    分片的所有文件写完后才更新清单（先写临时文件再替换），中断时未记录的分片在续跑时重新处理
+    """
+
+    def __init__(self, build_dir: str, feature_types: Sequence[str], config: Dict, restart: bool = False):
+        """
+        Args:
+            build_dir: 分片目录
+            feature_types: 构建的特征类型
+            config: 构建配置（推理模式、骨干网络等），续跑时必须与断点一致
+            restart: 丢弃已有断点重新开始
+
+        Raises:
+            ConfigMismatchError: 已有断点的配置与本次不一致且未指定restart
+        """
+        self.build_dir = build_dir
+        self.feature_types = list(feature_types)
+        # 经过一次JSON序列化，与从清单读出的配置可以直接比较
+        self.config = json.loads(json.dumps(dict(config, feature_types=self.feature_types)))
+        if restart:
+            self.remove()
+        self.manifest = self._read_manifest()
+        if self.manifest is None:
+            self.manifest = {'config': self.config, 'shards': []}
+        elif self.manifest['config'] != self.config:
+            raise ConfigMismatchError(f"{build_dir} 中断点的构建配置与本次不一致，请使用 --restart 重新开始")
+
+    @property
+    def manifest_file(self) -> str:
+        return os.path.join(self.build_dir, manifest_name)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_manifest(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        tmp = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.manifest_file)
+
+    def _path(self, shard_id: int, feature_type: str = None, ext: str = 'npy') -> str:
+        if feature_type is None:
+            return os.path.join(self.build_dir, f'shard_{shard_id:05d}.files.txt')
+        return os.path.join(self.build_dir, feature_type, f'shard_{shard_id:05d}.{ext}')
+
+    @property
+    def shards(self) -> List[Dict]:
+        return self.manifest['shards']
+
+    def done_files(self) -> Set[str]:
+        """已完成分片中处理过的图片"""
+        done = set()
+        for shard in self.shards:
+            done.update(_read_lines(self._path(shard['id'])))
+        return done
+
+    def write_shard(self, files: Sequence[str], features: Dict[str, Tuple[List[np.ndarray], List[str]]]):
+        """
+        写入一个分片并记录到清单
+
+        Args:
+            files: 本分片处理过的所有图片
+            features: {特征类型: (特征向量列表, 图片列表)}，只包含提取成功的图片
+        """
+        shard_id = self.shards[-1]['id'] + 1 if self.shards else 0
+        counts = {}
+        for feature_type in self.feature_types:
+            feats, paths = features.get(feature_type, ([], []))
+            os.makedirs(os.path.join(self.build_dir, feature_type), exist_ok=True)
+            if feats:
+                np.save(self._path(shard_id, feature_type), np.vstack(feats).astype('float32'))
+            _write_lines(self._path(shard_id, feature_type, 'txt'), paths)
+            counts[feature_type] = len(paths)
+        _write_lines(self._path(shard_id), files)
+        self.shards.append({'id': shard_id, 'images': len(files), 'features': counts})
+        self._write_manifest()
+
+    def count(self, feature_type: str) -> int:
+        return sum(shard['features'][feature_type] for shard in self.shards)
+
+    def iter_feature(self, feature_type: str) -> Iterator[Tuple[np.ndarray, List[str]]]:
+        """按顺序产出各分片中该特征的 (特征矩阵, 图片列表)，特征矩阵以内存映射方式读取"""
+        for shard in self.shards:
+            if not shard['features'][feature_type]:
+                continue
+            feats = np.load(self._path(shard['id'], feature_type), mmap_mode='r')
+            yield feats, _read_lines(self._path(shard['id'], feature_type, 'txt'))
+
+    def remove(self):
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+
+
+def _write_lines(path: str, lines: Sequence[str]):
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f]
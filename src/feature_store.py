@@ -0,0 +1,198 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+
+import imageio
+import numpy as np
+import pandas as pd
+from six.moves import cPickle
+from skimage import color
+
+from image_loader import iter_decoded, default_num_workers
+
+# make_samples 共用的特征存储：每张图片只解码一次、转一次灰度，分发给所有需要计算的特征
+# 结果保存在一张表中，行为图片路径，每个特征一列，列名为该特征的缓存配置名（与原来的单独缓存文件同名）
+cache_dir = 'cache'
+store_file = os.path.join(cache_dir, 'feature_store')
+
+# 每次解码并分发给各特征的图片数量，解码线程数同 CBIR_LOADER_WORKERS
+chunk_size = int(os.environ.get("CBIR_STORE_CHUNK", "64"))
+# 解码或提取失败的图片在存储中记为此标记，与尚未计算的None区分，之后不再重复计算
+# 需要重新计算时删除存储文件或其中对应的列
+failed = 'failed'
+# use_pool 为True的特征（Gabor）使用的工作进程数，默认为CPU核数
+pool_workers = int(os.environ.get("CBIR_STORE_WORKERS", str(os.cpu_count() or 1)))
+
+
+def decode(path: str) -> np.ndarray:
+    """图片路径 -> (H, W, 3) 的RGB数组，RGBA和灰度图也转为RGB"""
+    return imageio.imread(path, mode='RGB')
+
+
+def create_pool(workers: int = pool_workers) -> Optional[ProcessPoolExecutor]:
+    """use_pool 特征的进程池，workers为0时返回None，在当前进程中提取"""
+    if workers <= 0:
+        return None
+    # spawn 避免在已初始化torch/OpenMP线程的进程中fork
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _extract(extractor, imgs: List[np.ndarray], grays: List, pool: Optional[ProcessPoolExecutor] = None) -> List:
+    """
+    调用特征的 extract_batch(imgs, grays)，没有时逐张调用 extract(img, gray)
+    use_pool 为True的特征额外传入进程池；单张图片失败时结果为None
+    """
+    if getattr(extractor, 'use_pool', False):
+        return extractor.extract_batch(imgs, grays, pool=pool)
+    if hasattr(extractor, 'extract_batch'):
+        return extractor.extract_batch(imgs, grays)
+    hists = []
+    for img, gray in zip(imgs, grays):
+        try:
+            hists.append(extractor.extract(img, gray))
+        except Exception as e:
+            print(f"{extractor.cache_name()} 特征提取失败: {e}")
+            hists.append(None)
+    return hists
+
+
+def _load_legacy(name: str, store: pd.DataFrame) -> bool:
+    """把原来单独保存的缓存文件导入存储，返回是否导入"""
+    path = os.path.join(cache_dir, name)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            samples = cPickle.load(f)
+    except Exception:
+        return False
+    hists = {s['img']: s['hist'] for s in samples}
+    store[name] = pd.Series([hists.get(img) for img in store.index], index=store.index, dtype=object)
+    return True
+
+
+def load_store(path: str = store_file) -> pd.DataFrame:
+    try:
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+    except Exception:
+        return pd.DataFrame(columns=['cls'])
+
+
+def save_store(store: pd.DataFrame, path: str = store_file):
+    """先写临时文件再替换，中断时不会留下不完整的存储"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        cPickle.dump(store, f, True)
+    os.replace(tmp, path)
+
+
+def update_store(db, extractors: Sequence, verbose: bool = True, path: str = store_file) -> pd.DataFrame:
+    """
+    计算数据库中缺少的特征，每张图片只解码一次
+
+    Args:
+        db: Database
+        extractors: 特征实例，需提供 cache_name()，以及 extract(img, gray) 或 extract_batch(imgs, grays)；
+                    use_gray 为True的特征使用预先转好的灰度图
+        verbose: 打印每个特征使用缓存还是重新计算
+
+    Returns:
+        存储表，index为图片路径，'cls' 列为类别，其余每列为一个特征，失败时为 failed 标记；
+        只有计算了新的特征或导入了旧缓存时才重写存储文件
+    """
+    data = db.get_data()
+    store = load_store(path)
+    store = store[~store.index.duplicated()].reindex(data["img"])
+    changed = False
+
+    names = list(dict.fromkeys(f.cache_name() for f in extractors))
+    for name in names:
+        if name not in store.columns:
+            changed = _load_legacy(name, store) or changed
+    # 每列转为列表，缺失（包括重新索引后新增的图片）统一为None，失败标记保留
+    columns = {}
+    for name in store.columns:
+        if name != 'cls':
+            columns[name] = [v if isinstance(v, np.ndarray) or (isinstance(v, str) and v == failed) else None
+                             for v in store[name]]
+    for name in names:
+        columns.setdefault(name, [None] * len(store))
+
+    # 每个特征只计算没有结果的图片
+    todo = {}
+    for f in extractors:
+        name = f.cache_name()
+        if name in todo:
+            continue
+        missing = np.array([v is None for v in columns[name]], dtype=bool)
+        todo[name] = (f, missing)
+        if verbose:
+            if missing.any():
+                print("Counting histogram..., config=%s, images=%d" % (name, missing.sum()))
+            else:
+                print("Using cache..., config=%s" % name)
+
+    need = np.zeros(len(store), dtype=bool)
+    for _, missing in todo.values():
+        need |= missing
+    rows = np.flatnonzero(need)
+    if len(rows):
+        paths = list(store.index[rows])
+        pending = [f for f, missing in todo.values() if missing.any()]
+        use_gray = any(getattr(f, 'use_gray', False) for f in pending)
+        # 进程池只在本次计算期间存在，工作进程在各组图片之间保留各自的缓存
+        pool = create_pool() if any(getattr(f, 'use_pool', False) for f in pending) else None
+        try:
+            for idxs, imgs in iter_decoded(paths, decode, chunk_size, default_num_workers):
+                grays = [color.rgb2gray(img) for img in imgs] if use_gray else [None] * len(imgs)
+                locs = rows[idxs]
+                for name, (f, missing) in todo.items():
+                    keep = [i for i, loc in enumerate(locs) if missing[loc]]
+                    if not keep:
+                        continue
+                    hists = _extract(f, [imgs[i] for i in keep], [grays[i] for i in keep], pool)
+                    for i, hist in zip(keep, hists):
+                        columns[name][locs[i]] = hist
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        # 解码失败（不在iter_decoded的结果中）或提取失败的图片记为失败
+        for name, (f, missing) in todo.items():
+            for loc in np.flatnonzero(missing):
+                if columns[name][loc] is None:
+                    columns[name][loc] = failed
+        changed = True
+
+    store = pd.DataFrame({'cls': data["cls"].values}, index=store.index)
+    for name, values in columns.items():
+        store[name] = pd.Series(values, index=store.index, dtype=object)
+    if changed:
+        save_store(store, path)
+    return store
+
+
+def make_samples(db, extractors: Sequence, verbose: bool = True, path: str = store_file) -> List[List[dict]]:
+    """
+    一次遍历数据库计算多个特征
+
+    Returns:
+        与extractors等长的列表，每项为该特征的样本列表 [{'img', 'cls', 'hist'}]，跳过提取失败的图片
+    """
+    store = update_store(db, extractors, verbose, path)
+    imgs, classes = list(store.index), list(store['cls'])
+    results = []
+    for f in extractors:
+        samples = []
+        for img, cls, hist in zip(imgs, classes, store[f.cache_name()]):
+            if not isinstance(hist, np.ndarray):
+                continue
+            samples.append({
+                'img': img,
+                'cls': cls,
+                'hist': np.array(hist, copy=True),
+            })
+        results.append(samples)
+    return results
@@ -4,6 +4,7 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
 
 from color import Color
 from daisy import Daisy
@@ -44,14 +45,14 @@ class FeatureFusion(object):
       print("Use features {}".format(" & ".join(self.features)))
 
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
+      # every image is decoded once and shared by all the features
+      extractors = [self._get_extractor(f_class) for f_class in self.features]
+      feats = feature_store.make_samples(db, extractors, verbose=False)
       samples = self._concat_feat(db, feats)
       self.samples = samples  # cache the result
     return self.samples
 
-  def _get_feat(self, db, f_class):
+  def _get_extractor(self, f_class):
     if f_class == 'color':
       f_c = Color()
     elif f_class == 'daisy':
@@ -66,7 +67,7 @@ class FeatureFusion(object):
       f_c = VGGNetFeat()
     elif f_class == 'res':
       f_c = ResNetFeat()
-    return f_c.make_samples(db, verbose=False)
+    return f_c
 
   def _concat_feat(self, db, feats):
     samples = feats[0]
@@ -4,12 +4,15 @@ from __future__ import print_function
 
 from evaluate import *
 from DB import Database
+import feature_store
 
 from skimage.filters import gabor_kernel
 from skimage import color
 from scipy import ndimage as ndi
+from scipy import fft
 
-import multiprocessing
+import collections
+import threading
 
 from six.moves import cPickle
 import numpy as np
@@ -76,6 +79,58 @@ elif sigma and bandwidth:
 elif not sigma and not bandwidth:
   assert len(gabor_kernels) == theta * len(frequency), "kernel nums error in make_gabor_kernel()"
 
+
+def _wrap_kernel(kernel, shape):
+  ''' fold a kernel onto an image-sized torus, so that FFT convolution equals ndi.convolve(mode='wrap') '''
+  kh, kw = kernel.shape
+  rows = (np.arange(kh) - kh // 2) % shape[0]
+  cols = (np.arange(kw) - kw // 2) % shape[1]
+  wrapped = np.zeros(shape, dtype=np.complex128)
+  np.add.at(wrapped, (rows[:, None], cols[None, :]), kernel)  # kernels larger than the image alias onto it
+  return wrapped
+
+
+def iter_kernel_ffts(kernels, shape, batch):
+  ''' FFTs of a complex gabor bank for one image shape, batch kernels at a time, each chunk has shape (<=batch, H, W) '''
+  for start in range(0, len(kernels), batch):
+    yield fft.fft2(np.stack([_wrap_kernel(kernel, shape) for kernel in kernels[start:start+batch]]))
+
+
+def make_kernel_ffts(kernels, shape):
+  ''' FFTs of the whole bank for one image shape, shape (len(kernels), H, W) '''
+  batch = max(1, max_batch_pixels // (shape[0] * shape[1]))
+  return np.concatenate(list(iter_kernel_ffts(kernels, shape, batch)))
+
+
+# kernel FFTs or filtered responses kept in memory at once, bounds the batch size of the frequency domain arrays
+max_batch_pixels = 1 << 22
+# bytes of gabor_kernels FFT banks kept between images, banks of larger images are recomputed in batches every time
+kernel_cache_bytes = 256 << 20
+
+_kernel_cache = collections.OrderedDict()  # image shape -> FFTs of gabor_kernels, least recently used first
+_kernel_cache_lock = threading.Lock()
+
+
+def _cached_kernel_ffts(shape):
+  ''' FFTs of gabor_kernels for an image shape, images in a dataset usually share a few shapes
+  
+      return
+        a numpy array with shape (len(gabor_kernels), H, W), None when the bank is larger than kernel_cache_bytes
+  '''
+  nbytes = len(gabor_kernels) * shape[0] * shape[1] * np.dtype(np.complex128).itemsize
+  if nbytes > kernel_cache_bytes:
+    return None
+  with _kernel_cache_lock:
+    ffts = _kernel_cache.pop(shape, None)
+    if ffts is None:
+      ffts = make_kernel_ffts(gabor_kernels, shape)
+      cached = sum(v.nbytes for v in _kernel_cache.values())
+      while _kernel_cache and cached + nbytes > kernel_cache_bytes:
+        cached -= _kernel_cache.popitem(last=False)[1].nbytes
+    _kernel_cache[shape] = ffts
+  return ffts
+
+
 # cache dir
 cache_dir = 'cache'
 if not os.path.exists(cache_dir):
@@ -83,12 +138,14 @@ if not os.path.exists(cache_dir):
 
 
 class Gabor(object):  
+  use_gray = True  # uses the gray image shared by feature_store
+  use_pool = True  # feature_store passes its process pool to extract_batch
   
   def gabor_histogram(self, input, type=h_type, n_slice=n_slice, normalize=True):
     ''' count img histogram
   
       arguments
-        input    : a path to a image or a numpy.ndarray
+        input    : a path to a image or a numpy.ndarray, a 2-d array is taken as the gray image
         type     : 'global' means count the histogram for whole image
                    'region' means count the histogram for regions in images, then concatanate all of them
         n_slice  : work when type equals to 'region', height & width will equally sliced into N slices
@@ -96,21 +153,21 @@ class Gabor(object):
   
       return
         type == 'global'
-          a numpy array with size len(gabor_kernels)
+          a numpy array with size 2 * len(gabor_kernels)
         type == 'region'
-          a numpy array with size len(gabor_kernels) * n_slice * n_slice
+          a numpy array with size 2 * len(gabor_kernels) * n_slice * n_slice
     '''
     if isinstance(input, np.ndarray):  # examinate input type
       img = input.copy()
     else:
       img = imageio.imread(input)
-    height, width, channel = img.shape
+    height, width = img.shape[:2]
   
     if type == 'global':
       hist = self._gabor(img, kernels=gabor_kernels)
   
     elif type == 'region':
-      hist = np.zeros((n_slice, n_slice, len(gabor_kernels)))
+      hist = np.zeros((n_slice, n_slice, 2 * len(gabor_kernels)))  # mean and variance of every kernel
       h_silce = np.around(np.linspace(0, height, n_slice+1, endpoint=True)).astype(int)
       w_slice = np.around(np.linspace(0, width, n_slice+1, endpoint=True)).astype(int)
   
@@ -157,19 +214,46 @@ class Gabor(object):
     return feats
   
   
-  def _gabor(self, image, kernels=make_gabor_kernel(theta, frequency, sigma, bandwidth), normalize=True):
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+  def _power_bank(self, image, kernels=None):
+    '''
+      _power for every kernel at once: the real and imaginary responses are the two parts of
+      one complex convolution, computed as a batched product in the frequency domain;
+      kernel FFTs not held by the shape cache are computed batch by batch along with the responses
+
+      arguments
+        image  : ndarray of the gray image
+        kernels: gabor kernels, None means gabor_kernels
+      return
+        a ndarray whose shape is (len(kernels), 2)
+    '''
+    image = (image - image.mean()) / image.std()  # Normalize images for better comparison.
+    batch = max(1, max_batch_pixels // image.size)
+    kernel_ffts = None
+    if kernels is None or kernels is gabor_kernels:
+      kernels = gabor_kernels
+      kernel_ffts = _cached_kernel_ffts(image.shape)
+    if kernel_ffts is None:
+      chunks = iter_kernel_ffts(kernels, image.shape, batch)
+    else:
+      chunks = (kernel_ffts[start:start+batch] for start in range(0, len(kernels), batch))
+    f_image = fft.fft2(image)
+
+    feats = np.zeros((len(kernels), 2), dtype=np.double)
+    for start, chunk in zip(range(0, len(kernels), batch), chunks):
+      f_img = np.abs(fft.ifft2(f_image * chunk))
+      feats[start:start+batch, 0] = f_img.mean(axis=(1, 2))
+      feats[start:start+batch, 1] = f_img.var(axis=(1, 2))
+    return feats
+  
   
-    img = color.rgb2gray(image)
+  def _gabor(self, image, kernels=None, normalize=True):
+    img = color.rgb2gray(image) if image.ndim == 3 else image  # gray images are used as is
   
-    results = []
-    feat_fn = self._power
-    for kernel in kernels:
-      results.append(pool.apply_async(self._worker, (img, kernel, feat_fn)))
-    pool.close()
-    pool.join()
-    
-    hist = np.array([res.get() for res in results])
+    try:
+      hist = self._power_bank(img, kernels)
+    except Exception:
+      print("return zero")
+      hist = np.zeros((len(gabor_kernels if kernels is None else kernels), 2))
   
     if normalize:
       hist = hist / np.sum(hist, axis=0)
@@ -177,44 +261,35 @@ class Gabor(object):
     return hist.T.flatten()
   
   
-  def _worker(self, img, kernel, feat_fn):
-    try:
-      ret = feat_fn(img, kernel)
-    except:
-      print("return zero")
-      ret = np.zeros(2)
-    return ret
-  
-  
-  def make_samples(self, db, verbose=True):
+  def cache_name(self):
     if h_type == 'global':
-      sample_cache = "gabor-{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, theta, frequency, sigma, bandwidth)
+      return "gabor-{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, theta, frequency, sigma, bandwidth)
     elif h_type == 'region':
-      sample_cache = "gabor-{}-n_slice{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, n_slice, theta, frequency, sigma, bandwidth)
+      return "gabor-{}-n_slice{}-theta{}-frequency{}-sigma{}-bandwidth{}".format(h_type, n_slice, theta, frequency, sigma, bandwidth)
   
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-  
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        d_hist = self.gabor_histogram(d_img, type=h_type, n_slice=n_slice)
-        samples.append({
-                        'img':  d_img, 
-                        'cls':  d_cls, 
-                        'hist': d_hist
-                      })
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+  
+  def extract(self, img, gray=None):
+    return self.gabor_histogram(img if gray is None else gray, type=h_type, n_slice=n_slice)
+  
+  
+  def extract_batch(self, imgs, grays, pool=None):
+    ''' gabor only needs the gray image
+
+      arguments
+        pool: an executor owned by the caller (spawn context, see feature_store), None computes in this process;
+              the workers live as long as the pool, so each keeps its kernel FFT cache between batches
+    '''
+    if pool is None:
+      return [_histogram_worker(gray) for gray in grays]
+    return list(pool.map(_histogram_worker, grays, chunksize=8))
+  
+  
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
+
+
+def _histogram_worker(gray):
+  return Gabor().gabor_histogram(gray, type=h_type, n_slice=n_slice)
 
 
 if __name__ == "__main__":
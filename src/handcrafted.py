@@ -0,0 +1,48 @@
+import numpy as np
+
+# 只依赖numpy/skimage，供web服务的进程池调用，工作进程无需导入torch
+from color import Color
+from daisy import Daisy
+from edge import Edge
+from HOG import HOG
+
+handcrafted_methods = {
+    "color": lambda img: Color().histogram(img),
+    "texture": lambda img: Daisy().histogram(img),
+    "shape": lambda img: HOG().histogram(img),
+    "edge": lambda img: Edge().histogram(img),
+}
+
+def extract_handcrafted(feature_type, img):
+    """
+    提取手工特征
+    Args:
+        feature_type: color/texture/shape/edge
+        img: RGB图片数组或PIL Image
+    Returns:
+        feature: numpy array
+    """
+    return handcrafted_methods[feature_type](np.array(img))
+
+def extract_handcrafted_batch(feature_type, imgs):
+    """
+    批量提取手工特征，一个工作进程顺序处理一组图片
+    Returns:
+        与imgs等长的列表，元素为 float32 特征向量，失败时为异常对象
+    """
+    feats = []
+    for img in imgs:
+        try:
+            feats.append(np.array(extract_handcrafted(feature_type, img)).astype('float32').flatten())
+        except Exception as e:
+            # 转为普通异常，保证可以从工作进程pickle回主进程
+            feats.append(RuntimeError(str(e)))
+    return feats
+
+def extract_handcrafted_multi(feature_types, imgs):
+    """
+    对同一组图片提取多种手工特征，图片只需传给工作进程一次
+    Returns:
+        {特征类型: extract_handcrafted_batch 的结果}
+    """
+    return {feature_type: extract_handcrafted_batch(feature_type, imgs) for feature_type in feature_types}
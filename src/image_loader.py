@@ -0,0 +1,181 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+# 深度特征批量推理的默认配置
+default_batch_size = int(os.environ.get("CBIR_BATCH_SIZE", "16"))
+default_num_workers = int(os.environ.get("CBIR_LOADER_WORKERS", "4"))
+
+# ResNet/VGG输入的通道均值（BGR顺序），预处理不依赖torch，ONNX Runtime后端也使用
+means = np.array([103.939, 116.779, 123.68]) / 255.
+
+
+def load_image(item) -> Image.Image:
+    """图片路径或PIL Image -> RGB的PIL Image，GIF取第一帧"""
+    if isinstance(item, Image.Image):
+        img = item
+    else:
+        img = Image.open(item)
+        if img.format == 'GIF':
+            img.seek(0)
+    return img.convert('RGB')
+
+
+def preprocess_resnet(img: Image.Image) -> np.ndarray:
+    """PIL Image -> (3, H, W) 的BGR去均值数组"""
+    img_array = np.array(img)
+    img_array = img_array[:, :, ::-1]  # RGB to BGR
+    img_array = np.transpose(img_array, (2, 0, 1)) / 255.
+    img_array[0] -= means[0]  # reduce B's mean
+    img_array[1] -= means[1]  # reduce G's mean
+    img_array[2] -= means[2]  # reduce R's mean
+    return img_array.astype(np.float32)
+
+
+def preprocess_vgg(img: Image.Image) -> np.ndarray:
+    """PIL Image -> (3, 224, 224) 的BGR去均值数组，与 torchvision 的 Resize + ToTensor 结果相同"""
+    img = img.resize((224, 224), Image.BILINEAR)
+    img_array = np.asarray(img, dtype=np.float32).transpose(2, 0, 1)[::-1] / np.float32(255)  # RGB to BGR
+    return img_array - means.astype(np.float32)[:, None, None]
+
+
+def _load(item, preprocess: Callable, size: Optional[Tuple[int, int]]):
+    img = load_image(item)
+    if size is not None and img.size != (size[1], size[0]):
+        img = img.resize((size[1], size[0]), Image.BILINEAR)
+    return preprocess(img)
+
+
+def iter_batches(items: Sequence,
+                 preprocess: Callable,
+                 batch_size: int = default_batch_size,
+                 num_workers: int = default_num_workers,
+                 size: Optional[Tuple[int, int]] = None,
+                 prefetch: int = 2) -> Iterator[Tuple[List[int], np.ndarray]]:
+    """
+    在工作线程中解码和预处理图片，按批次产出可直接堆叠的数组
+
+    Args:
+        items: 图片路径或PIL Image列表
+        preprocess: PIL Image -> (C, H, W) 数组的预处理函数
+        batch_size: 每批图片数量
+        num_workers: 解码线程数，为0或只有一张图片时在当前线程中处理
+        size: (H, W)，指定时先缩放到固定尺寸，所有图片可以合并为一批；
+              为None时保持原始分辨率，只把尺寸相同的图片合并为一批
+        prefetch: 预先提交的批次数量，限制内存中等待推理的图片数
+
+    Yields:
+        (idxs, batch): 图片在items中的下标列表和堆叠后的数组 (N, C, H, W)；
+        解码失败的图片打印错误后跳过
+    """
+    buckets = {}
+    max_buffered = batch_size * max(prefetch, 1) * 2
+
+    def add(idx, arr):
+        # 按尺寸分桶，桶满时产出一批；尺寸各异时缓存的图片过多则先产出最大的桶
+        bucket = buckets.setdefault(arr.shape, [])
+        bucket.append((idx, arr))
+        if len(bucket) < batch_size and sum(len(b) for b in buckets.values()) < max_buffered:
+            return None
+        shape = arr.shape if len(bucket) >= batch_size else max(buckets, key=lambda k: len(buckets[k]))
+        return buckets.pop(shape)
+
+    def flush(bucket):
+        return [idx for idx, _ in bucket], np.stack([arr for _, arr in bucket])
+
+    def loaded():
+        if num_workers <= 0 or len(items) <= 1:
+            for idx, item in enumerate(items):
+                try:
+                    yield idx, _load(item, preprocess, size)
+                except Exception as e:
+                    print(f"图片加载失败: {item}, 错误: {e}")
+            return
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='cbir-loader') as executor:
+            pending = deque()
+            item_iter = iter(enumerate(items))
+
+            def submit():
+                for idx, item in item_iter:
+                    pending.append((idx, item, executor.submit(_load, item, preprocess, size)))
+                    return
+
+            for _ in range(batch_size * prefetch):
+                submit()
+            while pending:
+                idx, item, future = pending.popleft()
+                submit()
+                try:
+                    yield idx, future.result()
+                except Exception as e:
+                    print(f"图片加载失败: {item}, 错误: {e}")
+
+    for idx, arr in loaded():
+        bucket = add(idx, arr)
+        if bucket is not None:
+            yield flush(bucket)
+    for bucket in buckets.values():
+        yield flush(bucket)
+
+
+def iter_decoded(items: Sequence,
+                 load: Callable = load_image,
+                 chunk_size: int = default_batch_size,
+                 num_workers: int = default_num_workers,
+                 prefetch: int = 2) -> Iterator[Tuple[List[int], List]]:
+    """
+    在工作线程中按原顺序解码图片，每次产出一组，不做预处理
+
+    Args:
+        items: 图片路径列表
+        load: 图片路径 -> 解码结果，默认为RGB的PIL Image
+        chunk_size: 每组图片数量
+        num_workers: 解码线程数，为0时在当前线程中处理
+        prefetch: 预先解码的组数，限制内存中的图片数
+
+    Yields:
+        (idxs, imgs): 图片在items中的下标列表和解码结果；解码失败的图片打印错误后跳过
+    """
+    def decode(idx):
+        try:
+            return load(items[idx])
+        except Exception as e:
+            print(f"图片加载失败: {items[idx]}, 错误: {e}")
+            return None
+
+    def decoded():
+        if num_workers <= 0:
+            for idx in range(len(items)):
+                yield idx, decode(idx)
+            return
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='cbir-decoder') as executor:
+            pending = deque()
+            idx_iter = iter(range(len(items)))
+
+            def submit():
+                for idx in idx_iter:
+                    pending.append((idx, executor.submit(decode, idx)))
+                    return
+
+            for _ in range(chunk_size * max(prefetch, 1)):
+                submit()
+            while pending:
+                idx, future = pending.popleft()
+                submit()
+                yield idx, future.result()
+
+    idxs, imgs = [], []
+    for idx, img in decoded():
+        if img is None:
+            continue
+        idxs.append(idx)
+        imgs.append(img)
+        if len(imgs) >= chunk_size:
+            yield idxs, imgs
+            idxs, imgs = [], []
+    if imgs:
+        yield idxs, imgs
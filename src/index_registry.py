@@ -0,0 +1,215 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+import index_segments
+
+
+def signature_version(signature: Tuple) -> str:
+    """由文件签名派生索引版本号，文件变化后版本号随之变化"""
+    return hashlib.md5(repr(signature).encode()).hexdigest()[:12]
+
+
+# 使用深度模型的特征类型，这些索引的元数据中记录推理模式和骨干网络
+deep_feature_types = ("resnet", "vgg", "fusion")
+# 各深度特征用到的网络，融合特征包含ResNet和VGG两个分量
+feature_networks = {"resnet": ("resnet",), "vgg": ("vgg",), "fusion": ("resnet", "vgg")}
+# 融合特征由以下分量按顺序拼接而成，与 fusion.extract_fusion_feature 一致
+fusion_components = ("color", "texture", "shape", "resnet", "vgg")
+# 没有元数据的旧索引都是用默认配置构建的
+legacy_backbones = {
+    "resnet": {"model": "resnet152", "layer": "avg"},
+    "vgg": {"model": "vgg19", "layer": "avg"},
+}
+
+
+def meta_file(index_dir: str, feature_type: str) -> str:
+    return os.path.join(index_dir, f'index_meta_{feature_type}.json')
+
+
+def read_index_meta(index_dir: str, feature_type: str) -> Dict:
+    """读取索引元数据，旧版本构建的索引没有元数据时返回空字典"""
+    try:
+        with open(meta_file(index_dir, feature_type), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_index_meta(index_dir: str, feature_type: str, meta: Dict):
+    """写入索引元数据（构建时的推理模式等），先写临时文件再替换"""
+    path = meta_file(index_dir, feature_type)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def index_backbones(meta: Dict, feature_type: str) -> Dict[str, Dict]:
+    """索引元数据中记录的骨干网络和特征层 {网络: {"model", "layer"}}，旧索引按默认配置处理"""
+    backbones = meta.get('backbones', {})
+    return {network: backbones.get(network, legacy_backbones[network])
+            for network in feature_networks.get(feature_type, ())}
+
+
+class IndexEntry:
+    """单个特征类型的常驻索引"""
+    def __init__(self, feature_type: str, index, img_paths: List[str], signature: Tuple, meta: Optional[Dict] = None,
+                 segments: Optional[List[int]] = None):
+        self.feature_type = feature_type
+        self.index = index
+        self.img_paths = img_paths
+        self.signature = signature
+        self.meta = meta or {}
+        # 段格式索引已加载的段编号，旧格式索引为None
+        self.segments = segments
+        self.version = signature_version(signature)
+
+    def __len__(self):
+        return len(self.img_paths)
+
+
+class IndexRegistry:
+    """进程级索引注册表：启动时加载一次，文件变化时才重新加载"""
+
+    def __init__(self, index_dir: str, feature_types: List[str]):
+        """
+        初始化索引注册表
+
+        Args:
+            index_dir: 索引文件目录
+            feature_types: 需要管理的特征类型列表
+        """
+        self.index_dir = index_dir
+        self.feature_types = list(feature_types)
+        self.entries: Dict[str, IndexEntry] = {}
+        self._lock = threading.Lock()
+
+    def _files(self, feature_type: str) -> Tuple[str, ...]:
+        """签名依据的文件：段格式为段清单，旧格式为FAISS索引和路径列表"""
+        manifest = index_segments.manifest_file(self.index_dir, feature_type)
+        if os.path.exists(manifest):
+            return (manifest,)
+        index_file = os.path.join(self.index_dir, f'index_{feature_type}.faiss')
+        paths_file = os.path.join(self.index_dir, f'img_paths_{feature_type}.txt')
+        return index_file, paths_file
+
+    def _signature(self, feature_type: str) -> Optional[Tuple]:
+        """根据文件的 mtime 和 size 计算签名，索引文件缺失时返回 None；元数据文件可以缺失"""
+        signature = []
+        for path in self._files(feature_type):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            signature.append((st.st_mtime_ns, st.st_size))
+        try:
+            st = os.stat(meta_file(self.index_dir, feature_type))
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+        return tuple(signature)
+
+    def _load_segments(self, feature_type: str, manifest: Dict, previous: Optional[IndexEntry]):
+        """
+        由各段的特征构建索引；已加载的段是新清单的前缀时（只追加了新段）复制旧索引，只添加新段
+        """
+        segments = manifest['segments']
+        if not segments:
+            raise RuntimeError(f"{feature_type} 索引没有任何段")
+        ids = [segment['id'] for segment in segments]
+        if previous is not None and previous.segments and ids[:len(previous.segments)] == previous.segments:
+            index = faiss.clone_index(previous.index)
+            img_paths = list(previous.img_paths)
+            segments = segments[len(previous.segments):]
+        else:
+            index = faiss.IndexFlatL2(segments[0]['dim'])
+            img_paths = []
+        for segment in segments:
+            features, paths = index_segments.read_segment(self.index_dir, feature_type, segment['id'])
+            index.add(np.ascontiguousarray(features, dtype='float32'))
+            img_paths.extend(paths)
+        return index, img_paths, ids
+
+    def _load(self, feature_type: str, signature: Tuple, previous: Optional[IndexEntry] = None) -> IndexEntry:
+        manifest = index_segments.read_manifest(self.index_dir, feature_type)
+        segments = None
+        if manifest is not None:
+            stale = [f for f in index_segments.legacy_files(self.index_dir, feature_type) if os.path.exists(f)]
+            if stale:
+                # 构建脚本转换或重建后会删除旧格式文件，仍然存在说明是从别处复制或检出的过期文件
+                print(f"警告：{feature_type} 已使用段格式索引，忽略过期的旧格式文件: {', '.join(map(os.path.basename, stale))}")
+            index, img_paths, segments = self._load_segments(feature_type, manifest, previous)
+        else:
+            index_file, paths_file = self._files(feature_type)
+            index = faiss.read_index(index_file)
+            with open(paths_file, 'r', encoding='utf-8') as f:
+                img_paths = [line.strip() for line in f]
+        if index.ntotal != len(img_paths):
+            # 构建脚本可能正在写入文件，保留旧索引等待下次检查
+            raise RuntimeError(f"{feature_type} 索引与路径数量不一致: {index.ntotal} != {len(img_paths)}")
+        meta = read_index_meta(self.index_dir, feature_type)
+        print(f"加载 {feature_type} 索引，包含 {len(img_paths)} 张图片")
+        return IndexEntry(feature_type, index, img_paths, signature, meta, segments)
+
+    def get(self, feature_type: str) -> IndexEntry:
+        """
+        获取特征类型对应的索引，文件发生变化时自动重新加载
+
+        Args:
+            feature_type: 特征类型
+
+        Returns:
+            IndexEntry 实例
+        """
+        signature = self._signature(feature_type)
+        if signature is None:
+            raise FileNotFoundError(f"{feature_type} 索引文件不存在，请先构建索引")
+
+        entry = self.entries.get(feature_type)
+        if entry is not None and entry.signature == signature:
+            return entry
+
+        with self._lock:
+            # 可能已被其他线程重新加载
+            entry = self.entries.get(feature_type)
+            if entry is None or entry.signature != signature:
+                try:
+                    entry = self._load(feature_type, signature, entry)
+                except Exception:
+                    if entry is None:
+                        raise
+                    print(f"重新加载 {feature_type} 索引失败，继续使用旧版本")
+                    return entry
+                self.entries[feature_type] = entry
+        return entry
+
+    def current_version(self, feature_type: str) -> Optional[str]:
+        """只检查文件签名得到当前版本号，不加载索引；文件缺失时返回 None"""
+        signature = self._signature(feature_type)
+        return signature_version(signature) if signature is not None else None
+
+    def load_all(self):
+        """加载所有特征索引，缺失或损坏的索引只打印提示"""
+        for feature_type in self.feature_types:
+            try:
+                self.get(feature_type)
+            except Exception as e:
+                print(f"加载 {feature_type} 索引失败: {e}")
+
+    def stats(self) -> Dict[str, Dict]:
+        """获取已加载索引的统计信息"""
+        return {
+            feature_type: {
+                'num_images': len(entry),
+                'version': entry.version,
+                'inference_mode': entry.meta.get('inference_mode'),
+                'backbones': index_backbones(entry.meta, feature_type),
+            }
+            for feature_type, entry in self.entries.items()
+        }
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import sys
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 追加式索引存储：每种特征的特征矩阵分成多个只读的段，清单记录当前有效的段及顺序
+#   segments_{特征}.json                   清单，写入新段或合并后整体替换
+#   segments/{特征}/seg_000000.npy/.txt    段的特征矩阵（float32）和对应图片，写入后不再修改
+# 增量构建只写入新图片组成的新段，小段由合并任务在后台合并为大段
+# FAISS索引在加载时由各段的特征构建，不单独保存
+
+# 行数少于此值的段视为小段，小段数量达到 merge_factor 时合并相邻的小段
+merge_min_rows = int(os.environ.get("CBIR_SEGMENT_MERGE_ROWS", "10000"))
+merge_factor = int(os.environ.get("CBIR_SEGMENT_MERGE_FACTOR", "8"))
+
+# 同一进程中增量写入和合并对清单的修改互斥
+_lock = threading.Lock()
+
+
+def manifest_file(index_dir: str, feature_type: str) -> str:
+    return os.path.join(index_dir, f'segments_{feature_type}.json')
+
+
+def segment_dir(index_dir: str, feature_type: str) -> str:
+    return os.path.join(index_dir, 'segments', feature_type)
+
+
+def segment_files(index_dir: str, feature_type: str, segment_id: int) -> Tuple[str, str]:
+    """段的特征文件和路径列表"""
+    base = os.path.join(segment_dir(index_dir, feature_type), f'seg_{segment_id:06d}')
+    return f'{base}.npy', f'{base}.txt'
+
+
+def legacy_files(index_dir: str, feature_type: str) -> Tuple[str, str, str]:
+    """旧格式整体保存的特征文件、路径列表和FAISS索引"""
+    return (os.path.join(index_dir, f'features_{feature_type}.npy'),
+            os.path.join(index_dir, f'img_paths_{feature_type}.txt'),
+            os.path.join(index_dir, f'index_{feature_type}.faiss'))
+
+
+def read_manifest(index_dir: str, feature_type: str) -> Optional[Dict]:
+    """读取段清单，没有段格式的索引时返回None"""
+    try:
+        with open(manifest_file(index_dir, feature_type), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_manifest(index_dir: str, feature_type: str, manifest: Dict):
+    path = manifest_file(index_dir, feature_type)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def has_index(index_dir: str, feature_type: str) -> bool:
+    return (read_manifest(index_dir, feature_type) is not None
+            or all(os.path.exists(f) for f in legacy_files(index_dir, feature_type)))
+
+
+def _write_segment(index_dir: str, feature_type: str, segment_id: int,
+                   features: np.ndarray, img_paths: Sequence[str]) -> Dict:
+    """写入一个段，文件写完后才改名为正式文件名"""
+    os.makedirs(segment_dir(index_dir, feature_type), exist_ok=True)
+    features_file, paths_file = segment_files(index_dir, feature_type, segment_id)
+    for path, write in ((features_file, lambda f: np.save(f, features)),
+                        (paths_file, lambda f: f.write(''.join(p + '\n' for p in img_paths).encode('utf-8')))):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    return {'id': segment_id, 'rows': int(features.shape[0]), 'dim': int(features.shape[1])}
+
+
+def _remove_segment(index_dir: str, feature_type: str, segment_id: int):
+    for path in segment_files(index_dir, feature_type, segment_id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def read_segment(index_dir: str, feature_type: str, segment_id: int) -> Tuple[np.ndarray, List[str]]:
+    """读取一个段，特征矩阵以内存映射方式读取"""
+    features_file, paths_file = segment_files(index_dir, feature_type, segment_id)
+    features = np.load(features_file, mmap_mode='r')
+    with open(paths_file, 'r', encoding='utf-8') as f:
+        img_paths = [line.rstrip('\n') for line in f]
+    return features, img_paths
+
+
+def iter_segments(index_dir: str, feature_type: str,
+                  manifest: Optional[Dict] = None) -> Iterator[Tuple[Dict, np.ndarray, List[str]]]:
+    """按清单顺序产出 (段信息, 特征矩阵, 图片列表)"""
+    manifest = manifest or read_manifest(index_dir, feature_type) or {'segments': []}
+    for segment in manifest['segments']:
+        features, img_paths = read_segment(index_dir, feature_type, segment['id'])
+        yield segment, features, img_paths
+
+
+def migrate_legacy(index_dir: str, feature_type: str) -> Optional[Dict]:
+    """
+    把旧格式的索引转换为一个段，在第一次增量写入或手动转换（--migrate）时执行
+    没有特征文件时从FAISS索引中取回特征
+
+    Returns:
+        转换后的清单，没有旧格式索引时返回None
+    """
+    features_file, paths_file, index_file = legacy_files(index_dir, feature_type)
+    if not os.path.exists(paths_file):
+        return None
+    if os.path.exists(features_file):
+        features = np.load(features_file, mmap_mode='r')
+    elif os.path.exists(index_file):
+        import faiss
+        index = faiss.read_index(index_file)
+        features = index.reconstruct_n(0, index.ntotal)
+    else:
+        return None
+    with open(paths_file, 'r', encoding='utf-8') as f:
+        img_paths = [line.strip() for line in f]
+    segment = _write_segment(index_dir, feature_type, 0, np.asarray(features, dtype='float32'), img_paths)
+    manifest = {'segments': [segment], 'next_id': 1}
+    _write_manifest(index_dir, feature_type, manifest)
+    for path in (features_file, paths_file, index_file):
+        if os.path.exists(path):
+            os.remove(path)
+    print(f"{feature_type} 索引已转换为段格式，包含 {segment['rows']} 张图片")
+    return manifest
+
+
+def append_segment(index_dir: str, feature_type: str, features: np.ndarray, img_paths: Sequence[str]) -> Dict:
+    """
+    把新图片的特征写为一个新段，写入量只与新图片数量有关
+
+    Returns:
+        更新后的清单
+
+    Raises:
+        ValueError: 特征维度与现有的段不一致
+    """
+    features = np.ascontiguousarray(features, dtype='float32')
+    with _lock:
+        manifest = read_manifest(index_dir, feature_type) or migrate_legacy(index_dir, feature_type) \
+            or {'segments': [], 'next_id': 0}
+        if manifest['segments'] and manifest['segments'][0]['dim'] != features.shape[1]:
+            raise ValueError(f"{feature_type} 新特征维度 {features.shape[1]} 与现有索引维度 "
+                             f"{manifest['segments'][0]['dim']} 不一致，请用 build_full_index.py 重建")
+        segment = _write_segment(index_dir, feature_type, manifest['next_id'], features, img_paths)
+        manifest = {'segments': manifest['segments'] + [segment], 'next_id': manifest['next_id'] + 1}
+        _write_manifest(index_dir, feature_type, manifest)
+    return manifest
+
+
+def replace_segments(index_dir: str, feature_type: str,
+                     blocks: Iterable[Tuple[np.ndarray, Sequence[str]]]) -> Dict:
+    """
+    用一组新的段替换整个索引（完整构建），旧的段和旧格式文件在新清单生效后删除
+
+    Args:
+        blocks: (特征矩阵, 图片列表) 序列，每项写为一个段
+    """
+    with _lock:
+        old = read_manifest(index_dir, feature_type) or {'segments': [], 'next_id': 0}
+        next_id = old['next_id']
+        segments = []
+        for features, img_paths in blocks:
+            segments.append(_write_segment(index_dir, feature_type, next_id,
+                                           np.ascontiguousarray(features, dtype='float32'), img_paths))
+            next_id += 1
+        manifest = {'segments': segments, 'next_id': next_id}
+        _write_manifest(index_dir, feature_type, manifest)
+    for segment in old['segments']:
+        _remove_segment(index_dir, feature_type, segment['id'])
+    for path in legacy_files(index_dir, feature_type):
+        if os.path.exists(path):
+            os.remove(path)
+    return manifest
+
+
+def _merge_runs(segments: List[Dict], min_rows: int) -> List[Tuple[int, int]]:
+    """相邻小段组成的区间 [start, end)，只保留至少包含两个段的区间"""
+    runs, start = [], None
+    for i, segment in enumerate(segments + [None]):
+        small = segment is not None and segment['rows'] < min_rows
+        if small and start is None:
+            start = i
+        elif not small and start is not None:
+            if i - start > 1:
+                runs.append((start, i))
+            start = None
+    return runs
+
+
+def compact(index_dir: str, feature_type: str, min_rows: int = merge_min_rows,
+            factor: int = merge_factor, force: bool = False) -> bool:
+    """
+    合并相邻的小段，保持图片顺序不变
+
+    合并结果写为新段，替换清单后再删除被合并的段；合并期间新追加的段不受影响
+
+    Args:
+        min_rows: 行数少于此值的段视为小段
+        factor: 小段数量达到此值时才合并
+        force: 忽略 factor，只要有相邻的小段就合并
+
+    Returns:
+        是否进行了合并
+    """
+    manifest = read_manifest(index_dir, feature_type)
+    if manifest is None:
+        return False
+    segments = manifest['segments']
+    if not force and sum(s['rows'] < min_rows for s in segments) < factor:
+        return False
+    runs = _merge_runs(segments, min_rows)
+    if not runs:
+        return False
+
+    with _lock:
+        # 预留合并结果的段编号，合并期间追加的新段使用后面的编号
+        current = read_manifest(index_dir, feature_type)
+        next_id = current['next_id']
+        _write_manifest(index_dir, feature_type, dict(current, next_id=next_id + len(runs)))
+    merged = {}
+    for n, (start, end) in enumerate(runs):
+        parts = [read_segment(index_dir, feature_type, s['id']) for s in segments[start:end]]
+        features = np.concatenate([np.asarray(f) for f, _ in parts])
+        img_paths = [p for _, paths in parts for p in paths]
+        merged[segments[start]['id']] = (_write_segment(index_dir, feature_type, next_id + n, features, img_paths),
+                                         [s['id'] for s in segments[start:end]])
+
+    with _lock:
+        current = read_manifest(index_dir, feature_type)
+        ids = [s['id'] for s in current['segments']]
+        result, removed, i = [], [], 0
+        while i < len(current['segments']):
+            segment = current['segments'][i]
+            if segment['id'] in merged:
+                new_segment, replaced = merged[segment['id']]
+                if ids[i:i + len(replaced)] == replaced:
+                    result.append(new_segment)
+                    removed.extend(replaced)
+                    i += len(replaced)
+                    continue
+            result.append(segment)
+            i += 1
+        _write_manifest(index_dir, feature_type, dict(current, segments=result))
+    # 没有生效的合并结果（被合并的段已被替换）直接删除
+    used = {s['id'] for s in result}
+    for new_segment, _ in merged.values():
+        if new_segment['id'] not in used:
+            _remove_segment(index_dir, feature_type, new_segment['id'])
+    for segment_id in removed:
+        _remove_segment(index_dir, feature_type, segment_id)
+    print(f"{feature_type} 合并了 {len(removed)} 个小段，现有 {len(result)} 个段")
+    return bool(removed)
+
+
+def start_compaction(index_dir: str, feature_type: str) -> threading.Thread:
+    """在后台线程中合并小段，返回线程以便退出前等待"""
+    def run():
+        try:
+            compact(index_dir, feature_type)
+        except Exception as e:
+            print(f"合并 {feature_type} 索引的段失败: {e}")
+
+    thread = threading.Thread(target=run, name=f'cbir-compact-{feature_type}')
+    thread.start()
+    return thread
+
+
+def _list_features(index_dir: str, prefix: str, suffix: str) -> List[str]:
+    return sorted(f[len(prefix):-len(suffix)] for f in os.listdir(index_dir) if f.startswith(prefix) and f.endswith(suffix))
+
+
+if __name__ == "__main__":
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="合并索引中相邻的小段，或把旧格式的索引转换为段格式")
+    parser.add_argument("features", nargs="*", help="特征类型，默认处理目录中所有的索引")
+    parser.add_argument("--index-dir", default=os.path.join(BASE_DIR, "..", "faiss_index"))
+    parser.add_argument("--min-rows", type=int, default=merge_min_rows, help="行数少于此值的段视为小段")
+    parser.add_argument("--force", action="store_true", help="只要有相邻的小段就合并")
+    parser.add_argument("--migrate", action="store_true",
+                        help="把旧格式的 features/img_paths/index 文件转换为段格式并删除旧文件")
+    args = parser.parse_args()
+    if args.migrate:
+        for feature_type in args.features or _list_features(args.index_dir, 'img_paths_', '.txt'):
+            if read_manifest(args.index_dir, feature_type) is not None:
+                print(f"{feature_type} 已是段格式，旧格式文件已过期，可以直接删除")
+            elif migrate_legacy(args.index_dir, feature_type) is None:
+                print(f"{feature_type} 没有旧格式的索引")
+        sys.exit(0)
+    for feature_type in args.features or _list_features(args.index_dir, 'segments_', '.json'):
+        if not compact(args.index_dir, feature_type, args.min_rows, force=args.force):
+            print(f"{feature_type} 没有需要合并的段")
@@ -0,0 +1,233 @@
+import argparse
+import os
+import sys
+import warnings
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from image_loader import iter_batches, load_image
+from index_registry import deep_feature_types, feature_networks
+import onnx_backend
+
+# CPU推理模式，索引构建脚本和Web服务共用，构建时使用的模式记录在索引元数据中
+#   fp32:          eager 前向（默认）
+#   channels_last: NHWC 内存布局，oneDNN 卷积更快
+#   bf16:          bfloat16 autocast，CPU不支持AVX512-BF16/AMX时回退为fp32
+#   jit:           TorchScript trace 后 freeze，折叠BN并消除Python开销
+#   compile:       torch.compile，首次前向时编译
+#   int8_static:   卷积部分静态量化，用数据集样本校准
+# 全连接层动态量化不在其中：avg特征不经过全连接层，量化后的结果与fp32相同，并不是一种加速模式
+inference_modes = ('fp32', 'channels_last', 'bf16', 'jit', 'compile', 'int8_static')
+inference_mode = os.environ.get("CBIR_INFERENCE_MODE", "fp32")
+calibration_size = int(os.environ.get("CBIR_CALIBRATION_SIZE", "32"))
+
+# 校验加速模式时允许的误差：特征余弦相似度下限，以及样本内 top-k 检索结果与fp32的重合率下限
+min_cosine = 0.99
+min_topk_overlap = 0.9
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+dataset_dir = os.path.join(BASE_DIR, "..", "dataset")
+
+
+def bf16_supported() -> bool:
+    """CPU是否原生支持bfloat16计算，不支持时autocast会慢于fp32"""
+    check = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+    return bool(check is not None and check())
+
+
+def resolve_mode(mode: Optional[str] = None) -> str:
+    """
+    检查推理模式，返回当前环境实际使用的模式
+
+    GPU上只使用fp32；CPU不支持bf16时回退为fp32，回退提示每个进程只显示一次
+    """
+    mode = mode or inference_mode
+    if mode not in inference_modes:
+        raise ValueError(f"不支持的推理模式: {mode}，可选 {', '.join(inference_modes)}")
+    if mode != 'fp32' and torch.cuda.is_available():
+        warnings.warn(f"推理模式 {mode} 只用于CPU，GPU上使用fp32", RuntimeWarning)
+        return 'fp32'
+    if mode == 'bf16' and not bf16_supported():
+        warnings.warn("CPU不支持bfloat16，推理模式回退为fp32", RuntimeWarning)
+        return 'fp32'
+    return mode
+
+
+def index_meta(feature_type: str, backbones: Dict[str, Dict]) -> Dict:
+    """
+    索引元数据，深度特征记录构建时的推理模式、骨干网络和特征层
+
+    ONNX Runtime 执行的是fp32计算图，与torch的fp32模式通用
+
+    Args:
+        backbones: {网络: {"model", "layer"}}，构建时使用的骨干网络
+    """
+    if feature_type not in deep_feature_types:
+        return {'feature_type': feature_type, 'inference_mode': None}
+    backend = onnx_backend.deep_backend
+    return {
+        'feature_type': feature_type,
+        'inference_mode': 'fp32' if backend == 'onnx' else resolve_mode(),
+        'backend': backend,
+        'backbones': {network: backbones[network] for network in feature_networks[feature_type]},
+    }
+
+
+def calibration_images(n: int = calibration_size, directory: str = dataset_dir) -> List[str]:
+    """按文件名排序后等间隔抽取n张图片作为校准和校验样本，结果可复现"""
+    fnames = sorted(f for f in os.listdir(directory)
+                    if f.lower().endswith(('.jpg', '.png', '.jpeg', '.gif')))
+    step = max(len(fnames) // max(n, 1), 1)
+    return [os.path.join(directory, f) for f in fnames[::step][:n]]
+
+
+def calibration_batches(preprocess: Callable, size=None, n: int = calibration_size) -> Iterator[torch.Tensor]:
+    """用数据集样本生成校准输入，预处理与特征提取时相同"""
+    for _, batch in iter_batches(calibration_images(n), preprocess, size=size):
+        yield torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32))
+
+
+def _quantize_static(backbone: nn.Module, calibration: Optional[Callable]) -> nn.Module:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    batches = list(calibration()) if calibration is not None else []
+    if not batches:
+        raise RuntimeError("int8_static 需要校准数据，请检查数据集目录")
+    engines = torch.backends.quantized.supported_engines
+    engine = next(e for e in ('x86', 'fbgemm', 'qnnpack') if e in engines)
+    torch.backends.quantized.engine = engine
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(engine), (batches[0],))
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+class InferenceModel:
+    """
+    按推理模式包装 ResidualNet/VGGNet
+
+    只对卷积部分 model.backbone() 做加速，池化和输出层 model.heads() 仍用fp32计算，
+    因此任意输入尺寸都可以使用，调用方式与原模型相同：model(x)[pick_layer]
+    """
+
+    def __init__(self, model: nn.Module, mode: str = 'fp32', calibration: Optional[Callable] = None):
+        """
+        Args:
+            model: eval 模式下的 ResidualNet 或 VGGNet
+            mode: inference_modes 之一，应先经过 resolve_mode
+            calibration: int8_static 使用，返回校准输入张量序列的函数
+        """
+        self.model = model
+        self.mode = mode
+        backbone = model.backbone().eval()
+        if mode == 'channels_last':
+            backbone = backbone.to(memory_format=torch.channels_last)
+        elif mode == 'jit':
+            # 卷积部分不含依赖输入尺寸的Python逻辑，trace的结果适用于任意尺寸
+            with torch.no_grad():
+                backbone = torch.jit.freeze(torch.jit.trace(backbone, torch.zeros(1, 3, 224, 224)))
+        elif mode == 'compile':
+            backbone = torch.compile(backbone, dynamic=True)
+        elif mode == 'int8_static':
+            backbone = _quantize_static(backbone, calibration)
+        self.backbone = backbone
+
+    def __call__(self, x: torch.Tensor) -> Dict[str, torch.Tensor]:
+        with torch.inference_mode():
+            if self.mode == 'channels_last':
+                x = x.contiguous(memory_format=torch.channels_last)
+            if self.mode == 'bf16':
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    fmap = self.backbone(x)
+                fmap = fmap.float()
+            else:
+                fmap = self.backbone(x)
+            return self.model.heads(fmap.contiguous())
+
+
+def compare_features(reference: Sequence[np.ndarray], candidate: Sequence[np.ndarray], k: int = 5) -> Dict:
+    """
+    比较同一组图片在fp32和其他模式下的特征
+
+    每张图片轮流作为查询，在样本内做L2检索，统计 top-k 结果与fp32的重合率
+
+    Returns:
+        min_cosine/mean_cosine: 特征余弦相似度，max_rel_error: 最大相对L2误差，topk_overlap: 平均重合率
+    """
+    ref = np.vstack(reference).astype(np.float64)
+    cand = np.vstack(candidate).astype(np.float64)
+    ref_norm = np.linalg.norm(ref, axis=1)
+    cosine = (ref * cand).sum(axis=1) / np.maximum(ref_norm * np.linalg.norm(cand, axis=1), 1e-12)
+    rel_error = np.linalg.norm(ref - cand, axis=1) / np.maximum(ref_norm, 1e-12)
+
+    def topk(feats, k):
+        sq = (feats ** 2).sum(axis=1)
+        dists = sq[:, None] + sq[None, :] - 2 * feats @ feats.T
+        np.fill_diagonal(dists, np.inf)
+        return np.argsort(dists, axis=1)[:, :k]
+
+    k = min(k, len(ref) - 1)
+    overlap = 1.0
+    if k > 0:
+        overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(topk(ref, k), topk(cand, k))]))
+    return {
+        'num_images': len(ref),
+        'min_cosine': float(cosine.min()),
+        'mean_cosine': float(cosine.mean()),
+        'max_rel_error': float(rel_error.max()),
+        'topk_overlap': overlap,
+    }
+
+
+def verify_mode(network: str, mode: str, n: int = calibration_size, k: int = 5) -> Dict:
+    """
+    用数据集样本校验推理模式：特征与fp32的误差和检索结果的重合率需在容差以内
+
+    Args:
+        network: resnet 或 vgg
+        mode: 待校验的推理模式
+        n: 样本图片数量
+        k: 比较的检索深度
+
+    Returns:
+        compare_features 的统计结果，passed 表示是否在容差以内
+    """
+    if network == 'resnet':
+        import resnet
+        build, extract = resnet.build_resnet_model, resnet.extract_resnet_features
+    elif network == 'vgg':
+        import vggnet
+        build, extract = vggnet.build_vgg_model, vggnet.extract_vgg_features
+    else:
+        raise ValueError(f"不支持的网络: {network}")
+
+    imgs = [load_image(path) for path in calibration_images(n)]
+    mode = resolve_mode(mode)
+    reference = extract(imgs, model=build('fp32'))
+    candidate = extract(imgs, model=build(mode))
+    pairs = [(r, c) for r, c in zip(reference, candidate) if r is not None and c is not None]
+    if not pairs:
+        raise RuntimeError("没有可用于校验的样本图片")
+    stats = compare_features([r for r, _ in pairs], [c for _, c in pairs], k)
+    stats.update(network=network, mode=mode,
+                 passed=stats['min_cosine'] >= min_cosine and stats['topk_overlap'] >= min_topk_overlap)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="校验CPU推理模式与fp32特征的误差")
+    parser.add_argument("network", choices=["resnet", "vgg"])
+    parser.add_argument("mode", nargs="?", default=inference_mode, choices=inference_modes)
+    parser.add_argument("-n", type=int, default=calibration_size, help="样本图片数量")
+    parser.add_argument("-k", type=int, default=5, help="比较的检索深度")
+    args = parser.parse_args()
+
+    stats = verify_mode(args.network, args.mode, args.n, args.k)
+    for key, value in stats.items():
+        print(f"{key}: {value}")
+    sys.exit(0 if stats['passed'] else 1)
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+from image_loader import iter_batches, default_batch_size, default_num_workers, preprocess_resnet, preprocess_vgg
+from index_registry import legacy_backbones
+
+# 深度特征的执行后端：torch（默认）或 onnx
+# onnx 时用 ONNX Runtime 的CPU执行 export_onnx.py 导出的计算图，Web服务进程不导入torch
+deep_backend = os.environ.get("CBIR_DEEP_BACKEND", "torch")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+onnx_dir = os.environ.get("CBIR_ONNX_DIR", os.path.join(BASE_DIR, "..", "onnx_models"))
+
+# ONNX Runtime 线程池：intra 为单个算子使用的线程数，inter 为并行执行算子的线程数，0 表示使用默认值
+intra_op_threads = int(os.environ.get("CBIR_ORT_THREADS", "0"))
+inter_op_threads = int(os.environ.get("CBIR_ORT_INTER_THREADS", "0"))
+# 缓存图优化后的模型，之后加载时跳过优化；优化结果与CPU指令集相关，换机器后需删除 *.optimized.onnx
+optimized_cache = os.environ.get("CBIR_ORT_OPTIMIZED_CACHE", "1") != "0"
+
+networks = ("resnet", "vgg")
+
+# 骨干网络 -> 会话
+_sessions = {}
+_lock = threading.Lock()
+
+
+def backbone_network(backbone: str) -> str:
+    """resnet50 -> resnet，vgg16 -> vgg"""
+    for network in networks:
+        if backbone.startswith(network):
+            return network
+    raise ValueError(f"不支持的骨干网络: {backbone}")
+
+
+def model_path(backbone: str) -> str:
+    return os.path.join(onnx_dir, f"{backbone}.onnx")
+
+
+def info_path(backbone: str) -> str:
+    """导出时记录的模型信息（骨干网络、特征层、输入尺寸）"""
+    return os.path.join(onnx_dir, f"{backbone}.json")
+
+
+def model_info(backbone: str) -> Dict:
+    with open(info_path(backbone), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _create_session(path: str):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+    cached = os.path.splitext(path)[0] + '.optimized.onnx'
+    if optimized_cache and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+        # 缓存的模型已经过图优化，直接加载
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        path = cached
+    else:
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if optimized_cache:
+            options.optimized_model_filepath = cached
+    return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def get_session(backbone: str):
+    """获取骨干网络对应的 ONNX Runtime 会话（单例），会话可在多个线程中同时使用"""
+    session = _sessions.get(backbone)
+    if session is None:
+        with _lock:
+            session = _sessions.get(backbone)
+            if session is None:
+                path = model_path(backbone)
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"{path} 不存在，请先运行 export_onnx.py {backbone} 导出模型")
+                session = _sessions[backbone] = _create_session(path)
+    return session
+
+
+def loaded_models() -> Dict[str, bool]:
+    return {network: any(backbone_network(b) == network for b in _sessions) for network in networks}
+
+
+def _run(backbone: str, batch: np.ndarray) -> np.ndarray:
+    session = get_session(backbone)
+    return session.run(None, {session.get_inputs()[0].name: batch})[0]
+
+
+def extract_resnet_features(images, batch_size=default_batch_size, num_workers=default_num_workers, size=None,
+                            backbone=None) -> List:
+    """
+    用 ONNX Runtime 批量提取ResNet avg特征，参数和返回值与 resnet.extract_resnet_features 相同
+
+    size 为None时使用导出时记录的输入尺寸，backbone 为None时使用默认的 resnet152
+    """
+    backbone = backbone or legacy_backbones["resnet"]["model"]
+    features = [None] * len(images)
+    if size is None and os.path.exists(info_path(backbone)):
+        size = model_info(backbone).get("input_size")
+    for idxs, batch in iter_batches(images, preprocess_resnet, batch_size, num_workers, size):
+        try:
+            feats = _run(backbone, batch)
+            for i, feat in zip(idxs, feats):
+                features[i] = feat / np.sum(feat)  # normalize
+        except Exception as e:
+            print(f"Error extracting ResNet feature: {e}")
+    return features
+
+
+def extract_vgg_features(imgs, batch_size=default_batch_size, num_workers=default_num_workers, backbone=None) -> List:
+    """用 ONNX Runtime 批量提取VGG avg特征，backbone 为None时使用默认的 vgg19"""
+    backbone = backbone or legacy_backbones["vgg"]["model"]
+    features = [None] * len(imgs)
+    for idxs, batch in iter_batches(imgs, preprocess_vgg, batch_size, num_workers):
+        try:
+            for i, feat in zip(idxs, _run(backbone, batch)):
+                features[i] = feat
+        except Exception as e:
+            print(f"Error extracting VGG feature: {e}")
+    return features
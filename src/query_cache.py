@@ -0,0 +1,73 @@
+import hashlib
+from typing import Any, Dict, Optional
+
+from fast_retrieval import LRUCache
+
+
+def content_hash(data: bytes) -> str:
+    """计算上传内容的 SHA-256，作为查询缓存的键"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class QueryCache:
+    """按上传图片内容缓存特征向量和检索结果的两级缓存
+
+    只在事件循环线程中访问，无需加锁。
+    """
+
+    def __init__(self, feature_capacity: int = 512, result_capacity: int = 2048):
+        """
+        初始化查询缓存
+
+        Args:
+            feature_capacity: 特征向量缓存条目数
+            result_capacity: 检索结果缓存条目数
+        """
+        self.feature_cache = LRUCache(feature_capacity)
+        self.result_cache = LRUCache(result_capacity)
+        self.versions: Dict[str, str] = {}
+        self.counters = {
+            'feature_hits': 0,
+            'feature_misses': 0,
+            'result_hits': 0,
+            'result_misses': 0,
+            'invalidations': 0,
+        }
+
+    def check_version(self, feature_type: str, version: Optional[str]):
+        """索引版本变化时清除该特征类型的所有缓存条目"""
+        if version is None or self.versions.get(feature_type) == version:
+            return
+        if feature_type in self.versions:
+            for cache in (self.feature_cache, self.result_cache):
+                stale = [key for key in cache.cache if key[1] == feature_type]
+                for key in stale:
+                    del cache.cache[key]
+            self.counters['invalidations'] += 1
+        self.versions[feature_type] = version
+
+    def get_feature(self, digest: str, feature_type: str) -> Any:
+        feat = self.feature_cache.get((digest, feature_type))
+        self.counters['feature_hits' if feat is not None else 'feature_misses'] += 1
+        return feat
+
+    def put_feature(self, digest: str, feature_type: str, feat):
+        self.feature_cache.put((digest, feature_type), feat)
+
+    def get_result(self, digest: str, feature_type: str, k: int, version: Optional[str]) -> Any:
+        result = self.result_cache.get((digest, feature_type, k, version))
+        self.counters['result_hits' if result is not None else 'result_misses'] += 1
+        return result
+
+    def put_result(self, digest: str, feature_type: str, k: int, version: str, result):
+        self.result_cache.put((digest, feature_type, k, version), result)
+
+    def stats(self) -> Dict[str, Any]:
+        """命中/未命中计数和命中率"""
+        stats = dict(self.counters)
+        for level in ('feature', 'result'):
+            total = stats[f'{level}_hits'] + stats[f'{level}_misses']
+            stats[f'{level}_hit_ratio'] = stats[f'{level}_hits'] / total if total else 0.0
+        stats['feature_entries'] = len(self.feature_cache.cache)
+        stats['result_entries'] = len(self.result_cache.cache)
+        return stats
@@ -4,6 +4,7 @@ from __future__ import print_function
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
 
 from color import Color
 from daisy import Daisy
@@ -46,9 +47,9 @@ class RandomProjection(object):
       print("Use features {}, {} RandomProject, keep {}".format(" & ".join(self.features), self.project_type, self.keep_rate))
 
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
+      # every image is decoded once and shared by all the features
+      extractors = [self._get_extractor(f_class) for f_class in self.features]
+      feats = feature_store.make_samples(db, extractors, verbose=False)
       samples = self._concat_feat(db, feats)
       samples, _ = self._rp(samples)
       self.samples = samples  # cache the result
@@ -61,15 +62,15 @@ class RandomProjection(object):
          a boolean
     '''
     if self.samples == None:
-      feats = []
-      for f_class in self.features:
-        feats.append(self._get_feat(db, f_class))
+      # every image is decoded once and shared by all the features
+      extractors = [self._get_extractor(f_class) for f_class in self.features]
+      feats = feature_store.make_samples(db, extractors, verbose=False)
       samples = self._concat_feat(db, feats)
       samples, flag = self._rp(samples)
       self.samples = samples  # cache the result
     return True if flag else False
 
-  def _get_feat(self, db, f_class):
+  def _get_extractor(self, f_class):
     if f_class == 'color':
       f_c = Color()
     elif f_class == 'daisy':
@@ -84,7 +85,7 @@ class RandomProjection(object):
       f_c = VGGNetFeat()
     elif f_class == 'res':
       f_c = ResNetFeat()
-    return f_c.make_samples(db, verbose=False)
+    return f_c
 
   def _concat_feat(self, db, feats):
     samples = feats[0]
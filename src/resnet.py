@@ -19,6 +19,11 @@ import gc
 
 from evaluate import evaluate_class
 from DB import Database
+import feature_store
+from image_loader import iter_batches, default_batch_size, default_num_workers
+from image_loader import preprocess_resnet as _preprocess_resnet
+import onnx_backend
+from inference_modes import InferenceModel, resolve_mode, calibration_batches
 
 os.environ['TORCH_HOME'] = os.path.join(os.path.dirname(__file__), 'cache')
 
@@ -31,6 +36,7 @@ os.environ['TORCH_HOME'] = os.path.join(os.path.dirname(__file__), 'cache')
 RES_model  = 'resnet152'  # model type
 pick_layer = 'avg'        # extract feature of this layer
 d_type     = 'd1'         # distance type
+input_size = None         # (H, W) to resize images to before the forward pass, None keeps the native resolution
 
 depth = 3  # retrieved depth, set to None will count the ap for whole database
 
@@ -64,25 +70,39 @@ cache_dir = 'cache'
 if not os.path.exists(cache_dir):
   os.makedirs(cache_dir)
 
-# 全局模型实例，避免重复创建
-_resnet_model = None
+# 全局模型实例，按骨干网络缓存，避免重复创建
+_resnet_models = {}
 
-def get_resnet_model():
-    """获取ResNet模型实例（单例模式）"""
-    global _resnet_model
-    if _resnet_model is None:
-        _resnet_model = ResidualNet(model=RES_model)
-        _resnet_model.eval()
-        if use_gpu:
-            _resnet_model = _resnet_model.cuda()
-    return _resnet_model
+def backbone_spec():
+    """当前配置的骨干网络和特征层，构建索引时写入元数据"""
+    return {"model": RES_model, "layer": pick_layer}
+
+def build_resnet_model(mode=None, backbone=None):
+    """
+    创建按推理模式包装的ResNet模型
+    Args:
+        mode: inference_modes 中的推理模式，为None时使用 CBIR_INFERENCE_MODE
+        backbone: resnet18/34/50/101/152，为None时使用 RES_model
+    """
+    model = ResidualNet(model=backbone or RES_model)
+    model.eval()
+    if use_gpu:
+        model = model.cuda()
+    # int8_static 用数据集样本校准，预处理与特征提取时相同
+    return InferenceModel(model, resolve_mode(mode),
+                          calibration=lambda: calibration_batches(_preprocess_resnet, size=input_size))
+
+def get_resnet_model(backbone=None):
+    """获取ResNet模型实例（每种骨干网络一个单例），backbone为None时使用 RES_model"""
+    backbone = backbone or RES_model
+    if backbone not in _resnet_models:
+        _resnet_models[backbone] = build_resnet_model(backbone=backbone)
+    return _resnet_models[backbone]
 
 def clear_resnet_model():
-    """清理ResNet模型实例"""
-    global _resnet_model
-    if _resnet_model is not None:
-        del _resnet_model
-        _resnet_model = None
+    """清理所有ResNet模型实例"""
+    if _resnet_models:
+        _resnet_models.clear()
         if use_gpu:
             torch.cuda.empty_cache()
         gc.collect()
@@ -119,6 +139,11 @@ class ResidualNet(ResNet):
         if pretrained:
             self.load_state_dict(model_zoo.load_url(model_urls['resnet152']))
 
+  def backbone(self):
+    # conv part up to layer4, shares modules with self; inference modes only accelerate this part
+    return nn.Sequential(self.conv1, self.bn1, self.relu, self.maxpool,
+                         self.layer1, self.layer2, self.layer3, self.layer4)
+
   def forward(self, x):
     x = self.conv1(x)
     x = self.bn1(x)
@@ -128,6 +153,10 @@ class ResidualNet(ResNet):
     x = self.layer2(x)
     x = self.layer3(x)
     x = self.layer4(x)  # x after layer4, shape = N * 512 * H/32 * W/32
+    return self.heads(x)
+
+  def heads(self, x):
+    # global pooling and fc on the layer4 feature map
     max_pool = torch.nn.MaxPool2d((x.size(-2),x.size(-1)), stride=(x.size(-2),x.size(-1)), padding=0, ceil_mode=False)
     Max = max_pool(x)  # avg.size = N * 512 * 1 * 1
     Max = Max.view(Max.size(0), -1)  # avg.size = N * 512
@@ -145,52 +174,52 @@ class ResidualNet(ResNet):
 
 class ResNetFeat(object):
 
-  def make_samples(self, db, verbose=True):
-    sample_cache = '{}-{}'.format(RES_model, pick_layer)
+  def cache_name(self):
+    return '{}-{}'.format(RES_model, pick_layer)
   
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
+  def extract_batch(self, imgs, grays=None):
+    # decoded arrays go through the same preprocessing as image paths
+    return extract_resnet_features([Image.fromarray(img) for img in imgs])
   
-      res_model = ResidualNet(model=RES_model)
-      res_model.eval()
-      if use_gpu:
-        res_model = res_model.cuda()
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        img = imageio.imread(d_img, mode="RGB")
-        img = img[:, :, ::-1]  # switch to BGR
-        img = np.transpose(img, (2, 0, 1)) / 255.
-        img[0] -= means[0]  # reduce B's mean
-        img[1] -= means[1]  # reduce G's mean
-        img[2] -= means[2]  # reduce R's mean
-        img = np.expand_dims(img, axis=0)
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
+
+
+def extract_resnet_features(images, batch_size=default_batch_size, num_workers=default_num_workers, size=input_size,
+                            model=None, backbone=None):
+    """
+    批量提取ResNet特征，图片在加载线程中解码和预处理，每批做一次前向
+    Args:
+        images: PIL Image对象或图片路径列表
+        batch_size: 每批图片数量
+        num_workers: 解码和预处理的线程数
+        size: (H, W)，缩放到固定尺寸后任意图片都可以合并为一批；为None时保持原始分辨率，只合并尺寸相同的图片
+        model: 使用的模型，为None时使用全局单例（校验推理模式时传入其他模式的模型）
+        backbone: 骨干网络，为None时使用 RES_model；检索时取自索引元数据
+    Returns:
+        features: 与images等长的列表，元素为 numpy array, shape (2048,)，失败时为None
+    """
+    if model is None and onnx_backend.deep_backend == 'onnx':
+        return onnx_backend.extract_resnet_features(images, batch_size, num_workers, size, backbone or RES_model)
+    features = [None] * len(images)
+    res_model = model if model is not None else get_resnet_model(backbone)
+    for idxs, batch in iter_batches(images, _preprocess_resnet, batch_size, num_workers, size):
         try:
-          if use_gpu:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).cuda().float())
-          else:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).float())
-          d_hist = res_model(inputs)[pick_layer]
-          d_hist = d_hist.data.cpu().numpy().flatten()
-          d_hist /= np.sum(d_hist)  # normalize
-          samples.append({
-                          'img':  d_img, 
-                          'cls':  d_cls, 
-                          'hist': d_hist
-                         })
-        except:
-          pass
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-  
-    return samples
+            with torch.inference_mode():
+                inputs = torch.from_numpy(batch)
+                if use_gpu:
+                    inputs = inputs.cuda()
+                feats = res_model(inputs)[pick_layer].cpu().numpy()
+                del inputs
+            for i, feat in zip(idxs, feats):
+                features[i] = feat / np.sum(feat)  # normalize
+        except Exception as e:
+            print(f"Error extracting ResNet feature: {e}")
+            # 显存不足等错误后释放缓存，继续处理下一批
+            if use_gpu:
+                torch.cuda.empty_cache()
+            gc.collect()
+    return features
 
 
 def extract_resnet_feature(img):
@@ -202,41 +231,9 @@ def extract_resnet_feature(img):
         feature: numpy array, shape (512,)
     """
     try:
-        # 获取模型实例（单例模式）
-        res_model = get_resnet_model()
-        
-        # 预处理图片
-        img_array = np.array(img)
-        img_array = img_array[:, :, ::-1]  # RGB to BGR
-        img_array = np.transpose(img_array, (2, 0, 1)) / 255.
-        img_array[0] -= means[0]  # reduce B's mean
-        img_array[1] -= means[1]  # reduce G's mean
-        img_array[2] -= means[2]  # reduce R's mean
-        img_array = np.expand_dims(img_array, axis=0)
-        
-        # 提取特征
-        with torch.no_grad():  # 禁用梯度计算以节省内存
-            if use_gpu:
-                inputs = torch.from_numpy(img_array).cuda().float()
-            else:
-                inputs = torch.from_numpy(img_array).float()
-            
-            feature = res_model(inputs)[pick_layer]
-            feature = feature.cpu().numpy().flatten()
-            feature /= np.sum(feature)  # normalize
-            
-            # 清理中间变量
-            del inputs
-            if use_gpu:
-                torch.cuda.empty_cache()
-            
-            return feature
+        return extract_resnet_features([img])[0]
     except Exception as e:
         print(f"Error extracting ResNet feature: {e}")
-        # 清理内存
-        if use_gpu:
-            torch.cuda.empty_cache()
-        gc.collect()
         return None
 
 
@@ -0,0 +1,68 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class QueueFullError(RuntimeError):
+    """执行器等待队列已满"""
+
+
+class BoundedExecutor:
+    """带有界等待队列的执行器，用于把CPU密集任务移出asyncio事件循环"""
+
+    def __init__(self,
+                 kind: str = 'thread',
+                 max_workers: int = None,
+                 queue_size: int = 16):
+        """
+        初始化执行器
+
+        Args:
+            kind: 'thread' 使用线程池，'process' 使用进程池
+            max_workers: 并发工作者数量，默认为CPU核数
+            queue_size: 工作者全忙时允许排队的任务数量，超出后拒绝新任务
+        """
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"未知的执行器类型: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                # spawn 避免在已初始化torch/OpenMP线程的进程中fork
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='cbir-search')
+        return self._executor
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """
+        在执行器中运行任务并等待结果
+
+        Raises:
+            QueueFullError: 正在执行和排队的任务数达到上限
+        """
+        # pending只在事件循环线程中修改，无需加锁
+        if self.pending >= self.max_workers + self.queue_size:
+            raise QueueFullError(f"检索队列已满（{self.pending} 个任务进行中）")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
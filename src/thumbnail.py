@@ -0,0 +1,119 @@
+import base64
+import io
+import os
+import threading
+from typing import Iterable
+
+from PIL import Image
+
+# 缩略图配置，Web服务和索引构建脚本共用，可通过环境变量覆盖
+thumb_size = int(os.environ.get("CBIR_THUMB_SIZE", "256"))   # 缩略图最长边
+thumb_format = os.environ.get("CBIR_THUMB_FORMAT", "JPEG")   # JPEG 或 WEBP
+thumb_quality = 85
+preview_size = 400      # 结果页展示上传原图的最长边
+
+_extensions = {'JPEG': 'jpg', 'WEBP': 'webp'}
+_media_types = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+def make_thumbnail(img: Image.Image, size: int) -> Image.Image:
+    """等比缩放到最长边不超过size，不放大小图"""
+    img = img.convert('RGB')
+    img.thumbnail((size, size), Image.LANCZOS)
+    return img
+
+
+def make_preview_data_uri(img: Image.Image, size: int = preview_size, quality: int = thumb_quality) -> str:
+    """把上传的图片缩小后编码为 JPEG data URI，用于结果页展示"""
+    buffered = io.BytesIO()
+    make_thumbnail(img, size).save(buffered, format='JPEG', quality=quality)
+    img_base64 = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/jpeg;base64,{img_base64}"
+
+
+class ThumbnailService:
+    """为数据集图片生成并缓存缩略图，原图更新后自动重新生成"""
+
+    def __init__(self,
+                 dataset_dir: str,
+                 cache_dir: str,
+                 size: int = thumb_size,
+                 fmt: str = thumb_format,
+                 quality: int = thumb_quality):
+        """
+        初始化缩略图服务
+
+        Args:
+            dataset_dir: 原图目录
+            cache_dir: 缩略图缓存目录
+            size: 缩略图最长边
+            fmt: 缩略图格式，JPEG 或 WEBP
+            quality: 编码质量
+        """
+        fmt = fmt.upper()
+        if fmt not in _extensions:
+            raise ValueError(f"不支持的缩略图格式: {fmt}")
+        self.dataset_dir = os.path.abspath(dataset_dir)
+        self.cache_dir = os.path.join(cache_dir, f"{size}-{_extensions[fmt]}")
+        self.size = size
+        self.fmt = fmt
+        self.quality = quality
+        self.media_type = _media_types[fmt]
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def source_path(self, fname: str) -> str:
+        """原图路径，拒绝越出数据集目录的文件名"""
+        path = os.path.abspath(os.path.join(self.dataset_dir, fname))
+        if not path.startswith(self.dataset_dir + os.sep):
+            raise FileNotFoundError(fname)
+        return path
+
+    def thumb_path(self, fname: str) -> str:
+        return os.path.join(self.cache_dir, f"{fname}.{_extensions[self.fmt]}")
+
+    def get(self, fname: str) -> str:
+        """
+        获取缩略图路径，缩略图缺失或比原图旧时生成
+
+        Raises:
+            FileNotFoundError: 原图不存在
+            PIL.UnidentifiedImageError: 原图不是图片
+            OSError: 原图损坏或无法读取
+        """
+        src = self.source_path(fname)
+        dst = self.thumb_path(fname)
+        src_mtime = os.stat(src).st_mtime
+        try:
+            if os.stat(dst).st_mtime >= src_mtime:
+                return dst
+        except OSError:
+            pass
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with Image.open(src) as img:
+            if img.format == 'GIF':
+                img.seek(0)
+            thumb = make_thumbnail(img, self.size)
+        # 先写临时文件再替换，避免并发请求读到半个文件
+        tmp = f"{dst}.{os.getpid()}-{threading.get_ident()}.tmp"
+        thumb.save(tmp, format=self.fmt, quality=self.quality)
+        os.replace(tmp, dst)
+        return dst
+
+    def etag(self, path: str) -> str:
+        st = os.stat(path)
+        return '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+
+    def generate_all(self, fnames: Iterable[str], verbose: bool = True) -> int:
+        """批量预生成缩略图（索引构建时调用），返回成功数量"""
+        count = 0
+        for fname in fnames:
+            try:
+                self.get(fname)
+                count += 1
+            except Exception as e:
+                if verbose:
+                    print(f"缩略图生成失败: {fname}, 错误: {e}")
+        if verbose:
+            print(f"缩略图生成完成，共 {count} 张")
+        return count
@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 from torchvision import models
 from torchvision.models.vgg import VGG
+import torch.utils.model_zoo as model_zoo
 
 from six.moves import cPickle
 import numpy as np
@@ -16,8 +17,10 @@ import gc
 
 from evaluate import evaluate_class
 from DB import Database
-
-from torchvision import transforms
+import feature_store
+from inference_modes import InferenceModel, resolve_mode, calibration_batches
+from image_loader import preprocess_vgg as _preprocess_vgg
+import onnx_backend
 
 os.environ['TORCH_HOME'] = os.path.join(os.path.dirname(__file__), 'cache')
 
@@ -62,58 +65,93 @@ cache_dir = 'cache'
 if not os.path.exists(cache_dir):
   os.makedirs(cache_dir)
 
-# 全局模型实例，避免重复创建
-_vgg_model = None
+# 全局模型实例，按骨干网络缓存，避免重复创建
+_vgg_models = {}
 
-def get_vgg_model():
-    """获取VGG模型实例（单例模式）"""
-    global _vgg_model
-    if _vgg_model is None:
-        _vgg_model = VGGNet(requires_grad=False, model=VGG_model)
-        _vgg_model.eval()
-        if use_gpu:
-            _vgg_model = _vgg_model.cuda()
-    return _vgg_model
+def backbone_spec():
+    """当前配置的骨干网络和特征层，构建索引时写入元数据"""
+    return {"model": VGG_model, "layer": pick_layer}
+
+def build_vgg_model(mode=None, backbone=None):
+    """
+    创建按推理模式包装的VGG模型
+    Args:
+        mode: inference_modes 中的推理模式，为None时使用 CBIR_INFERENCE_MODE
+        backbone: vgg11/13/16/19，为None时使用 VGG_model
+    """
+    # 只用avg池化特征时不需要全连接层，省去约1.2亿参数
+    model = VGGNet(requires_grad=False, model=backbone or VGG_model, remove_fc=(pick_layer == 'avg'))
+    model.eval()
+    if use_gpu:
+        model = model.cuda()
+    # int8_static 用数据集样本校准，预处理与特征提取时相同
+    return InferenceModel(model, resolve_mode(mode), calibration=lambda: calibration_batches(_preprocess_vgg))
+
+def get_vgg_model(backbone=None):
+    """获取VGG模型实例（每种骨干网络一个单例），backbone为None时使用 VGG_model"""
+    backbone = backbone or VGG_model
+    if backbone not in _vgg_models:
+        _vgg_models[backbone] = build_vgg_model(backbone=backbone)
+    return _vgg_models[backbone]
 
 def clear_vgg_model():
-    """清理VGG模型实例"""
-    global _vgg_model
-    if _vgg_model is not None:
-        del _vgg_model
-        _vgg_model = None
+    """清理所有VGG模型实例"""
+    if _vgg_models:
+        _vgg_models.clear()
         if use_gpu:
             torch.cuda.empty_cache()
         gc.collect()
 
+# from https://github.com/pytorch/vision/blob/master/torchvision/models/vgg.py
+model_urls = {
+    'vgg11': 'https://download.pytorch.org/models/vgg11-8a719046.pth',
+    'vgg13': 'https://download.pytorch.org/models/vgg13-19584684.pth',
+    'vgg16': 'https://download.pytorch.org/models/vgg16-397923af.pth',
+    'vgg19': 'https://download.pytorch.org/models/vgg19-dcbb9e9d.pth',
+}
+
 class VGGNet(VGG):
   def __init__(self, pretrained=True, model='vgg16', requires_grad=False, remove_fc=False, show_params=False):
-    super().__init__(make_layers(cfg[model]))
+    # pretrained weights overwrite the random initialization anyway
+    super().__init__(make_layers(cfg[model]), init_weights=not pretrained)
     self.ranges = ranges[model]
     self.fc_ranges = ((0, 2), (2, 5), (5, 7))
+    self.remove_fc = remove_fc
+
+    if remove_fc:  # delete redundant fully-connected layer params, can save memory; forward then only returns 'avg'
+      del self.classifier
 
     if pretrained:
-      exec("self.load_state_dict(models.%s(pretrained=True).state_dict())" % model)
+      state_dict = model_zoo.load_url(model_urls[model])
+      if remove_fc:
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith('classifier.')}
+      self.load_state_dict(state_dict)
 
     if not requires_grad:
       for param in super().parameters():
         param.requires_grad = False
 
-    if remove_fc:  # delete redundant fully-connected layer params, can save memory
-      del self.classifier
-
     if show_params:
       for name, param in self.named_parameters():
         print(name, param.size())
 
+  def backbone(self):
+    # conv part; inference modes only accelerate this part
+    return self.features
+
   def forward(self, x):
-    output = {}
+    return self.heads(self.features(x))
 
-    x = self.features(x)
+  def heads(self, x):
+    # global avg pooling and the fc layers on the conv feature map
+    output = {}
 
     avg_pool = torch.nn.AvgPool2d((x.size(-2), x.size(-1)), stride=(x.size(-2), x.size(-1)), padding=0, ceil_mode=False, count_include_pad=True)
     avg = avg_pool(x)  # avg.size = N * 512 * 1 * 1
     avg = avg.view(avg.size(0), -1)  # avg.size = N * 512
     output['avg'] = avg
+    if self.remove_fc:
+      return output
 
     x = x.view(x.size(0), -1)  # flatten()
     dims = x.size(1)
@@ -170,54 +208,34 @@ def make_layers(cfg, batch_norm=False):
 
 class VGGNetFeat(object):
 
-  def make_samples(self, db, verbose=True):
-    sample_cache = '{}-{}'.format(VGG_model, pick_layer)
-  
-    try:
-      samples = cPickle.load(open(os.path.join(cache_dir, sample_cache), "rb", True))
-      for sample in samples:
-        sample['hist'] /= np.sum(sample['hist'])  # normalize
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
-      if verbose:
-        print("Using cache..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
-    except:
-      if verbose:
-        print("Counting histogram..., config=%s, distance=%s, depth=%s" % (sample_cache, d_type, depth))
+  def cache_name(self):
+    return '{}-{}'.format(VGG_model, pick_layer)
   
-      vgg_model = VGGNet(requires_grad=False, model=VGG_model)
-      vgg_model.eval()
-      if use_gpu:
-        vgg_model = vgg_model.cuda()
-      samples = []
-      data = db.get_data()
-      for d in data.itertuples():
-        d_img, d_cls = getattr(d, "img"), getattr(d, "cls")
-        img = imageio.imread(d_img)
-        if img.shape[-1] == 4:  # RGBA转RGB
-            img = img[..., :3]
-        img = np.transpose(img, (2, 0, 1)) / 255.
-        img[0] -= means[0]  # reduce B's mean
-        img[1] -= means[1]  # reduce G's mean
-        img[2] -= means[2]  # reduce R's mean
-        img = np.expand_dims(img, axis=0)
-        try:
-          if use_gpu:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).cuda().float())
-          else:
-            inputs = torch.autograd.Variable(torch.from_numpy(img).float())
-          d_hist = vgg_model(inputs)[pick_layer]
-          d_hist = np.sum(d_hist.data.cpu().numpy(), axis=0)
-          d_hist /= np.sum(d_hist)  # normalize
-          samples.append({
-                          'img':  d_img, 
-                          'cls':  d_cls, 
-                          'hist': d_hist
-                         })
-        except:
-          pass
-      cPickle.dump(samples, open(os.path.join(cache_dir, sample_cache), "wb", True))
+  def extract_batch(self, imgs, grays=None):
+    # images keep their own resolution, one forward per image
+    vgg_model = get_vgg_model()
+    hists = []
+    for img in imgs:
+      img = np.transpose(img, (2, 0, 1)) / 255.
+      img[0] -= means[0]  # reduce B's mean
+      img[1] -= means[1]  # reduce G's mean
+      img[2] -= means[2]  # reduce R's mean
+      img = np.expand_dims(img, axis=0)
+      try:
+        if use_gpu:
+          inputs = torch.autograd.Variable(torch.from_numpy(img).cuda().float())
+        else:
+          inputs = torch.autograd.Variable(torch.from_numpy(img).float())
+        d_hist = vgg_model(inputs)[pick_layer]
+        d_hist = np.sum(d_hist.data.cpu().numpy(), axis=0)
+        d_hist /= np.sum(d_hist)  # normalize
+        hists.append(d_hist)
+      except:
+        hists.append(None)
+    return hists
   
-    return samples
+  def make_samples(self, db, verbose=True):
+    return feature_store.make_samples(db, [self], verbose=verbose)[0]
 
 
 if __name__ == "__main__":
@@ -231,45 +249,46 @@ if __name__ == "__main__":
     cls_MAPs.append(MAP)
   print("MMAP", np.mean(cls_MAPs))
 
-# ========== 新增：单张图片VGG特征提取函数 ==========
-def extract_vgg_feature(img):
+# ========== 新增：单张/批量图片VGG特征提取函数 ==========
+def extract_vgg_features(imgs, model=None, backbone=None):
     """
-    输入: PIL.Image
-    输出: numpy.ndarray (VGG avg池化层特征)
+    批量提取VGG特征，所有图片缩放到224x224后做一次前向
+    输入: PIL.Image 列表；model 为None时使用全局单例（校验推理模式时传入其他模式的模型）；
+         backbone 为None时使用 VGG_model，检索时取自索引元数据
+    输出: 与imgs等长的列表，元素为 numpy.ndarray (VGG avg池化层特征)，失败时为None
     """
+    if model is None and onnx_backend.deep_backend == 'onnx':
+        return onnx_backend.extract_vgg_features(imgs, backbone=backbone or VGG_model)
     try:
         # 获取模型实例（单例模式）
-        vgg_model = get_vgg_model()
-        
-        # 预处理图片
-        preprocess = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-        ])
-        img_tensor = preprocess(img).unsqueeze(0)  # (1, 3, 224, 224)
-        img_tensor = img_tensor[:, [2,1,0], :, :]  # RGB->BGR
-        img_tensor[:, 0, :, :] -= means[0]
-        img_tensor[:, 1, :, :] -= means[1]
-        img_tensor[:, 2, :, :] -= means[2]
-        
+        vgg_model = model if model is not None else get_vgg_model(backbone)
+
+        img_tensor = torch.from_numpy(np.stack([_preprocess_vgg(img) for img in imgs]))  # (N, 3, 224, 224)
         if use_gpu:
             img_tensor = img_tensor.cuda()
-        
+
         # 提取特征
-        with torch.no_grad():  # 禁用梯度计算以节省内存
-            feat = vgg_model(img_tensor)[pick_layer]  # 取avg池化层
-            feat = feat.cpu().numpy().flatten()
-            
+        with torch.inference_mode():  # 禁用梯度计算以节省内存
+            feats = vgg_model(img_tensor)[pick_layer]  # 取avg池化层
+            feats = feats.cpu().numpy()
+
             # 清理中间变量
             del img_tensor
             if use_gpu:
                 torch.cuda.empty_cache()
-            
-            return feat
+
+            return list(feats)
     except Exception as e:
         print(f"Error extracting VGG feature: {e}")
         # 清理内存
         if use_gpu:
             torch.cuda.empty_cache()
         gc.collect()
-        return None
+        return [None] * len(imgs)
+
+def extract_vgg_feature(img):
+    """
+    输入: PIL.Image
+    输出: numpy.ndarray (VGG avg池化层特征)
+    """
+    return extract_vgg_features([img])[0]
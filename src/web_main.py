@@ -1,24 +1,27 @@
 import sys
 import os
+import asyncio
+import secrets
+import time
 import numpy as np
-import faiss
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
-import base64
 
-from fastapi import FastAPI, File, UploadFile, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, File, UploadFile, Request, Form, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from typing import List
 
 # 导入特征提取方法
-from color import Color
-from daisy import Daisy
-from HOG import HOG
-from resnet import extract_resnet_feature
-from vggnet import extract_vgg_feature
-from fusion import extract_fusion_feature  # 你可以自定义
+from handcrafted import handcrafted_methods, extract_handcrafted_batch
+import onnx_backend
+from index_registry import IndexRegistry, deep_feature_types, index_backbones, fusion_components
+from search_executor import BoundedExecutor, QueueFullError
+from query_cache import QueryCache, content_hash
+from fast_retrieval import FastRetrieval, LRUCache
+from metrics import MetricsRegistry
+from thumbnail import ThumbnailService, make_preview_data_uri
 
 sys.path.insert(0, os.path.dirname(__file__))
 
@@ -31,93 +34,604 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 dataset_dir = os.path.join(BASE_DIR, "..", "dataset")
 templates_dir = os.path.join(BASE_DIR, "..", "templates")
 faiss_index_dir = os.path.join(BASE_DIR, "..", "faiss_index")
+thumbnail_dir = os.path.join(BASE_DIR, "..", "thumbnails")
 
 app.mount("/static", StaticFiles(directory=dataset_dir), name="static")
 app.mount("/material", StaticFiles(directory=os.path.join(BASE_DIR, "..", "material")), name="material")
 templates = Jinja2Templates(directory=templates_dir)
 
-# 统一key为英文小写
-feature_methods = {
-    "color": lambda img: Color().histogram(np.array(img)),
-    "texture": lambda img: Daisy().histogram(np.array(img)),
-    "shape": lambda img: HOG().histogram(np.array(img)),
-    "resnet": extract_resnet_feature,
-    "vgg": extract_vgg_feature,
-    "fusion": extract_fusion_feature,
-}
+# 结果页使用缩略图，原图仍通过 /static 下载
+thumbnails = ThumbnailService(dataset_dir, thumbnail_dir)
+thumb_max_age = 7 * 24 * 3600
+
+# 深度特征的执行后端（CBIR_DEEP_BACKEND），onnx 时由 ONNX Runtime 执行导出的fp32计算图，不导入torch
+if onnx_backend.deep_backend == "onnx":
+    from onnx_backend import extract_resnet_features, extract_vgg_features
+    inference_mode = "fp32"
+    pick_layers = {"resnet": "avg", "vgg": "avg"}
+else:
+    import resnet
+    import vggnet
+    from resnet import extract_resnet_features
+    from vggnet import extract_vgg_features
+    from inference_modes import resolve_mode
+    # 深度模型的CPU推理模式（CBIR_INFERENCE_MODE），必须与构建深度特征索引时的模式一致
+    inference_mode = resolve_mode()
+    pick_layers = {"resnet": resnet.pick_layer, "vgg": vggnet.pick_layer}
+
+# 统一为英文小写；手工特征由 extract_handcrafted_batch 提取，深度特征见 batch_feature_methods，融合特征由 fusion_components 拼接
+feature_types = ("color", "texture", "shape", "edge", "resnet", "vgg", "fusion")
 feature_names = {
     "color": "颜色特征",
     "texture": "纹理特征",
     "shape": "形状特征",
+    "edge": "边缘特征",
     "resnet": "ResNet特征",
     "vgg": "VGG特征",
     "fusion": "融合特征",
 }
+# 支持整批前向推理的深度特征
+batch_feature_methods = {
+    "resnet": extract_resnet_features,
+    "vgg": extract_vgg_features,
+}
+
+# 进程级常驻索引，启动时加载一次，索引文件变化时自动重新加载
+index_registry = IndexRegistry(faiss_index_dir, list(feature_types))
+
+# 所有检索都经由常驻的 FastRetrieval 实例，与上面的注册表共用索引
+# CBIR_RETRIEVAL_CACHE_SIZE: 按查询特征缓存的检索结果数
+# CBIR_HIERARCHICAL=1: 融合特征在大索引上先用颜色索引预过滤（近似检索，默认关闭），CBIR_FILTER_RATIO: 预过滤保留的比例
+retrieval = FastRetrieval(
+    faiss_index_dir,
+    cache_size=int(os.environ.get("CBIR_RETRIEVAL_CACHE_SIZE", "1000")),
+    use_hierarchical=os.environ.get("CBIR_HIERARCHICAL", "0") != "0",
+    filter_ratio=float(os.environ.get("CBIR_FILTER_RATIO", "0.1")),
+    registry=index_registry,
+    preload=False,
+)
+
+# 特征提取和检索在执行器中运行，避免阻塞事件循环
+# CBIR_EXECUTOR: thread/process，CBIR_WORKERS: 工作者数量，CBIR_QUEUE_SIZE: 排队上限
+# 深度模型推理和faiss检索计算时会释放GIL，默认使用线程
+search_executor = BoundedExecutor(
+    kind=os.environ.get("CBIR_EXECUTOR", "thread"),
+    max_workers=int(os.environ.get("CBIR_WORKERS", "0")) or None,
+    queue_size=int(os.environ.get("CBIR_QUEUE_SIZE", "16")),
+)
+# 手工特征是纯Python/numpy计算，默认放到进程池中才能并行
+# CBIR_HANDCRAFTED_EXECUTOR: thread/process，CBIR_HANDCRAFTED_WORKERS: 工作进程数量
+handcrafted_executor = BoundedExecutor(
+    kind=os.environ.get("CBIR_HANDCRAFTED_EXECUTOR", "process"),
+    max_workers=int(os.environ.get("CBIR_HANDCRAFTED_WORKERS", "0")) or None,
+    queue_size=int(os.environ.get("CBIR_QUEUE_SIZE", "16")),
+)
+
+# 按上传内容SHA-256缓存特征向量和检索结果，索引版本变化时自动失效
+query_cache = QueryCache(
+    feature_capacity=int(os.environ.get("CBIR_FEATURE_CACHE_SIZE", "512")),
+    result_capacity=int(os.environ.get("CBIR_RESULT_CACHE_SIZE", "2048")),
+)
+
+# JSON批量接口的限制
+api_max_batch = int(os.environ.get("CBIR_API_MAX_BATCH", "64"))
+api_max_k = 100
+
+# 翻页：首次检索 CBIR_CANDIDATE_WINDOW 条候选结果，排序列表按游标缓存 CBIR_CURSOR_CACHE_SIZE 个
+candidate_window = int(os.environ.get("CBIR_CANDIDATE_WINDOW", "100"))
+max_result_depth = 1000
+cursor_cache = LRUCache(int(os.environ.get("CBIR_CURSOR_CACHE_SIZE", "256")))
+
+# 启动时在后台加载索引和深度模型，手工特征无需等待深度模型加载完成即可检索
+# CBIR_WARMUP=0 时关闭预热，深度模型在首次请求时加载
+warmup_enabled = os.environ.get("CBIR_WARMUP", "1") != "0"
+# feature_type -> loading/ready/failed，只有 loading 状态会拒绝请求
+feature_state = {f: "loading" if warmup_enabled else "ready" for f in feature_types}
+warmup_errors = {}
+
+class FeatureNotReadyError(RuntimeError):
+    """特征对应的模型或索引仍在加载"""
+
+def network_backbone(network):
+    """ResNet/VGG使用的骨干网络，取自该特征索引的元数据；该索引不存在时取融合索引的元数据"""
+    for feature_type in (network, "fusion"):
+        try:
+            meta = index_registry.get(feature_type).meta
+        except FileNotFoundError:
+            continue
+        return index_backbones(meta, feature_type)[network]["model"]
+    return None
+
+def check_index_meta(feature_type):
+    """深度特征的查询必须与索引使用同一推理模式、骨干网络和特征层提取，没有元数据的旧索引按默认配置处理"""
+    if feature_type not in deep_feature_types:
+        return
+    meta = index_registry.get(feature_type).meta
+    built_mode = meta.get("inference_mode", "fp32")
+    if built_mode != inference_mode:
+        raise RuntimeError(f"{feature_names[feature_type]}索引使用 {built_mode} 推理模式构建，"
+                           f"服务当前为 {inference_mode}，请重建索引或修改 CBIR_INFERENCE_MODE")
+    for network, spec in index_backbones(meta, feature_type).items():
+        if spec["layer"] != pick_layers[network]:
+            raise RuntimeError(f"{feature_names[feature_type]}索引使用 {spec['layer']} 层特征构建，"
+                               f"服务当前为 {pick_layers[network]}，请重建索引")
+        # 融合特征复用ResNet/VGG特征的提取结果，分量必须与对应索引使用同一骨干网络
+        if spec["model"] != network_backbone(network):
+            raise RuntimeError(f"{feature_names[feature_type]}索引的{feature_names[network]}使用 {spec['model']} 构建，"
+                               f"与{feature_names[network]}索引不一致，请重建索引")
+
+# 各阶段耗时与索引/缓存状态，通过 /metrics 以 Prometheus 文本格式导出
+metrics = MetricsRegistry()
+request_seconds = metrics.histogram(
+    "cbir_request_seconds", "HTTP request latency in seconds", ["endpoint", "status"])
+stage_seconds = metrics.histogram(
+    "cbir_stage_seconds", "Latency of each search stage in seconds", ["stage", "feature"])
+metrics.gauge(
+    "cbir_index_images", "Number of images in each loaded index",
+    lambda: [({"feature": f}, len(entry)) for f, entry in index_registry.entries.items()])
+metrics.gauge(
+    "cbir_cache_hit_ratio", "Query cache hit ratio",
+    lambda: [({"level": level}, query_cache.stats()[f"{level}_hit_ratio"]) for level in ("feature", "result")])
+metrics.gauge(
+    "cbir_cache_lookups_total", "Query cache lookups",
+    lambda: [({"level": level, "outcome": outcome}, query_cache.counters[f"{level}_{outcome}"])
+             for level in ("feature", "result") for outcome in ("hits", "misses")],
+    metric_type="counter")
+metrics.gauge(
+    "cbir_executor_pending", "Tasks running or queued in each executor",
+    lambda: [({"executor": "search"}, search_executor.pending),
+             ({"executor": "handcrafted"}, handcrafted_executor.pending)])
+metrics.gauge(
+    "cbir_feature_ready", "Whether each feature is ready to serve (1) or still loading (0)",
+    lambda: [({"feature": f}, state != "loading") for f, state in feature_state.items()])
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # 使用路由模板作为标签，避免游标和文件名造成标签爆炸
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", "unmatched")
+    request_seconds.observe(time.perf_counter() - start, endpoint=endpoint, status=response.status_code)
+    return response
+
+def warmup_model(feature_type):
+    """按索引元数据加载深度模型，并用空白图片做一次前向，触发内存分配器和oneDNN初始化"""
+    feats = batch_feature_methods[feature_type]([Image.new('RGB', (224, 224))], backbone=network_backbone(feature_type))
+    if feats[0] is None:
+        raise RuntimeError(f"{feature_names[feature_type]}模型预热失败")
+
+async def warmup():
+    """后台预热：先加载索引和手工特征进程池，再依次加载深度模型"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, retrieval.load_indices)
+
+    # 每个工作进程处理一张小图，提前完成进程启动和模块导入
+    dummy = np.zeros((32, 32, 3), dtype=np.uint8)
+    pool_warmup = asyncio.gather(
+        *[handcrafted_executor.run(extract_handcrafted_batch, "color", [dummy])
+          for _ in range(handcrafted_executor.max_workers)],
+        return_exceptions=True
+    )
+    for feature_type in handcrafted_methods:
+        feature_state[feature_type] = "ready"
+
+    for feature_type in batch_feature_methods:
+        start = time.perf_counter()
+        try:
+            await search_executor.run(warmup_model, feature_type)
+            feature_state[feature_type] = "ready"
+            print(f"{feature_names[feature_type]}模型预热完成，耗时 {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            feature_state[feature_type] = "failed"
+            warmup_errors[feature_type] = str(e)
+            print(f"{feature_names[feature_type]}模型预热失败: {e}")
+
+    components = [feature_state[f] for f in fusion_components]
+    feature_state["fusion"] = "ready" if all(s == "ready" for s in components) else "failed"
+    await pool_warmup
+
+@app.on_event("startup")
+async def start_warmup():
+    if warmup_enabled:
+        # 不等待预热完成，服务立即开始接受请求
+        app.state.warmup_task = asyncio.ensure_future(warmup())
+    else:
+        retrieval.load_indices()
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    search_executor.shutdown(wait=False)
+    handcrafted_executor.shutdown(wait=False)
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    # 边缘特征在完整重建索引后才有索引文件，没有时默认不勾选，避免默认检索报错
+    edge_index = index_registry.current_version("edge") is not None
+    return templates.TemplateResponse("index.html", {"request": request, "edge_index": edge_index})
+
+def decode_image(img_bytes):
+    """解码上传的图片，并生成缩小后的 base64 预览图以便前端展示"""
+    img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+    original_img_data = make_preview_data_uri(img)
+    return img, original_img_data
+
+def decode_images(img_bytes_list):
+    """批量解码上传的图片，解码失败的位置为异常对象"""
+    imgs = []
+    for img_bytes in img_bytes_list:
+        try:
+            imgs.append(Image.open(io.BytesIO(img_bytes)).convert('RGB'))
+        except Exception as e:
+            imgs.append(RuntimeError(f"图片解码失败: {e}"))
+    return imgs
+
+def extract_feature_batch(feature_type, imgs):
+    """批量提取深度特征，在执行器中运行，整批图片只做一次前向；骨干网络取自索引元数据"""
+    feats = batch_feature_methods[feature_type](imgs, backbone=network_backbone(feature_type))
+    return [np.array(feat).astype('float32').flatten() if feat is not None
+            else RuntimeError(f"{feature_names[feature_type]}提取失败")
+            for feat in feats]
+
+def normalize_scores(dists):
+    """把距离按最小/最大值归一化为相似度，距离越小相似度越高"""
+    if len(dists) == 0:
+        return []
+    d_min, d_max = float(np.min(dists)), float(np.max(dists))
+    if d_max > d_min:
+        return [1 - (float(d) - d_min) / (d_max - d_min) for d in dists]
+    return [1.0 for _ in dists]
+
+def search_index(feature_type, feats, k=5):
+    """
+    通过 FastRetrieval 批量检索
+
+    Returns:
+        (索引版本号, 每个查询一个 (结果图片, 归一化相似度, 距离) 元组的列表)
+    """
+    searched = retrieval.batch_search(feats, feature_type, k)
+    results = [(r["img_paths"], r["scores"], r["distances"]) for r in searched]
+    return searched[0]["index_version"], results
+
+class QueryBatch:
+    """一次请求中的待检索图片、内容哈希及特征提取任务"""
+    def __init__(self, imgs, digests):
+        self.imgs = imgs
+        self.digests = digests
+        self.tasks = {}
+
+def get_extract_task(feature_type, batch):
+    """获取特征提取任务，同一请求内每种特征只提取一次"""
+    if feature_type not in batch.tasks:
+        batch.tasks[feature_type] = asyncio.ensure_future(extract_cached(feature_type, batch))
+    return batch.tasks[feature_type]
+
+async def extract_cached(feature_type, batch):
+    """先查特征缓存，只为未命中的图片提取特征"""
+    query_cache.check_version(feature_type, index_registry.current_version(feature_type))
+    feats = [query_cache.get_feature(d, feature_type) for d in batch.digests]
+    missing = [i for i, feat in enumerate(feats) if feat is None]
+    if not missing:
+        return feats
+
+    imgs = [batch.imgs[i] for i in missing]
+    with stage_seconds.time(stage="extract", feature=feature_type):
+        if feature_type == "fusion":
+            computed = await extract_fusion_concurrently(batch)
+            computed = [computed[i] for i in missing]
+        elif feature_type in handcrafted_methods:
+            computed = await extract_handcrafted_concurrently(feature_type, imgs)
+        else:
+            computed = await search_executor.run(extract_feature_batch, feature_type, imgs)
+    for i, feat in zip(missing, computed):
+        feats[i] = feat
+        if not isinstance(feat, Exception):
+            query_cache.put_feature(batch.digests[i], feature_type, feat)
+    return feats
+
+async def extract_handcrafted_concurrently(feature_type, imgs):
+    """把图片分组后交给进程池，每个工作进程处理一组"""
+    n_chunks = min(len(imgs), handcrafted_executor.max_workers)
+    chunks = [[np.array(img) for img in imgs[i::n_chunks]] for i in range(n_chunks)]
+    chunk_feats = await asyncio.gather(
+        *[handcrafted_executor.run(extract_handcrafted_batch, feature_type, chunk) for chunk in chunks]
+    )
+    # 还原为输入顺序
+    feats = [None] * len(imgs)
+    for i, part in enumerate(chunk_feats):
+        feats[i::n_chunks] = part
+    return feats
+
+async def extract_fusion_concurrently(batch):
+    """并行提取各分量后拼接为融合特征"""
+    parts = await asyncio.gather(
+        *[get_extract_task(f, batch) for f in fusion_components],
+        return_exceptions=True
+    )
+    for part in parts:
+        if isinstance(part, BaseException):
+            raise part
+    feats = []
+    for img_parts in zip(*parts):
+        errors = [p for p in img_parts if isinstance(p, Exception)]
+        if errors:
+            feats.append(errors[0])
+        else:
+            feats.append(np.concatenate([np.array(p).flatten() for p in img_parts]).astype('float32'))
+    return feats
+
+async def search_feature(feature_type, batch, k=5):
+    """
+    单个特征的提取+检索流水线，命中结果缓存的图片不再提取和检索
+
+    Returns:
+        与batch.imgs等长的列表，元素为 search_index 的结果元组，失败时为异常对象
+    """
+    version = index_registry.current_version(feature_type)
+    query_cache.check_version(feature_type, version)
+    results = [query_cache.get_result(d, feature_type, k, version) for d in batch.digests]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    if feature_state[feature_type] == "loading":
+        raise FeatureNotReadyError(f"{feature_names[feature_type]}正在加载，请稍后重试")
+    check_index_meta(feature_type)
+    feats = await get_extract_task(feature_type, batch)
+    ok = []
+    for i in missing:
+        if isinstance(feats[i], Exception):
+            results[i] = feats[i]
+        else:
+            ok.append(i)
+    if ok:
+        with stage_seconds.time(stage="search", feature=feature_type):
+            version, searched = await search_executor.run(search_index, feature_type, [feats[i] for i in ok], k)
+        for i, result in zip(ok, searched):
+            results[i] = result
+            query_cache.put_result(batch.digests[i], feature_type, k, version, result)
+    return results
+
+class ResultCursor:
+    """一次检索的候选结果列表，翻页时直接从中读取，无需重新提取特征和检索"""
+    def __init__(self, selected_features, original_img_data, rankings):
+        self.selected_features = selected_features
+        self.original_img_data = original_img_data
+        # feature_type -> {"img_paths", "distances", "feat", "exhausted"} 或 {"error"}
+        self.rankings = rankings
+
+async def rank_feature(feature_type, batch, window):
+    """检索候选窗口内的排序结果，保留查询特征以便翻出窗口时继续检索"""
+    try:
+        result = (await search_feature(feature_type, batch, window))[0]
+        if isinstance(result, Exception):
+            raise result
+        result_imgs, _, distances = result
+        task = batch.tasks.get(feature_type)
+        if task is not None and task.done() and not task.exception():
+            feat = task.result()[0]
+        else:
+            feat = query_cache.get_feature(batch.digests[0], feature_type)
+        return {
+            "img_paths": result_imgs,
+            "distances": distances,
+            "feat": feat,
+            # 返回数量不足窗口大小说明已经检索到索引末尾
+            "exhausted": len(result_imgs) < window,
+        }
+    except QueueFullError:
+        raise
+    except Exception as e:
+        return {"error": str(e)}
+
+async def extend_ranking(feature_type, ranking, depth):
+    """翻页超出候选窗口时，用保存的查询特征检索更深的结果"""
+    if ("error" in ranking or ranking["exhausted"] or ranking["feat"] is None
+            or len(ranking["img_paths"]) >= depth):
+        return
+    depth = min(max(depth, 2 * len(ranking["img_paths"])), max_result_depth)
+    with stage_seconds.time(stage="search", feature=feature_type):
+        _, results = await search_executor.run(search_index, feature_type, [ranking["feat"]], depth)
+    result_imgs, _, distances = results[0]
+    ranking["img_paths"] = result_imgs
+    ranking["distances"] = distances
+    ranking["exhausted"] = len(result_imgs) < depth
+
+def render_results_page(request, token, cursor, offset, k):
+    """从候选列表中截取一页渲染 result.html"""
+    all_results = []
+    has_next = False
+    for feature_type in cursor.selected_features:
+        ranking = cursor.rankings[feature_type]
+        if "error" in ranking:
+            all_results.append({
+                "feature_name": feature_names[feature_type],
+                "result_imgs": [],
+                "result_scores": [],
+                "error": ranking["error"]
+            })
+            continue
+        page_dists = ranking["distances"][offset:offset + k]
+        all_results.append({
+            "feature_name": feature_names[feature_type],
+            "result_imgs": ranking["img_paths"][offset:offset + k],
+            "result_scores": normalize_scores(page_dists)
+        })
+        more = len(ranking["img_paths"]) > offset + k or not ranking["exhausted"]
+        has_next = has_next or (more and offset + 2 * k <= max_result_depth)
+
+    with stage_seconds.time(stage="render"):
+        return templates.TemplateResponse(
+            "result.html",
+            {
+                "request": request,
+                "original_img_data": cursor.original_img_data,
+                "all_results": all_results,
+                "selected_features": cursor.selected_features,
+                "cursor": token,
+                "offset": offset,
+                "k": k,
+                "has_next": has_next
+            }
+        )
+
+def check_page_params(k, offset):
+    if not 1 <= k <= api_max_k:
+        raise HTTPException(status_code=400, detail=f"k 必须在 1 到 {api_max_k} 之间")
+    if offset < 0 or offset + k > max_result_depth:
+        raise HTTPException(status_code=400, detail=f"最多浏览前 {max_result_depth} 条结果")
 
 @app.post("/search", response_class=HTMLResponse)
 async def search(
     request: Request, 
     file: UploadFile = File(...),
-    features: List[str] = Form(...)
+    features: List[str] = Form(...),
+    k: int = Form(5),
+    offset: int = Form(0)
 ):
     # 验证选择的特征类型
-    valid_features = set(feature_methods.keys())
+    valid_features = set(feature_types)
     selected_features = [f for f in features if f in valid_features]
     
     if not selected_features:
         # 如果没有选择有效特征，默认使用所有特征
         selected_features = list(valid_features)
+    check_page_params(k, offset)
     
-    img_bytes = await file.read()
-    img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-    # 转为 base64 以便前端展示原图
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-    original_img_data = f"data:image/png;base64,{img_base64}"
+    with stage_seconds.time(stage="upload_read"):
+        img_bytes = await file.read()
+    # 一次检索较大的候选窗口，后续翻页从游标缓存中读取
+    window = min(max(candidate_window, offset + k), max_result_depth)
+    try:
+        with stage_seconds.time(stage="decode"):
+            img, original_img_data = await search_executor.run(decode_image, img_bytes)
+        # 各特征的提取和检索并行执行，结果保持 selected_features 的顺序
+        batch = QueryBatch([img], [content_hash(img_bytes)])
+        rankings = await asyncio.gather(
+            *[rank_feature(f, batch, window) for f in selected_features]
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
-    all_results = []
-    for feature_type in selected_features:
-        try:
-            extract_func = feature_methods[feature_type]
-            feat = np.array(extract_func(img)).astype('float32').reshape(1, -1)
-            features = np.load(os.path.join(faiss_index_dir, f'features_{feature_type}.npy'))
-            index = faiss.read_index(os.path.join(faiss_index_dir, f'index_{feature_type}.faiss'))
-            with open(os.path.join(faiss_index_dir, f'img_paths_{feature_type}.txt'), encoding='utf-8') as f:
-                img_paths = [line.strip() for line in f]
-            D, I = index.search(feat, 5)
-            result_imgs = [img_paths[i] for i in I[0]]
-            d_min, d_max = float(np.min(D[0])), float(np.max(D[0]))
-            if d_max > d_min:
-                result_scores = [1 - (float(d) - d_min) / (d_max - d_min) for d in D[0]]
+    cursor = ResultCursor(selected_features, original_img_data, dict(zip(selected_features, rankings)))
+    token = secrets.token_urlsafe(16)
+    cursor_cache.put(token, cursor)
+    return render_results_page(request, token, cursor, offset, k)
+
+@app.get("/search/{token}", response_class=HTMLResponse)
+async def search_page(request: Request, token: str, offset: int = 0, k: int = 5):
+    """翻页：从游标缓存中读取已检索的候选结果"""
+    check_page_params(k, offset)
+    cursor = cursor_cache.get(token)
+    if cursor is None:
+        raise HTTPException(status_code=404, detail="检索结果已过期，请重新上传图片")
+    try:
+        await asyncio.gather(
+            *[extend_ranking(f, cursor.rankings[f], offset + k) for f in cursor.selected_features]
+        )
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return render_results_page(request, token, cursor, offset, k)
+
+@app.post("/api/search")
+async def api_search(
+    files: List[UploadFile] = File(...),
+    features: List[str] = Form([]),
+    k: int = Form(5),
+    offset: int = Form(0)
+):
+    """JSON批量检索接口，一次请求可上传多张图片"""
+    selected_features = features or list(feature_types)
+    invalid = [f for f in selected_features if f not in feature_types]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"未知的特征类型: {invalid}")
+    check_page_params(k, offset)
+    if len(files) > api_max_batch:
+        raise HTTPException(status_code=400, detail=f"单次最多上传 {api_max_batch} 张图片")
+
+    with stage_seconds.time(stage="upload_read"):
+        img_bytes_list = [await f.read() for f in files]
+    try:
+        with stage_seconds.time(stage="decode"):
+            imgs = await search_executor.run(decode_images, img_bytes_list)
+        valid = [i for i, img in enumerate(imgs) if not isinstance(img, Exception)]
+        batch = QueryBatch([imgs[i] for i in valid], [content_hash(img_bytes_list[i]) for i in valid])
+        feature_results = await asyncio.gather(
+            *[search_feature(f, batch, offset + k) for f in selected_features],
+            return_exceptions=True
+        ) if valid else []
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    for result in feature_results:
+        if isinstance(result, QueueFullError):
+            raise HTTPException(status_code=503, detail=str(result))
+
+    queries = [{"filename": f.filename, "results": {}} for f in files]
+    for i, img in enumerate(imgs):
+        if isinstance(img, Exception):
+            queries[i]["error"] = str(img)
+    for feature_type, results in zip(selected_features, feature_results):
+        for pos, i in enumerate(valid):
+            result = results if isinstance(results, Exception) else results[pos]
+            if isinstance(result, Exception):
+                queries[i]["results"][feature_type] = {"error": str(result)}
             else:
-                result_scores = [1.0 for _ in D[0]]
-            all_results.append({
-                "feature_name": feature_names[feature_type],
-                "result_imgs": result_imgs,
-                "result_scores": result_scores
-            })
-        except Exception as e:
-            all_results.append({
-                "feature_name": feature_names[feature_type],
-                "result_imgs": [],
-                "result_scores": [],
-                "error": str(e)
-            })
+                result_imgs, _, distances = result
+                distances = distances[offset:offset + k]
+                queries[i]["results"][feature_type] = {
+                    "img_paths": result_imgs[offset:offset + k],
+                    "scores": normalize_scores(distances),
+                    "distances": distances,
+                }
+    return {"k": k, "offset": offset, "features": selected_features, "queries": queries}
+
+@app.get("/thumb/{fname:path}")
+def thumb(fname: str, request: Request):
+    """数据集图片的缩略图，首次请求时生成并缓存"""
+    try:
+        path = thumbnails.get(fname)
+    except (FileNotFoundError, IsADirectoryError):
+        raise HTTPException(status_code=404, detail="图片不存在")
+    except (UnidentifiedImageError, OSError):
+        # 数据集目录中的非图片或损坏文件
+        raise HTTPException(status_code=415, detail="无法解码图片")
+    etag = thumbnails.etag(path)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={thumb_max_age}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=thumbnails.media_type, headers=headers)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    return templates.TemplateResponse(
-        "result.html",
-        {
-            "request": request,
-            "original_img_data": original_img_data,
-            "all_results": all_results,
-            "selected_features": selected_features
+@app.get("/healthz")
+async def healthz():
+    """各特征的就绪状态，以及模型和索引是否已经加载完成"""
+    if onnx_backend.deep_backend == "onnx":
+        models = onnx_backend.loaded_models()
+    else:
+        models = {
+            "resnet": bool(resnet._resnet_models),
+            "vgg": bool(vggnet._vgg_models),
         }
-    )
+    indices = {f: f in index_registry.entries for f in feature_types}
+    warm = all(state == "ready" for state in feature_state.values()) and all(indices.values())
+    return {
+        "status": "ok" if warm else "warming",
+        "features": feature_state,
+        "errors": warmup_errors,
+        "models": models,
+        "backend": onnx_backend.deep_backend,
+        "inference_mode": inference_mode,
+        "indices": indices,
+    }
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """查询缓存的命中/未命中计数"""
+    return dict(query_cache.stats(), retrieval=retrieval.cache_stats())
 
 if __name__ == "__main__":
     import uvicorn
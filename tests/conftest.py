@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """特征模块导入时在当前目录下创建 cache/，测试在临时目录中运行，特征模块应在测试函数中导入"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def rgb_image():
+    """带有渐变和噪声的小尺寸RGB图片，各区域的内容不同"""
+    rng = np.random.default_rng(0)
+    h, w = 37, 53
+    yy, xx = np.mgrid[0:h, 0:w]
+    img = np.stack([xx * 255 // w, yy * 255 // h, (xx + yy) * 255 // (h + w)], axis=2)
+    img = img + rng.integers(0, 40, size=(h, w, 3))
+    return np.clip(img, 0, 255).astype(np.uint8)
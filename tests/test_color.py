@@ -0,0 +1,45 @@
+import itertools
+
+import numpy as np
+
+
+def _count_hist_loop(img, n_bin, bins, channel):
+    """原来逐像素统计的颜色直方图"""
+    bins_idx = {key: idx for idx, key in enumerate(itertools.product(np.arange(n_bin), repeat=channel))}
+    quantized = img.copy()
+    for idx in range(len(bins) - 1):
+        quantized[(img >= bins[idx]) & (img < bins[idx + 1])] = idx
+    hist = np.zeros(n_bin ** channel)
+    for h in range(img.shape[0]):
+        for w in range(img.shape[1]):
+            hist[bins_idx[tuple(quantized[h, w])]] += 1
+    return hist
+
+
+def _histogram_loop(img, n_bin, type, n_slice):
+    height, width, channel = img.shape
+    bins = np.linspace(0, 256, n_bin + 1, endpoint=True)
+    if type == 'global':
+        hist = _count_hist_loop(img, n_bin, bins, channel)
+    else:
+        hist = np.zeros((n_slice, n_slice, n_bin ** channel))
+        h_slice = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+        w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+        for hs in range(n_slice):
+            for ws in range(n_slice):
+                img_r = img[h_slice[hs]:h_slice[hs + 1], w_slice[ws]:w_slice[ws + 1]]
+                hist[hs][ws] = _count_hist_loop(img_r, n_bin, bins, channel)
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+def test_global_histogram_matches_pixel_loop(rgb_image):
+    from color import Color
+    np.testing.assert_array_equal(Color().histogram(rgb_image, n_bin=6, type='global'),
+                                  _histogram_loop(rgb_image, 6, 'global', None))
+
+
+def test_region_histogram_matches_pixel_loop(rgb_image):
+    from color import Color
+    np.testing.assert_array_equal(Color().histogram(rgb_image, n_bin=12, type='region', n_slice=3),
+                                  _histogram_loop(rgb_image, 12, 'region', 3))
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from skimage import color
+from skimage.feature import daisy
+
+
+def _image(height, width):
+    rng = np.random.default_rng(height * 1000 + width)
+    return rng.integers(0, 256, size=(height, width, 3)).astype(np.uint8)
+
+
+@pytest.mark.parametrize("height, width, n_slice", [(120, 120, 2), (64, 80, 2), (32, 32, 2), (61, 61, 2),
+                                                    (120, 90, 3), (24, 100, 3)])
+def test_region_histogram_on_small_images(height, width, n_slice):
+    import daisy as daisy_module
+    hist = daisy_module.Daisy().histogram(_image(height, width), type='region', n_slice=n_slice)
+    assert hist.shape == (n_slice * n_slice * daisy_module.R,)
+    assert np.all(np.isfinite(hist))
+    np.testing.assert_allclose(np.sum(hist), 1.0)
+    # 每个区域都分到了描述子
+    assert np.all(hist.reshape(n_slice * n_slice, -1).sum(axis=1) > 0)
+
+
+def test_global_histogram_matches_skimage_mean():
+    import daisy as daisy_module
+    img = _image(150, 170)
+    descs = daisy(color.rgb2gray(img), step=daisy_module.step, radius=daisy_module.radius,
+                  rings=daisy_module.rings, histograms=daisy_module.histograms, orientations=daisy_module.n_orient)
+    expected = np.mean(descs.reshape(-1, daisy_module.R), axis=0)
+    expected = expected / np.sum(expected)
+    np.testing.assert_allclose(daisy_module.Daisy().histogram(img, type='global'), expected, rtol=1e-9, atol=1e-12)
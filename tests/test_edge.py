@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+
+def _conv_loop(img, stride, kernels):
+    """原来逐窗口计算的边缘响应"""
+    H, W, C = img.shape
+    conv_kernels = np.tile(np.expand_dims(kernels, axis=3), (1, 1, 1, C))
+    sh, sw = stride
+    kn, kh, kw, _ = conv_kernels.shape
+    hh = int((H - kh) / sh + 1)
+    ww = int((W - kw) / sw + 1)
+    hist = np.zeros(kn)
+    for idx, k in enumerate(conv_kernels):
+        for h in range(hh):
+            for w in range(ww):
+                hist[idx] += np.sum(img[h * sh:h * sh + kh, w * sw:w * sw + kw] * k)
+    return hist / np.sum(hist)
+
+
+def _histogram_loop(img, stride, type, n_slice, kernels):
+    height, width, _ = img.shape
+    if type == 'global':
+        hist = _conv_loop(img, stride, kernels)
+    else:
+        hist = np.zeros((n_slice, n_slice, kernels.shape[0]))
+        h_slice = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+        w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+        for hs in range(n_slice):
+            for ws in range(n_slice):
+                img_r = img[h_slice[hs]:h_slice[hs + 1], w_slice[ws]:w_slice[ws + 1]]
+                hist[hs][ws] = _conv_loop(img_r, stride, kernels)
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+@pytest.mark.parametrize("stride", [(1, 1), (2, 2), (3, 2)])
+def test_global_histogram_matches_window_loop(rgb_image, stride):
+    from edge import Edge, edge_kernels
+    np.testing.assert_allclose(Edge().histogram(rgb_image, stride=stride, type='global'),
+                               _histogram_loop(rgb_image, stride, 'global', None, edge_kernels), rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("stride, n_slice", [((1, 1), 4), ((2, 2), 4), ((2, 2), 10), ((3, 2), 3)])
+def test_region_histogram_matches_window_loop(rgb_image, stride, n_slice):
+    from edge import Edge, edge_kernels
+    np.testing.assert_allclose(Edge().histogram(rgb_image, stride=stride, type='region', n_slice=n_slice),
+                               _histogram_loop(rgb_image, stride, 'region', n_slice, edge_kernels), rtol=1e-9, atol=1e-12)
@@ -0,0 +1,83 @@
+import os
+
+import imageio
+import numpy as np
+import pandas as pd
+
+
+class _Database(object):
+    def __init__(self, paths, classes):
+        self.data = pd.DataFrame({'img': paths, 'cls': classes})
+
+    def get_data(self):
+        return self.data
+
+
+class _MeanColor(object):
+    """记录被调用的图片数量的测试特征"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def cache_name(self):
+        return 'mean_color-test'
+
+    def extract(self, img, gray=None):
+        self.calls += 1
+        return img.reshape(-1, 3).mean(axis=0)
+
+
+def _write_images(tmp_path, rgb_image, n):
+    paths = []
+    for i in range(n):
+        path = str(tmp_path / 'img{}.png'.format(i))
+        imageio.imwrite(path, np.roll(rgb_image, i * 5, axis=1))
+        paths.append(path)
+    return paths
+
+
+def test_store_round_trips_and_is_not_rewritten(tmp_path, rgb_image):
+    import feature_store
+    store_path = str(tmp_path / 'cache' / 'feature_store')
+    paths = _write_images(tmp_path, rgb_image, 3)
+    broken = str(tmp_path / 'broken.png')
+    with open(broken, 'wb') as f:
+        f.write(b'not an image')
+    db = _Database(paths + [broken], ['a', 'b', 'a', 'b'])
+
+    extractor = _MeanColor()
+    samples, = feature_store.make_samples(db, [extractor], verbose=False, path=store_path)
+    assert extractor.calls == 3
+    assert [s['img'] for s in samples] == paths
+    assert [s['cls'] for s in samples] == ['a', 'b', 'a']
+
+    stored = feature_store.load_store(store_path)
+    assert list(stored.index) == paths + [broken]
+    assert list(stored['cls']) == ['a', 'b', 'a', 'b']
+    assert stored.loc[broken, extractor.cache_name()] == feature_store.failed
+    for sample in samples:
+        np.testing.assert_array_equal(stored.loc[sample['img'], extractor.cache_name()], sample['hist'])
+
+    # 第二次全部命中存储（包括失败标记），不重新计算也不重写文件
+    mtime = os.stat(store_path).st_mtime_ns
+    extractor = _MeanColor()
+    again, = feature_store.make_samples(db, [extractor], verbose=False, path=store_path)
+    assert extractor.calls == 0
+    assert os.stat(store_path).st_mtime_ns == mtime
+    for sample, cached in zip(samples, again):
+        assert sample['img'] == cached['img']
+        np.testing.assert_array_equal(sample['hist'], cached['hist'])
+
+
+def test_store_computes_only_new_images(tmp_path, rgb_image):
+    import feature_store
+    store_path = str(tmp_path / 'cache' / 'feature_store')
+    paths = _write_images(tmp_path, rgb_image, 4)
+    feature_store.make_samples(_Database(paths[:2], ['a', 'b']), [_MeanColor()], verbose=False, path=store_path)
+
+    extractor = _MeanColor()
+    samples, = feature_store.make_samples(_Database(paths, ['a', 'b', 'a', 'b']), [extractor], verbose=False,
+                                          path=store_path)
+    assert extractor.calls == 2
+    assert [s['img'] for s in samples] == paths
+    assert list(feature_store.load_store(store_path).index) == paths
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+from skimage import color
+
+
+def _power_convolve(image, kernel):
+    """原来用 ndi.convolve 逐个卷积核计算的响应能量"""
+    image = (image - image.mean()) / image.std()
+    f_img = np.sqrt(ndi.convolve(image, np.real(kernel), mode='wrap') ** 2 +
+                    ndi.convolve(image, np.imag(kernel), mode='wrap') ** 2)
+    return np.array([f_img.mean(), f_img.var()])
+
+
+def _gabor_convolve(img, kernels):
+    hist = np.array([_power_convolve(color.rgb2gray(img), kernel) for kernel in kernels])
+    hist = hist / np.sum(hist, axis=0)
+    return hist.T.flatten()
+
+
+def _histogram_convolve(img, type, n_slice, kernels):
+    height, width = img.shape[:2]
+    if type == 'global':
+        hist = _gabor_convolve(img, kernels)
+    else:
+        hist = np.zeros((n_slice, n_slice, 2 * len(kernels)))
+        h_slice = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+        w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+        for hs in range(n_slice):
+            for ws in range(n_slice):
+                img_r = img[h_slice[hs]:h_slice[hs + 1], w_slice[ws]:w_slice[ws + 1]]
+                hist[hs][ws] = _gabor_convolve(img_r, kernels)
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+@pytest.mark.parametrize("type, n_slice", [('global', None), ('region', 2)])
+def test_histogram_matches_convolve(rgb_image, type, n_slice):
+    from gabor import Gabor, gabor_kernels
+    np.testing.assert_allclose(Gabor().gabor_histogram(rgb_image, type=type, n_slice=n_slice),
+                               _histogram_convolve(rgb_image, type, n_slice, gabor_kernels), rtol=1e-9, atol=1e-12)
+
+
+def test_gray_input_matches_rgb(rgb_image):
+    from gabor import Gabor
+    gabor = Gabor()
+    np.testing.assert_array_equal(gabor.gabor_histogram(color.rgb2gray(rgb_image)), gabor.gabor_histogram(rgb_image))
+
+
+def test_extract_batch_pool_matches_in_process(rgb_image):
+    from gabor import Gabor
+    import feature_store
+    grays = [color.rgb2gray(rgb_image), color.rgb2gray(rgb_image[::-1, :17])]
+    pool = feature_store.create_pool(workers=2)
+    try:
+        pooled = Gabor().extract_batch(None, grays, pool=pool)
+    finally:
+        pool.shutdown()
+    for got, expected in zip(pooled, Gabor().extract_batch(None, grays)):
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_large_bank_is_computed_in_batches(rgb_image, monkeypatch):
+    import gabor
+    from gabor import Gabor, gabor_kernels
+    gray = color.rgb2gray(rgb_image)
+    expected = Gabor().gabor_histogram(gray)
+    # 缓存放不下整个卷积核组时逐批计算卷积核的FFT，每批5个
+    monkeypatch.setattr(gabor, 'max_batch_pixels', gray.size * 5)
+    monkeypatch.setattr(gabor, 'kernel_cache_bytes', 0)
+    monkeypatch.setattr(gabor, '_kernel_cache', gabor.collections.OrderedDict())
+    batches = []
+    iter_kernel_ffts = gabor.iter_kernel_ffts
+    monkeypatch.setattr(gabor, 'iter_kernel_ffts',
+                        lambda *args: (batches.append(len(c)) or c for c in iter_kernel_ffts(*args)))
+    np.testing.assert_allclose(Gabor().gabor_histogram(gray), expected, rtol=1e-12, atol=1e-15)
+    assert max(batches) == 5 and sum(batches) == len(gabor_kernels)
+    assert not gabor._kernel_cache
+
+
+def test_kernel_cache_is_bounded_by_bytes(monkeypatch):
+    import gabor
+    from gabor import Gabor, gabor_kernels
+    bank_bytes = len(gabor_kernels) * 20 * 20 * 16
+    monkeypatch.setattr(gabor, 'kernel_cache_bytes', bank_bytes * 2)
+    monkeypatch.setattr(gabor, '_kernel_cache', gabor.collections.OrderedDict())
+    rng = np.random.default_rng(0)
+    for shape in [(20, 20), (20, 20), (10, 40), (40, 10), (30, 30)]:
+        Gabor().gabor_histogram(rng.random(shape))
+    # 最近使用的两个卷积核组留在缓存中，超过上限的 30x30 不缓存
+    assert list(gabor._kernel_cache) == [(10, 40), (40, 10)]
+    assert sum(v.nbytes for v in gabor._kernel_cache.values()) <= gabor.kernel_cache_bytes
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from skimage import color
+from skimage.feature import hog
+
+
+def _HOG_skimage(img, n_bin, n_orient, p_p_c, c_p_b):
+    """原来直接调用 skimage.feature.hog 的实现"""
+    fd = hog(color.rgb2gray(img), orientations=n_orient, pixels_per_cell=p_p_c, cells_per_block=c_p_b)
+    bins = np.linspace(0, np.max(fd), n_bin + 1, endpoint=True)
+    hist, _ = np.histogram(fd, bins=bins)
+    return np.array(hist) / np.sum(hist)
+
+
+def _histogram_loop(img, n_bin, type, n_slice, n_orient, p_p_c, c_p_b):
+    height, width, _ = img.shape
+    if type == 'global':
+        hist = _HOG_skimage(img, n_bin, n_orient, p_p_c, c_p_b)
+    else:
+        hist = np.zeros((n_slice, n_slice, n_bin))
+        h_slice = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+        w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+        for hs in range(n_slice):
+            for ws in range(n_slice):
+                img_r = img[h_slice[hs]:h_slice[hs + 1], w_slice[ws]:w_slice[ws + 1]]
+                hist[hs][ws] = _HOG_skimage(img_r, n_bin, n_orient, p_p_c, c_p_b)
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+@pytest.mark.parametrize("p_p_c, c_p_b", [((2, 2), (1, 1)), ((4, 4), (2, 2)), ((3, 5), (2, 1))])
+def test_hog_matches_skimage(rgb_image, monkeypatch, p_p_c, c_p_b):
+    import HOG
+    monkeypatch.setattr(HOG, 'p_p_c', p_p_c)
+    monkeypatch.setattr(HOG, 'c_p_b', c_p_b)
+    gray = color.rgb2gray(rgb_image)
+    expected = hog(gray, orientations=HOG.n_orient, pixels_per_cell=p_p_c, cells_per_block=c_p_b,
+                   block_norm='L2-Hys', feature_vector=False)
+    # skimage 的 hog 内部用单精度累加，逐元素只能在单精度误差内一致
+    np.testing.assert_allclose(HOG.HOG()._hog(gray), expected, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("type, n_slice", [('global', None), ('region', 3)])
+def test_histogram_matches_skimage_loop(rgb_image, type, n_slice):
+    import HOG
+    np.testing.assert_allclose(HOG.HOG().histogram(rgb_image, type=type, n_slice=n_slice),
+                               _histogram_loop(rgb_image, HOG.n_bin, type, n_slice, HOG.n_orient, HOG.p_p_c, HOG.c_p_b),
+                               rtol=1e-9, atol=1e-12)
+
+
+def _regions_skimage(img, n_bin, n_slice, n_orient, p_p_c, c_p_b):
+    """整张图片计算一次skimage的HOG，每个block归入其中心所在的区域后逐区域统计"""
+    height, width = img.shape[:2]
+    fd = hog(color.rgb2gray(img), orientations=n_orient, pixels_per_cell=p_p_c, cells_per_block=c_p_b,
+             feature_vector=False)
+    h_slice = np.around(np.linspace(0, height, n_slice + 1, endpoint=True)).astype(int)
+    w_slice = np.around(np.linspace(0, width, n_slice + 1, endpoint=True)).astype(int)
+    values = [[[] for _ in range(n_slice)] for _ in range(n_slice)]
+    for r in range(fd.shape[0]):
+        for c in range(fd.shape[1]):
+            hs = min(np.searchsorted(h_slice, (r + c_p_b[0] / 2.) * p_p_c[0], side='right') - 1, n_slice - 1)
+            ws = min(np.searchsorted(w_slice, (c + c_p_b[1] / 2.) * p_p_c[1], side='right') - 1, n_slice - 1)
+            values[hs][ws].append(fd[r, c].ravel())
+    hist = np.zeros((n_slice, n_slice, n_bin))
+    for hs in range(n_slice):
+        for ws in range(n_slice):
+            v = np.concatenate(values[hs][ws])
+            h, _ = np.histogram(v, bins=np.linspace(0, np.max(v), n_bin + 1, endpoint=True))
+            hist[hs][ws] = h / np.sum(h)
+    hist /= np.sum(hist)
+    return hist.flatten()
+
+
+@pytest.mark.parametrize("n_slice", [2, 3, 6])
+def test_single_pass_matches_whole_image_skimage(rgb_image, n_slice):
+    import HOG
+    np.testing.assert_allclose(HOG.HOG().histogram(rgb_image, type='region', n_slice=n_slice, single_pass=True),
+                               _regions_skimage(rgb_image, HOG.n_bin, n_slice, HOG.n_orient, HOG.p_p_c, HOG.c_p_b),
+                               rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("n_slice", [2, 3])
+def test_single_pass_close_to_region_loop(rgb_image, n_slice):
+    import HOG
+    single = HOG.HOG().histogram(rgb_image, type='region', n_slice=n_slice, single_pass=True)
+    regions = HOG.HOG().histogram(rgb_image, type='region', n_slice=n_slice)
+    # 区域边界处的梯度和block不同，两者只是近似：各区域直方图的平均L1距离（最大为2）不超过0.5
+    assert np.abs(single - regions).sum() < 0.5
+
+
+@pytest.mark.parametrize("height, width", [(4, 4), (5, 7), (37, 53)])
+def test_single_pass_regions_sum_to_one(rgb_image, height, width):
+    import HOG
+    n_slice = 2
+    hist = HOG.HOG().histogram(rgb_image[:height, :width], type='region', n_slice=n_slice, single_pass=True)
+    assert hist.shape == (n_slice * n_slice * HOG.n_bin,)
+    np.testing.assert_allclose(hist.reshape(n_slice * n_slice, -1).sum(axis=1) * n_slice * n_slice, 1.0)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+
+def _blocks(sizes, dim=6):
+    rng = np.random.default_rng(0)
+    blocks, start = [], 0
+    for rows in sizes:
+        features = rng.standard_normal((rows, dim)).astype('float32')
+        blocks.append((features, ['img_{}.jpg'.format(i) for i in range(start, start + rows)]))
+        start += rows
+    return blocks
+
+
+def _assert_entry(entry, blocks):
+    features = np.concatenate([f for f, _ in blocks])
+    np.testing.assert_array_equal(entry.index.reconstruct_n(0, entry.index.ntotal), features)
+    assert entry.img_paths == [p for _, paths in blocks for p in paths]
+
+
+def test_append_compact_then_load_keeps_rows_in_order(tmp_path):
+    import index_segments
+    from index_registry import IndexRegistry
+    index_dir = str(tmp_path / 'faiss_index')
+    os.makedirs(index_dir)
+    blocks = _blocks([3, 5, 1, 200, 4, 2])
+    for features, img_paths in blocks[:4]:
+        index_segments.append_segment(index_dir, 'color', features, img_paths)
+
+    registry = IndexRegistry(index_dir, ['color'])
+    _assert_entry(registry.get('color'), blocks[:4])
+
+    # 只追加新段时复制已加载的索引
+    for features, img_paths in blocks[4:]:
+        index_segments.append_segment(index_dir, 'color', features, img_paths)
+    entry = registry.get('color')
+    assert len(entry.segments) == 6
+    _assert_entry(entry, blocks)
+
+    # 200行的段不是小段，两侧的小段分别合并
+    assert index_segments.compact(index_dir, 'color', min_rows=100, force=True)
+    manifest = index_segments.read_manifest(index_dir, 'color')
+    assert [s['rows'] for s in manifest['segments']] == [9, 200, 6]
+    assert sorted(os.listdir(index_segments.segment_dir(index_dir, 'color'))) == sorted(
+        os.path.basename(path) for s in manifest['segments']
+        for path in index_segments.segment_files(index_dir, 'color', s['id']))
+    _assert_entry(registry.get('color'), blocks)
+    _assert_entry(IndexRegistry(index_dir, ['color']).get('color'), blocks)
+
+
+def test_compact_waits_for_enough_small_segments(tmp_path):
+    import index_segments
+    index_dir = str(tmp_path / 'faiss_index')
+    os.makedirs(index_dir)
+    for features, img_paths in _blocks([2, 2, 2]):
+        index_segments.append_segment(index_dir, 'color', features, img_paths)
+    assert not index_segments.compact(index_dir, 'color', min_rows=100, factor=4)
+    assert len(index_segments.read_manifest(index_dir, 'color')['segments']) == 3
+
+
+def test_append_migrates_legacy_files(tmp_path):
+    import index_segments
+    from index_registry import IndexRegistry
+    index_dir = str(tmp_path / 'faiss_index')
+    os.makedirs(index_dir)
+    blocks = _blocks([7, 3])
+    features_file, paths_file, _ = index_segments.legacy_files(index_dir, 'color')
+    np.save(features_file, blocks[0][0])
+    with open(paths_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(blocks[0][1]) + '\n')
+
+    index_segments.append_segment(index_dir, 'color', *blocks[1])
+    assert not os.path.exists(features_file) and not os.path.exists(paths_file)
+    assert [s['rows'] for s in index_segments.read_manifest(index_dir, 'color')['segments']] == [7, 3]
+    _assert_entry(IndexRegistry(index_dir, ['color']).get('color'), blocks)